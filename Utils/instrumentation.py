@@ -0,0 +1,327 @@
+'''
+Per-patient, per-stage timing and memory instrumentation.
+
+Each stage records its wall time, CPU time and the peak RSS seen while it
+ran, one JSON object per line. Both include the child processes (dicom
+conversion, nnU-Net preprocessing and export workers): the CPU time of the
+live ones and of the ones reaped meanwhile, the RSS of the live ones. A Prometheus textfile-format snapshot can be
+derived from the JSON lines of a run, e.g. for the node exporter textfile
+collector.
+
+    from Utils import instrumentation
+    instrumentation.configure("Outputs/metrics.jsonl", run_id="...")
+    with instrumentation.stage("wg_inference", patient=key):
+        ...
+'''
+import os
+import json
+import time
+import uuid
+import resource
+import platform
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+def current_rss() -> int:
+    ''' Resident set size of this process in bytes '''
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no procfs, fall back to the lifetime peak (kB on Linux, bytes on macOS)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if platform.system() == "Darwin" else maxrss * 1024
+
+def _children(pid:int) -> list:
+    ''' Live child processes of pid, empty without procfs '''
+    children = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return children
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children", "r", encoding="utf-8") as file:
+                children.extend(int(child) for child in file.read().split())
+        except (OSError, ValueError): # the thread or the process is gone
+            continue
+    return children
+
+def _descendants() -> list:
+    ''' Live child processes of this process and their own children '''
+    descendants = []
+    pending = _children(os.getpid())
+    while pending:
+        pid = pending.pop()
+        descendants.append(pid)
+        pending.extend(_children(pid))
+    return descendants
+
+def _children_rss(pids:list) -> int:
+    ''' Summed resident set size of processes, the pages they share are counted once per process '''
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm", "r", encoding="utf-8") as statm:
+                total += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError): # exited meanwhile
+            continue
+    return total
+
+def _children_cpu(pids:list) -> float:
+    ''' CPU time of live processes, with the one of the children they reaped (utime, stime, cutime, cstime) '''
+    ticks = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+            ticks += sum(int(value) for value in fields[11:15])
+        except (OSError, ValueError, IndexError):
+            continue
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+def _process_cpu() -> float:
+    ''' CPU time of the process, of its reaped children and of its live ones '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+            + _children_cpu(_descendants()))
+
+def _tree_rss() -> int:
+    ''' Resident set size of the process and of its live children '''
+    return current_rss() + _children_rss(_descendants())
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RunMetrics:
+    '''
+    Prometheus textfile snapshot of one run, built incrementally from its stage records.
+    Stage totals are aggregated over patients. The per patient gauges keep the latest
+    record of every (stage, patient), a patient processed again replaces its samples
+    instead of repeating the series.
+    '''
+
+    def __init__(self, run_id:str):
+        self.run_id = run_id
+        self.totals = defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "count": 0, "failed": 0, "peak": 0})
+        self.patients = {} # (stage, patient): (end, wall_s)
+        self.last_end = None
+
+    def add(self, record:dict):
+        total = self.totals[record["stage"]]
+        total["wall"] += record["wall_s"]
+        total["cpu"] += record["cpu_s"]
+        total["count"] += 1
+        total["failed"] += not record["ok"]
+        total["peak"] = max(total["peak"], record["peak_rss_bytes"])
+        end = record["start"] + record["wall_s"]
+        if record["patient"] is not None:
+            key = (record["stage"], record["patient"])
+            if key not in self.patients or self.patients[key][0] <= end:
+                self.patients[key] = (end, record["wall_s"])
+        self.last_end = end if self.last_end is None else max(self.last_end, end)
+
+    def lines(self) -> list:
+        totals = sorted(self.totals.items())
+        lines = [
+            "# HELP segmentor_stage_wall_seconds Wall time spent in a stage during the last run.",
+            "# TYPE segmentor_stage_wall_seconds summary",
+        ]
+        for name, total in totals:
+            lines.append(f'segmentor_stage_wall_seconds_sum{{stage="{_escape(name)}"}} {total["wall"]:.6f}')
+            lines.append(f'segmentor_stage_wall_seconds_count{{stage="{_escape(name)}"}} {total["count"]}')
+        lines += [
+            "# HELP segmentor_stage_cpu_seconds_total CPU time of the process and its child processes "
+            "(live or reaped) while a stage ran during the last run.",
+            "# TYPE segmentor_stage_cpu_seconds_total counter",
+        ]
+        for name, total in totals:
+            lines.append(f'segmentor_stage_cpu_seconds_total{{stage="{_escape(name)}"}} {total["cpu"]:.6f}')
+        lines += [
+            "# HELP segmentor_stage_failures_total Stage executions that raised during the last run.",
+            "# TYPE segmentor_stage_failures_total counter",
+        ]
+        for name, total in totals:
+            lines.append(f'segmentor_stage_failures_total{{stage="{_escape(name)}"}} {total["failed"]}')
+        lines += [
+            "# HELP segmentor_stage_peak_rss_bytes Highest resident set size of the process plus its live "
+            "child processes observed during a stage, shared pages counted once per process.",
+            "# TYPE segmentor_stage_peak_rss_bytes gauge",
+        ]
+        for name, total in totals:
+            lines.append(f'segmentor_stage_peak_rss_bytes{{stage="{_escape(name)}"}} {total["peak"]}')
+        lines += [
+            "# HELP segmentor_patient_stage_wall_seconds Wall time of the latest execution of a stage for one patient.",
+            "# TYPE segmentor_patient_stage_wall_seconds gauge",
+        ]
+        for (name, patient), (_, wall) in sorted(self.patients.items()):
+            lines.append(
+                f'segmentor_patient_stage_wall_seconds{{stage="{_escape(name)}",'
+                f'patient="{_escape(patient)}"}} {wall:.6f}'
+            )
+        lines += [
+            "# HELP segmentor_last_run_timestamp_seconds End of the last recorded stage.",
+            "# TYPE segmentor_last_run_timestamp_seconds gauge",
+            f'segmentor_last_run_timestamp_seconds{{run_id="{_escape(self.run_id)}"}} {self.last_end:.3f}',
+        ]
+        return lines
+
+    def write(self, prom_path:str):
+        if self.last_end is None:
+            return
+        # write and rename, so that the collector never reads a partial file
+        tmp_path = prom_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write("\n".join(self.lines()) + "\n")
+        os.replace(tmp_path, prom_path)
+
+class StageRecorder:
+    '''
+    Writes stage records to a JSON lines file.
+
+    Stages may run concurrently (streaming mode), so the peak RSS is tracked by
+    one sampler thread for all open stages and cpu_s is the CPU time of the
+    whole process while the stage ran; thread_cpu_s only counts the calling thread.
+    Child processes are counted in both, the sampler looks their pids up again
+    every children_interval seconds.
+    '''
+
+    def __init__(self, jsonl_path:str=None, run_id:str=None, sample_interval:float=0.01,
+                 children_interval:float=0.1):
+        self.jsonl_path = jsonl_path
+        self.run_id = run_id or uuid.uuid4().hex
+        self.sample_interval = sample_interval
+        self.children_interval = children_interval
+        self._lock = threading.Lock()
+        self._open = {}
+        self._sampler = None
+        self.metrics = RunMetrics(self.run_id) # running totals of the records written by this process
+
+    @property
+    def enabled(self) -> bool:
+        return self.jsonl_path is not None
+
+    def _sample(self):
+        children, listed = [], None
+        while True:
+            now = time.monotonic()
+            if listed is None or now - listed >= self.children_interval:
+                children, listed = _descendants(), now
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                rss = current_rss() + _children_rss(children)
+                for record in self._open.values():
+                    record["peak_rss_bytes"] = max(record["peak_rss_bytes"], rss)
+            time.sleep(self.sample_interval)
+
+    @contextmanager
+    def stage(self, stage:str, patient:str=None, **labels):
+        ''' Measures the enclosed block as one stage of one patient (None for cohort stages) '''
+        if not self.enabled:
+            yield {}
+            return
+
+        record = {
+            "run_id": self.run_id,
+            "pid": os.getpid(),
+            "stage": stage,
+            "patient": patient,
+            "start": time.time(),
+            "peak_rss_bytes": _tree_rss(),
+            **labels
+        }
+        key = id(record)
+        with self._lock:
+            self._open[key] = record
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+
+        wall, cpu, thread_cpu = time.perf_counter(), _process_cpu(), time.thread_time()
+        record["ok"] = False
+        try:
+            yield record
+            record["ok"] = True
+        finally:
+            record["wall_s"] = time.perf_counter() - wall
+            record["cpu_s"] = _process_cpu() - cpu
+            record["thread_cpu_s"] = time.thread_time() - thread_cpu
+            with self._lock:
+                self._open.pop(key, None)
+                record["peak_rss_bytes"] = max(record["peak_rss_bytes"], _tree_rss())
+                self._write(record)
+
+    def interval(self, stage:str, start:float, end:float, patient:str=None, **labels):
+        ''' Records a stage measured elsewhere, e.g. from an instance received to its SEG stored (epoch seconds) '''
+        if not self.enabled:
+            return
+        record = {
+            "run_id": self.run_id,
+            "pid": os.getpid(),
+            "stage": stage,
+            "patient": patient,
+            "start": start,
+            "peak_rss_bytes": _tree_rss(),
+            **labels,
+            "ok": True,
+            "wall_s": end - start,
+            "cpu_s": 0.0,
+            "thread_cpu_s": 0.0,
+        }
+        with self._lock:
+            self._write(record)
+
+    def _write(self, record:dict):
+        self.metrics.add(record)
+        os.makedirs(os.path.dirname(os.path.abspath(self.jsonl_path)), exist_ok=True)
+        with open(self.jsonl_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record) + "\n")
+
+_RECORDER = StageRecorder()
+
+def configure(jsonl_path:str=None, run_id:str=None) -> StageRecorder:
+    ''' Enables the recording of this process, call it in every process of a run with the same run_id '''
+    global _RECORDER
+    _RECORDER = StageRecorder(jsonl_path, run_id)
+    return _RECORDER
+
+def recorder() -> StageRecorder:
+    return _RECORDER
+
+def stage(stage_name:str, patient:str=None, **labels):
+    ''' Context manager measuring a stage with the configured recorder, no-op when disabled '''
+    return _RECORDER.stage(stage_name, patient=patient, **labels)
+
+def interval(stage_name:str, start:float, end:float, patient:str=None, **labels):
+    ''' Records a stage measured elsewhere with the configured recorder, no-op when disabled '''
+    _RECORDER.interval(stage_name, start, end, patient=patient, **labels)
+
+def write_prometheus(jsonl_path:str, prom_path:str, run_id:str=None):
+    '''
+    Writes a Prometheus textfile snapshot of one run (the last one if run_id is None),
+    from the JSON lines of all the processes of the run.
+    '''
+    if not os.path.exists(jsonl_path):
+        return
+    with open(jsonl_path, "r", encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    if not records:
+        return
+    metrics = RunMetrics(run_id or records[-1]["run_id"])
+    for record in records:
+        if record["run_id"] == metrics.run_id:
+            metrics.add(record)
+    metrics.write(prom_path)
+
+def write_process_prometheus(prom_path:str):
+    '''
+    Writes the snapshot of the records of this process kept in memory by the recorder,
+    for long running processes (watch mode) that should not read the JSON lines back.
+    '''
+    with _RECORDER._lock:
+        _RECORDER.metrics.write(prom_path)
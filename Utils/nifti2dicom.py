@@ -1,67 +1,73 @@
-''' 
+'''
 Convert nifti image to dicom with SimpleITK, modified example [1].
 Nifti images by nature are anonymized contains only metadata related to the image for manipulation.
 !Note: DO NOT USE FOR DICOM-SEG!! Not for multi-frame images (e.g. different b-values, planes)
 [1]: https://simpleitk.readthedocs.io/en/master/link_DicomSeriesReadModifyWrite_docs.html
+
+Two outputs:
+    classic   one MR Image Storage file per slice, written by a thread pool
+    enhanced  a single Enhanced MR Image Storage multi-frame file, written with pydicom
 '''
 
 import os
 import time
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import SimpleITK as sitk
-from pydicom.uid import generate_uid, MRImageStorage
+from pydicom import Dataset, dcmwrite
+from pydicom.sequence import Sequence
+from pydicom.tag import Tag
+from pydicom.datadict import dictionary_VR
+from pydicom.valuerep import DSfloat
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, MRImageStorage, EnhancedMRImageStorage
+from Utils.series_index import ReferenceSeries, expand_frames, order_headers
 
-def nifti2dicom( nifti_path:Path):
-    ''' Nifti to Dicom with SimpleITK. Not for multi-frames one dcm file directories!'''
+T2_EXPORT_MODES = ("classic", "enhanced")
+
+
+def _orientation(image:sitk.Image) -> tuple:
+    ''' Image Orientation (Patient), row and column direction cosines '''
+    _direction = image.GetDirection()
+    return (
+        _direction[0],
+        _direction[3],
+        _direction[6],
+        _direction[1],
+        _direction[4],
+        _direction[7],
+    )
+
+def _ds(values) -> list:
+    ''' Decimal strings within the 16 characters of the VR '''
+    return [DSfloat(value, auto_format=True) for value in values]
+
+def _series_tags(image:sitk.Image) -> dict:
+    ''' Tags shared by every slice of the series, generated once '''
 
-    output_name = ""
-    reader = sitk.ReadImage( nifti_path )
-    writer = sitk.ImageFileWriter()
-    # This guideline is when you load from a dicom directory
-    # "Use the study/series/frame of reference information given in the meta-data
-    # dictionary and not the automatically generated information from the file IO
-    writer.KeepOriginalImageUIDOn()
     # There are no UID stored in nifti, so we generate them! for uniqueness,
     # I set a random prefix accompanied from data and time for the uids
 
-    # Copy relevant tags from the original meta-data dictionary (private tags are
-    # also accessible).
-    # random prefix id
-
     # prefix normally is related to the organization ID (e.g. OID, OMG)
     patient_id = generate_uid()
     study_id = generate_uid()
     series_id = generate_uid()
-    sop_uid = generate_uid()
 
     modification_time = time.strftime("%H%M%S")
     modification_date = time.strftime("%Y%m%d")
 
-    _direction = reader.GetDirection()
-    rows, columns, frames = map(str,reader.GetSize())
-    pixel_spacing = reader.GetSpacing()[0:2]
-    pixel_spacing = "\\".join(map(str,pixel_spacing))
-    slice_thickness = str(reader.GetSpacing()[2])
-
-    direction = "\\".join(
-        map(
-            str,
-            (
-                _direction[0],
-                _direction[3],
-                _direction[6],
-                _direction[1],
-                _direction[4],
-                _direction[7],
-            ),  # Image Orientation (Patient)
-        )
-    )
+    columns, rows, frames = map(str,image.GetSize())
+    spacing = _ds(image.GetSpacing())
+    pixel_spacing = f"{spacing[1]}\\{spacing[0]}" # row spacing, column spacing
+    slice_thickness = str(spacing[2])
+
+    direction = "\\".join(map(str, _ds(_orientation(image)))) # Image Orientation (Patient)
 
-    tags_to_insert = {
+    return {
         "0010|0010":patient_id,  # Patient Name
         "0010|0020":patient_id,  # Patient ID
         "0008|0016": MRImageStorage, # SOP Class UID
-        "0008|0018":sop_uid, # SOP Instance UID
         "0008|1030":"Prostate Zone Segmentation", # Study Description
         "0010|0030":"",  # Patient Birth Date
         "0010|0040":"",  # Patient's Sex
@@ -72,7 +78,6 @@ def nifti2dicom( nifti_path:Path):
         "0020|000e":series_id, # Series Instance UID
         "0020|0052":generate_uid(), # Frame of Reference UID
         "0020|0011":"3", # Series Number
-        "0020|0013":"0", # Instance Number
         "0008|0020":modification_date, # Study Date
         "0008|0030":modification_time,  # Study Time
         "0008|0021":modification_date, # Series Date
@@ -87,6 +92,7 @@ def nifti2dicom( nifti_path:Path):
         "0018|9004":'RESEARCH', # Content Qualification
         "0028|0030":pixel_spacing,
         "0018|0050":slice_thickness,
+        "0018|0088":slice_thickness, # Spacing Between Slices
         "0028|0010":rows,
         "0028|0011":columns,
         "0028|0008":str(frames), # Number of Frames
@@ -100,6 +106,34 @@ def nifti2dicom( nifti_path:Path):
 
     }
 
+def _slice_tags(image:sitk.Image, i:int, sop_uid:str) -> dict:
+    ''' Tags of one slice of the classic series '''
+    return {
+        "0008|0018": sop_uid, # SOP Instance UID, kept by the writer so it must differ for every slice
+        "0020|0032": "\\".join(map(str, _ds(image.TransformIndexToPhysicalPoint((0, 0, i))))), # Image Position (Patient)
+        "0020|0013": str(i), # Instance Number
+    }
+
+def _dataset(tags:dict) -> Dataset:
+    ''' The tags of a SimpleITK metadata dictionary as pydicom parses them from the written files '''
+    dataset = Dataset()
+    for key, value in tags.items():
+        tag = Tag(int(key[:4], 16), int(key[5:], 16))
+        vr = dictionary_VR(tag)
+        if vr in ("US", "SS", "UL", "SL"):
+            value = int(value)
+        elif vr in ("DS", "IS") and value == "":
+            value = None # empty numbers are read back as None
+        dataset.add_new(tag, vr, value)
+    return dataset
+
+def _output_dir(tags:dict) -> str:
+    ''' dicom_outputs/<patient id>/<study uid>/t2w '''
+    return os.path.join("dicom_outputs", tags["0010|0020"], tags["0020|000d"], "t2w")
+
+def _write_classic(image:sitk.Image, tags:dict, output_name:str, sop_uids:list, workers:int=None):
+    ''' One file per slice, the slices are written concurrently (SimpleITK releases the GIL) '''
+
     # Copy some of the tags and add the relevant tags indicating the change.
     # For the series instance UID (0020|000e), each of the components is a number,
     # cannot start with zero, and separated by a '.' We create a unique series ID
@@ -112,34 +146,229 @@ def nifti2dicom( nifti_path:Path):
     #       always use lower case for the tags.
     # Tags of interest:
 
-    series_tag_values = [ (k, value) for k,value in tags_to_insert.items() ]
+    series_tag_values = list(tags.items())
+    creation_date = time.strftime("%Y%m%d")
+    creation_time = time.strftime("%H%M%S")
+    local = threading.local()
 
-    for i in range(reader.GetDepth()):
+    def write_slice(i:int):
+        # ImageFileWriter is not shared between threads
+        if not hasattr(local, "writer"):
+            local.writer = sitk.ImageFileWriter()
+            # This guideline is when you load from a dicom directory
+            # "Use the study/series/frame of reference information given in the meta-data
+            # dictionary and not the automatically generated information from the file IO
+            local.writer.KeepOriginalImageUIDOn()
 
-        image_slice = reader[:, :, i]
+        image_slice = image[:, :, i]
         # Tags shared by the series.
         for tag, value in series_tag_values:
             image_slice.SetMetaData(tag, value)
 
         # Slice specific tags.
+        for tag, value in _slice_tags(image, i, sop_uids[i]).items():
+            image_slice.SetMetaData(tag, value)
         #   Instance Creation Date
-        image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d"))
+        image_slice.SetMetaData("0008|0012", creation_date)
         #   Instance Creation Time
-        image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S"))
-        #   Image Position (Patient)
-        image_slice.SetMetaData(
-            "0020|0032",
-            "\\".join(map(str, reader.TransformIndexToPhysicalPoint((0, 0, i)))),
-        )
-        #   Instance Number
-        image_slice.SetMetaData("0020|0013", str(i))
+        image_slice.SetMetaData("0008|0013", creation_time)
 
         # Write to the output directory and add the extension dcm, to force writing
         # in DICOM format.
-        output_name = os.path.join("dicom_outputs",patient_id,study_id,"t2w")
-        os.makedirs( output_name, exist_ok=True)
-        output_file = os.path.join( output_name, f"image_{i:04}.dcm")
-        writer.SetFileName(output_file)
-        writer.Execute(image_slice)
+        local.writer.SetFileName(os.path.join( output_name, f"image_{i:04}.dcm"))
+        local.writer.Execute(image_slice)
+
+    workers = workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write_slice, range(image.GetDepth())))
+
+def _classic_headers(image:sitk.Image, tags:dict, sop_uids:list) -> tuple:
+    '''
+    The series header and the per slice headers of the classic files, as the SEG writer
+    reads them, built from the tags the files are written with
+    '''
+    header = _dataset(tags)
+    slices = [_dataset({"0008|0016": tags["0008|0016"], **_slice_tags(image, i, sop_uid)})
+              for i, sop_uid in enumerate(sop_uids)]
+    return header, slices
+
+def _pixel_data(image:sitk.Image) -> tuple:
+    '''
+    16 bit frames of the image and (pixel representation, rescale intercept, rescale slope).
+    Integer images that fit 16 bits are stored as they are, others are rescaled to uint16.
+    '''
+    array = sitk.GetArrayViewFromImage(image)
+    minimum, maximum = float(array.min()), float(array.max())
+    if np.issubdtype(array.dtype, np.integer):
+        if minimum >= 0 and maximum <= np.iinfo(np.uint16).max:
+            return array.astype("<u2"), (0, 0.0, 1.0)
+        if minimum >= np.iinfo(np.int16).min and maximum <= np.iinfo(np.int16).max:
+            return array.astype("<i2"), (1, 0.0, 1.0)
+    slope = (maximum - minimum) / np.iinfo(np.uint16).max or 1.0
+    return np.round((array - minimum) / slope).astype("<u2"), (0, minimum, slope)
+
+def _write_enhanced(image:sitk.Image, tags:dict, output_name:str) -> Dataset:
+    '''
+    The whole volume as one Enhanced MR multi-frame file, same patient/study/series as classic.
+    The frames are DERIVED: the MR acquisition macros (timing, FOV/geometry, echo, modifier,
+    coils, averages) and the MR Pulse Sequence module are only required for ORIGINAL or MIXED
+    frames and a NIfTI carries none of their values, so they are left out rather than made up.
+    '''
+    frames, (pixel_representation, intercept, slope) = _pixel_data(image)
+    sop_instance_uid = generate_uid()
+    creation_date = time.strftime("%Y%m%d")
+    creation_time = time.strftime("%H%M%S")
+
+    meta = Dataset()
+    meta.MediaStorageSOPClassUID = EnhancedMRImageStorage
+    meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    meta.ImplementationClassUID = generate_uid()
+
+    ds = Dataset()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.file_meta = meta
+
+    ds.SOPClassUID = EnhancedMRImageStorage
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.PatientName = tags["0010|0010"]
+    ds.PatientID = tags["0010|0020"]
+    ds.PatientBirthDate = ""
+    ds.PatientSex = ""
+    ds.StudyInstanceUID = tags["0020|000d"]
+    ds.StudyID = tags["0020|0010"]
+    ds.StudyDescription = tags["0008|1030"]
+    ds.StudyDate = tags["0008|0020"]
+    ds.StudyTime = tags["0008|0030"]
+    ds.AccessionNumber = tags["0008|0050"]
+    ds.ReferringPhysicianName = ""
+    ds.SeriesInstanceUID = tags["0020|000e"]
+    ds.SeriesNumber = tags["0020|0011"]
+    ds.SeriesDate = tags["0008|0021"]
+    ds.SeriesTime = tags["0008|0031"]
+    ds.SeriesDescription = tags["0008|103e"]
+    ds.Modality = "MR"
+    ds.FrameOfReferenceUID = tags["0020|0052"]
+    ds.PositionReferenceIndicator = ""
+    # Enhanced General Equipment module, type 1 unlike the classic tags
+    ds.Manufacturer = "Unspecified"
+    ds.ManufacturerModelName = "Unspecified"
+    ds.DeviceSerialNumber = "1"
+    ds.SoftwareVersions = "0"
+    ds.AcquisitionContextSequence = Sequence() # Acquisition Context module, type 2
+    ds.InstanceNumber = "1"
+    ds.InstanceCreationDate = creation_date
+    ds.InstanceCreationTime = creation_time
+    ds.ContentDate = creation_date
+    ds.ContentTime = creation_time
+    ds.AcquisitionDateTime = creation_date + creation_time
+
+    # Enhanced MR Image module
+    ds.ImageType = ["DERIVED", "SECONDARY", "VOLUME", "NONE"]
+    ds.ContentQualification = tags["0018|9004"]
+    ds.PixelPresentation = "MONOCHROME"
+    ds.VolumetricProperties = "VOLUME"
+    ds.VolumeBasedCalculationTechnique = "NONE"
+    ds.ComplexImageComponent = "MAGNITUDE"
+    ds.AcquisitionContrast = "UNKNOWN"
+    ds.BurnedInAnnotation = "NO"
+    ds.LossyImageCompression = tags["0028|2110"]
+    ds.PresentationLUTShape = "IDENTITY"
+
+    # Image pixel module
+    ds.Columns, ds.Rows = image.GetSize()[0:2]
+    ds.NumberOfFrames = str(image.GetDepth())
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = tags["0028|0004"]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = pixel_representation
+
+    # Multi-frame dimensions: the frames are the stack positions along the slice axis
+    dimension_uid = generate_uid()
+    organization = Dataset()
+    organization.DimensionOrganizationUID = dimension_uid
+    ds.DimensionOrganizationSequence = Sequence([organization])
+    ds.DimensionOrganizationType = "3D"
+    dimension_index = Dataset()
+    dimension_index.DimensionOrganizationUID = dimension_uid
+    dimension_index.DimensionIndexPointer = Tag("InStackPositionNumber")
+    dimension_index.FunctionalGroupPointer = Tag("FrameContentSequence")
+    ds.DimensionIndexSequence = Sequence([dimension_index])
+
+    # Shared functional groups
+    spacing = image.GetSpacing()
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = _ds((spacing[1], spacing[0])) # row spacing, column spacing
+    pixel_measures.SliceThickness, = _ds(spacing[2:])
+    pixel_measures.SpacingBetweenSlices, = _ds(spacing[2:])
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = _ds(_orientation(image))
+    frame_type = Dataset()
+    frame_type.FrameType = ds.ImageType
+    for keyword in ("PixelPresentation", "VolumetricProperties", "VolumeBasedCalculationTechnique",
+                    "ComplexImageComponent", "AcquisitionContrast"):
+        setattr(frame_type, keyword, getattr(ds, keyword))
+    pixel_transformation = Dataset()
+    pixel_transformation.RescaleIntercept, pixel_transformation.RescaleSlope = _ds((intercept, slope))
+    pixel_transformation.RescaleType = "US"
+    anatomic_region = Dataset()
+    anatomic_region.CodeValue = "T-92000"
+    anatomic_region.CodingSchemeDesignator = "SRT"
+    anatomic_region.CodeMeaning = "Prostate"
+    frame_anatomy = Dataset()
+    frame_anatomy.AnatomicRegionSequence = Sequence([anatomic_region])
+    frame_anatomy.FrameLaterality = "U"
+    shared = Dataset()
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    shared.PlaneOrientationSequence = Sequence([plane_orientation])
+    shared.MRImageFrameTypeSequence = Sequence([frame_type])
+    shared.PixelValueTransformationSequence = Sequence([pixel_transformation])
+    shared.FrameAnatomySequence = Sequence([frame_anatomy])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    # Per-frame functional groups: position and stack position of every slice
+    per_frame = Sequence()
+    for i in range(image.GetDepth()):
+        frame_content = Dataset()
+        frame_content.StackID = "1"
+        frame_content.InStackPositionNumber = i + 1
+        frame_content.DimensionIndexValues = [i + 1]
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = _ds(image.TransformIndexToPhysicalPoint((0, 0, i)))
+        group = Dataset()
+        group.FrameContentSequence = Sequence([frame_content])
+        group.PlanePositionSequence = Sequence([plane_position])
+        per_frame.append(group)
+    ds.PerFrameFunctionalGroupsSequence = per_frame
+
+    ds.PixelData = np.ascontiguousarray(frames).tobytes()
+    dcmwrite(os.path.join(output_name, "image.dcm"), ds, write_like_original=False)
+    return ds
+
+def nifti2dicom( nifti_path:Path, mode:str="classic", workers:int=None) -> ReferenceSeries:
+    '''
+    Nifti to Dicom, returns the directory of the series with the headers the SEG
+    writer needs (SOP UIDs, positions, patient/study and geometry tags), so that it
+    does not read the series back.
+    mode is classic (one file per slice, written by workers threads) or enhanced (one
+    multi-frame file). Not for multi-frames one dcm file directories!
+    '''
+    if mode not in T2_EXPORT_MODES:
+        raise ValueError(f"Unknown T2 export mode {mode}, expected one of {T2_EXPORT_MODES}")
+
+    reader = sitk.ReadImage( nifti_path )
+    tags = _series_tags(reader)
+    output_name = _output_dir(tags)
+    os.makedirs( output_name, exist_ok=True)
+
+    if mode == "enhanced":
+        header, slices = expand_frames(_write_enhanced(reader, tags, output_name))
+    else:
+        sop_uids = [generate_uid() for _ in range(reader.GetDepth())]
+        _write_classic(reader, tags, output_name, sop_uids, workers)
+        header, slices = _classic_headers(reader, tags, sop_uids)
 
-    return output_name
+    return ReferenceSeries(output_name, order_headers(slices, header, output_name))
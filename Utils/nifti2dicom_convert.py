@@ -3,23 +3,39 @@ import os
 import shutil
 import yaml
 from pydicom import dcmread
-from Utils.nifti2dicomseg import nifti2dicomseg
+from Utils.nifti2dicomseg import nifti2dicomseg_all
 from Utils.nifti2dicom import nifti2dicom
+from Utils.series_index import SeriesIndex
+from Utils import instrumentation
 
 SEG_OUTPUT = "Outputs"
 CATEGORY = "Resampled"
 
 
-def converter():
-    '''nifti to dicom'''
-    with open("Pats/patient_dict.yaml","r",encoding="utf-8") as yfile:
+def converter(patient_dict_path:str="Pats/patient_dict.yaml", output_format:str="separate",
+              series_index_path:str=None, t2_export:str="classic", export_workers:int=None,
+              seg_files:dict=None):
+    '''
+    nifti to dicom, returns the dicom_outputs study directories that were written.
+    output_format is the one of the segmentor outputs, separate binaries or multilabel.
+    series_index_path is the SQLite file of the reference series headers, not kept if None.
+    t2_export is the nifti2dicom mode of the T2 series converted from nifti, classic or enhanced.
+    seg_files, when given, is filled with {patient: SEG files written}, patients without SEG left out.
+    '''
+    seg_files = seg_files if seg_files is not None else {}
+    series_index = SeriesIndex(series_index_path) if series_index_path else None
+    with open(patient_dict_path,"r",encoding="utf-8") as yfile:
         PATIENT_DICT = yaml.safe_load( yfile )
+    study_dirs = []
     for key,value in PATIENT_DICT.items():
 
         if value["source_type"] == "nii.gz":
 
             nii_path = value["destination_nifti"]
-            t2_path = nifti2dicom(nii_path)
+            with instrumentation.stage("t2_export", patient=key):
+                # the SEG writer takes the headers of the written series from memory
+                t2_series = nifti2dicom(nii_path, mode=t2_export, workers=export_workers)
+            study_dirs.append(os.path.dirname(t2_series.path))
 
             out_location = os.path.join( *nii_path.split(os.sep)[1::])
             out_location = os.path.join( out_location.split('.nii.gz')[0] )
@@ -30,10 +46,12 @@ def converter():
                 CATEGORY
             )
 
-            nifti2dicomseg(seg_path, t2_path)
-            nifti2dicomseg(seg_path, t2_path,'wg')
-            nifti2dicomseg(seg_path, t2_path,'pz')
-            nifti2dicomseg(seg_path, t2_path,'tz')
+            with instrumentation.stage("seg_export", patient=key):
+                # masks and reference series are read once for the four SEG objects
+                written = nifti2dicomseg_all(seg_path, t2_series, ("", "wg", "pz", "tz"),
+                                             output_format=output_format, series_index=series_index)
+            if written:
+                seg_files[key] = written
 
         if value["source_type"] == "dcm":
 
@@ -55,9 +73,10 @@ def converter():
                 "t2w"
             )
 
-            os.makedirs(copy_t2, exist_ok=True)
-
-            shutil.copytree(key, copy_t2, dirs_exist_ok=True)
+            with instrumentation.stage("t2_export", patient=key):
+                os.makedirs(copy_t2, exist_ok=True)
+                shutil.copytree(key, copy_t2, dirs_exist_ok=True)
+            study_dirs.append(os.path.dirname(copy_t2))
 
             out_location = os.path.join( *dcm_path.split(os.sep)[1::])
             out_location = os.path.join( out_location.split('.')[0] ).replace(os.sep, "_")
@@ -68,7 +87,11 @@ def converter():
                 CATEGORY
             )
 
-            nifti2dicomseg(seg_path, copy_t2)
-            nifti2dicomseg(seg_path, copy_t2,'wg')
-            nifti2dicomseg(seg_path, copy_t2,'pz')
-            nifti2dicomseg(seg_path, copy_t2,'tz')
+            with instrumentation.stage("seg_export", patient=key):
+                # masks and reference series are read once for the four SEG objects
+                written = nifti2dicomseg_all(seg_path, copy_t2, ("", "wg", "pz", "tz"),
+                                             output_format=output_format, series_index=series_index)
+            if written:
+                seg_files[key] = written
+
+    return study_dirs
@@ -15,28 +15,17 @@ from pydicom.uid import (
     SegmentationStorage
 )
 from pydicom.sequence import Sequence
+from Utils.series_index import ReferenceSeries, SeriesIndex, read_series_headers
 
-def _sitk_files_order(series_dir: Path) -> tuple:
-    ''' 
-    Warning: Spatial ordering (z-axis), 
-    Use other GDCM ordering if this does not fit your requirements.
-    Also can be set for specific SeriesUID, recursive, etc. 
-    '''
-    reader=sitk.ImageSeriesReader()
-    return reader.GetGDCMSeriesFileNames(series_dir)
-
-def order_dcmfiles(series_dir:Path)-> List[Dataset]:
+def order_dcmfiles(series_dir:Path, series_index:SeriesIndex=None)-> List[Dataset]:
     '''
-    Reads dicom files in Spatial order Image Position Patient(z-axis).
-    **Future work: os.walk, DWI multi-frame, multiple series support. 
+    Reads the dicom headers (no pixel data) in Spatial order Image Position Patient(z-axis),
+    through the series index when one is given.
+    **Future work: DWI multi-frame, multiple series support. 
     '''
-    ds = [
-        dcmread(x)
-        for x in _sitk_files_order(series_dir)
-        if x.endswith(".dcm")
-    ]
-
-    return ds
+    if series_index is not None:
+        return series_index.get(series_dir)
+    return read_series_headers(series_dir)
 
 def nifti_reader(nifti_path:Path) -> sitk.Image:
     ''' 
@@ -60,8 +49,28 @@ def _safe_read_seg(seg_path:Path)->np.ndarray:
 
     return seg_arr
 
-def auto_seg_reader(seg_directory:Path)->Dict[str,np.ndarray]:
-    ''' Read segmentations to nifti'''
+def _labels_reader(labels_path:Path)->Dict[str,dict]:
+    ''' Splits the label map of the multilabel output format (1 WG, 2 TZ, 3 PZ) '''
+    if not os.path.exists(labels_path):
+        return {}
+    labels = sitk.GetArrayFromImage(sitk.ReadImage(labels_path, outputPixelType=sitk.sitkUInt8))
+    # the whole gland is the union, as wg_binary.nii.gz of the separate format
+    segments_dict = {
+        "wg": {"array": (labels > 0).astype(np.uint8)},
+        "pz": {"array": (labels == 3).astype(np.uint8)},
+        "tz": {"array": (labels == 2).astype(np.uint8)}
+    }
+    return {
+        key:value
+        for key, value in segments_dict.items()
+        if np.max(value["array"]) > 0
+    }
+
+def auto_seg_reader(seg_directory:Path, output_format:str="separate")->Dict[str,np.ndarray]:
+    ''' Read segmentations to nifti, the three binary masks or the label map of the multilabel format'''
+
+    if output_format == "multilabel":
+        return _labels_reader(os.path.join(seg_directory, "labels.nii.gz"))
 
     wg_path = os.path.join( seg_directory, "wg_binary.nii.gz")
     pz_path = os.path.join( seg_directory, "pz_binary.nii.gz")
@@ -152,8 +161,14 @@ def reference_image_sop(reference_ds:List[Dataset])-> Sequence:
     frame_ds = reference_ds[0]
 
 
+    referenced = set()
     for dataset in reference_ds:
 
+        # the frames of a multi-frame reference share their instance
+        if dataset.SOPInstanceUID in referenced:
+            continue
+        referenced.add(dataset.SOPInstanceUID)
+
         temp_ds = Dataset()
         temp_ds.ReferencedSOPClassUID = dataset.SOPClassUID
         temp_ds.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
@@ -268,7 +283,12 @@ def structures_dictionary(segmentation_type:str,seg_counter:int)->Sequence:
 def per_frame_group(
         reference_ds_list:List[Dataset],
         seg_dict:Dict[str,dict]) -> Sequence:
-    '''Adds meta-data for each slice'''
+    '''
+    Adds meta-data for each slice.
+    Only the frame content differs for every frame: the derivation and plane
+    position sub-sequences depend on the source slice and the segment
+    identification on the segment, they are built once and shared by the frames.
+    '''
 
     # Per-frame Functional Groups Sequence
 
@@ -284,59 +304,56 @@ def per_frame_group(
     derivation_code.CodingSchemeDesignator = 'DCM'
     derivation_code.CodeMeaning = 'Segmentation'
 
-    def frame_dataset(
-            frame_dict:dict,
-            slice_index:int,
-            dataset:Dataset,
-            purpose_ds:Dataset,
-            derivation_code:Dataset,
-            )->Sequence:
+    slice_templates = {}
 
-        per_frame = Dataset()
+    def slice_template(slice_index:int)->tuple:
+        ''' (DerivationImageSequence, PlanePositionSequence) of a source slice '''
+        if slice_index not in slice_templates:
+            dataset = reference_ds_list[slice_index]
 
-        derivation_image = Dataset()
-        source_image = Dataset()
+            source_image = Dataset()
+            source_image.ReferencedSOPClassUID = dataset.SOPClassUID
+            source_image.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
+            if "ReferencedFrameNumber" in dataset: # multi-frame reference
+                source_image.ReferencedFrameNumber = dataset.ReferencedFrameNumber
+            source_image.PurposeOfReferenceCodeSequence = Sequence([purpose_ds])
 
-        source_image.ReferencedSOPClassUID = dataset.SOPClassUID
-        source_image.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
-        source_image.PurposeOfReferenceCodeSequence = Sequence([purpose_ds])
+            derivation_image = Dataset()
+            derivation_image.SourceImageSequence = Sequence([source_image])
+            derivation_image.DerivationCodeSequence = Sequence([derivation_code])
 
-        derivation_image.SourceImageSequence = Sequence([source_image])
-        derivation_image.DerivationCodeSequence = Sequence([derivation_code])
+            img_position = Dataset()
+            img_position.ImagePositionPatient = dataset.ImagePositionPatient
 
-        # Only zero frames can be discarded, here we kept them for now
-
-        dim_index = Dataset()
-        dim_index.DimensionIndexValues = [frame_dict["label"], slice_index]
-        per_frame.FrameContentSequence = Sequence([dim_index])
-
-        img_position = Dataset()
-        img_position.ImagePositionPatient = dataset.ImagePositionPatient
-        per_frame.PlanePositionSequence = Sequence([img_position])
-
-        ref_segment_num = Dataset()
-        ref_segment_num.ReferencedSegmentNumber  = frame_dict["label"]
-        per_frame.SegmentIdentificationSequence = Sequence([ref_segment_num])
-
-        per_frame.DerivationImageSequence = Sequence([derivation_image])
-
-        return per_frame
+            slice_templates[slice_index] = (Sequence([derivation_image]), Sequence([img_position]))
+        return slice_templates[slice_index]
 
     per_frame_sequence = Sequence()
 
     for value in seg_dict.values():
 
-        if "seg_index" in value:
-            for idx in value["seg_index"]:
+        ref_segment_num = Dataset()
+        ref_segment_num.ReferencedSegmentNumber  = value["label"]
+        segment_identification = Sequence([ref_segment_num])
 
-                dataset = reference_ds_list[idx]
-                per_frame = frame_dataset(value,idx,dataset,purpose_ds,derivation_code)
-                per_frame_sequence.append(per_frame)
+        # Only zero frames can be discarded, here we kept them for now
+        if "seg_index" in value:
+            slice_indices = value["seg_index"]
         else:
+            slice_indices = range(len(reference_ds_list))
+
+        for idx in slice_indices:
+            derivation_image, img_position = slice_template(idx)
 
-            for idx, dataset in enumerate(reference_ds_list):
-                per_frame = frame_dataset(value,idx,dataset,purpose_ds,derivation_code)
-                per_frame_sequence.append(per_frame)
+            dim_index = Dataset()
+            dim_index.DimensionIndexValues = [value["label"], idx]
+
+            per_frame = Dataset()
+            per_frame.FrameContentSequence = Sequence([dim_index])
+            per_frame.PlanePositionSequence = img_position
+            per_frame.SegmentIdentificationSequence = segment_identification
+            per_frame.DerivationImageSequence = derivation_image
+            per_frame_sequence.append(per_frame)
 
     return per_frame_sequence
 
@@ -367,17 +384,76 @@ def array2bits(seg_dict:Dict[str,dict])->Union[np.ndarray,str]:
 
     return bit_frames, nframes
 
-def nifti2dicomseg(seg_dir_path:Path, t2_path:Path, single_seg:str=""):
+class SegExportContext:
+    '''
+    Masks and reference series of one patient, read once and shared by all the
+    SEG objects written from them. The reference series is only read if there
+    is a segmentation to export, and not at all when t2_path is the ReferenceSeries
+    returned by nifti2dicom.
+    '''
+
+    def __init__(self, seg_dir_path:Path, t2_path:Union[Path,ReferenceSeries], output_format:str="separate",
+                 series_index:SeriesIndex=None):
+        self.series_index = series_index
+        self.seg_dict = auto_seg_reader(seg_dir_path, output_format)
+        self._t2_dataset = None
+        if isinstance(t2_path, ReferenceSeries): # written by nifti2dicom, the headers are known
+            t2_path, self._t2_dataset = t2_path
+        self.t2_path = t2_path
+        self._referenced_series = None
+        self._shared_groups = None
+
+    @property
+    def t2_dataset(self)->List[Dataset]:
+        if self._t2_dataset is None:
+            self._t2_dataset = order_dcmfiles(self.t2_path, self.series_index)
+        return self._t2_dataset
+
+    @property
+    def referenced_series(self)->Sequence:
+        if self._referenced_series is None:
+            self._referenced_series = reference_image_sop(self.t2_dataset)
+        return self._referenced_series
+
+    @property
+    def shared_groups(self)->Sequence:
+        if self._shared_groups is None:
+            self._shared_groups = shared_metadata(self.t2_dataset[0])
+        return self._shared_groups
+
+    def segments(self)->Dict[str,dict]:
+        ''' Fresh per SEG dictionaries, the arrays are shared and never modified in place '''
+        return {key: {"array": value["array"]} for key, value in self.seg_dict.items()}
+
+def nifti2dicomseg(seg_dir_path:Path, t2_path:Path, single_seg:str="", output_format:str="separate"):
     ''' 
     Convert nifti segmentations to dcm files.
     Each segmentation file will have their own dcm file. Also, a multi-frame
     dcm file will be available with no overlaps!
     '''
+    write_seg(SegExportContext(seg_dir_path, t2_path, output_format), single_seg)
+
+def nifti2dicomseg_all(seg_dir_path:Path, t2_path:Path, segmentations=("", "wg", "pz", "tz"),
+                       output_format:str="separate", series_index:SeriesIndex=None):
+    '''
+    Writes several SEG objects of one patient ("" for the combined one, or a zone)
+    reading the masks and the reference series once. Returns the files written.
+    '''
+    context = SegExportContext(seg_dir_path, t2_path, output_format, series_index)
+    written = [write_seg(context, single_seg) for single_seg in segmentations]
+    return [path for path in written if path is not None]
+
+def write_seg(context:SegExportContext, single_seg:str=""):
+    '''
+    Writes the combined SEG object, or the one of a single zone, from a patient context.
+    Returns the path of the file, None if there was nothing to write.
+    '''
 
     seg_ds = Dataset()
     seg_ds.is_little_endian = True
     seg_ds.is_implicit_VR = False
-    seg_dict = auto_seg_reader(seg_dir_path)
+    seg_dict = context.segments()
+    t2_path = context.t2_path
 
     if not seg_dict:
         print(f"{t2_path} has no segmentations!")
@@ -388,7 +464,7 @@ def nifti2dicomseg(seg_dir_path:Path, t2_path:Path, single_seg:str=""):
             print(f"{t2_path} has no segmentation {single_seg}")
             return
 
-    t2_dataset = order_dcmfiles(t2_path)
+    t2_dataset = context.t2_dataset
     t2_ds = t2_dataset[0]
 
     modification_time = time.strftime("%H%M%S")
@@ -517,9 +593,9 @@ def nifti2dicomseg(seg_dir_path:Path, t2_path:Path, single_seg:str=""):
         seg_ds.InstanceNumber = '203'
         seg_ds.SeriesDescription = "Prostate Transition Zone"
 
-    seg_ds.ReferencedSeriesSequence = reference_image_sop(t2_dataset)
+    seg_ds.ReferencedSeriesSequence = context.referenced_series
     seg_ds = dim_organization_sequence(seg_ds)
-    seg_ds.SharedFunctionalGroupsSequence = shared_metadata(t2_ds)
+    seg_ds.SharedFunctionalGroupsSequence = context.shared_groups
 
     segment_sequence = Sequence()
 
@@ -567,9 +643,11 @@ def nifti2dicomseg(seg_dir_path:Path, t2_path:Path, single_seg:str=""):
     os.makedirs(output, exist_ok=True)
 
     if not single_seg:
-        dcmwrite(os.path.join(output,'prostate_zones.dcm'), seg_ds, write_like_original=False)
+        path = os.path.join(output,'prostate_zones.dcm')
     else:
-        dcmwrite(os.path.join(output,f'{single_seg}.dcm'), seg_ds, write_like_original=False)
+        path = os.path.join(output,f'{single_seg}.dcm')
+    dcmwrite(path, seg_ds, write_like_original=False)
+    return path
 
 def keep_same_direction(dcm_image:Dataset, sitk_image:sitk.Image)->sitk.Image:
     ''' 
@@ -5,53 +5,163 @@ os.environ['nnUNet_results'] = os.path.join("nnUnet_paths", "nnUNet_results")
 from nnunetv2.paths import nnUNet_results, nnUNet_raw
 from batchgenerators.utilities.file_and_folder_operations import join
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_steps_for_sliding_window
 import SimpleITK as sitk
+import numpy as np
 from abc import ABC, abstractmethod
+from typing import NamedTuple
+import threading
 import torch
+from Utils.result_cache import file_fingerprint
+
+
+class QualityTier(NamedTuple):
+    use_mirroring: bool
+    mirror_axes: tuple # spatial axes (z, y, x) of the test time mirroring, None for all the model allows
+    tile_step_size: float
+    use_gaussian: bool
+
+# Forward passes per window: full 8 (every axis mirrored), balanced 2, fast 1.
+# The wg patch covers the whole 24x256x256 grid, only the zones model (24x96x128
+# patches) has overlapping windows: 15 at a step of 0.5, 6 at 1.0.
+QUALITY_TIERS = {
+    "full": QualityTier(use_mirroring=True, mirror_axes=None, tile_step_size=0.5, use_gaussian=True),
+    # left-right only, the gland is roughly symmetric about the mid-sagittal plane
+    "balanced": QualityTier(use_mirroring=True, mirror_axes=(2,), tile_step_size=0.5, use_gaussian=True),
+    "fast": QualityTier(use_mirroring=False, mirror_axes=None, tile_step_size=1.0, use_gaussian=True),
+}
+
+def image_to_nnunet(image:sitk.Image):
+    """Converts a sitk image to the array and properties nnU-Net's SimpleITKIO would produce
+
+    Returns:
+        tuple: (np.ndarray (1, z, y, x) float32, properties dict)
+    """
+    data = sitk.GetArrayFromImage(image)[None].astype(np.float32)
+    properties = {
+        'sitk_stuff': {
+            'spacing': image.GetSpacing(),
+            'origin': image.GetOrigin(),
+            'direction': image.GetDirection()
+        },
+        'spacing': list(image.GetSpacing())[::-1]
+    }
+    return data, properties
 
 
 class BaseNNUnetModule(ABC):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    def __init__(self, input_path, output_path):
+    def __init__(self, input_path:str, output_path:str, tier:str="full"):
+        """Builds the predictor and loads the checkpoint, once per instance.
+
+        Keep the instance around to pay for weight loading only once per process.
+        tier selects the test time augmentation and sliding window overlap, see QUALITY_TIERS.
+        """
         self.input_path = input_path
         self.output_path = output_path
+        self.tier = tier
+        self.settings = QUALITY_TIERS[tier]
+        self._lock = threading.Lock()
+
+        # Create nnUNetPredictor with the determined device
+        self.predictor = nnUNetPredictor(
+            tile_step_size=self.settings.tile_step_size,
+            use_gaussian=self.settings.use_gaussian,
+            use_mirroring=self.settings.use_mirroring,
+            perform_everything_on_gpu=self.device.type == 'cuda',  # Set to True if using GPU, False if using CPU
+            device=self.device,
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=False
+        )
+        self.model_folder = join(nnUNet_results, os.path.join(self.input_path,'nnUNetTrainer__nnUNetPlans__3d_fullres'))
+        self.checkpoint_path = join(self.model_folder, 'fold_0', 'checkpoint_final.pth')
+        self.predictor.initialize_from_trained_model_folder(
+            self.model_folder,
+            use_folds=(0,),
+            checkpoint_name='checkpoint_final.pth',
+        )
+        if self.settings.use_mirroring and self.settings.mirror_axes is not None:
+            allowed = self.predictor.allowed_mirroring_axes or ()
+            self.predictor.allowed_mirroring_axes = tuple(axis for axis in self.settings.mirror_axes if axis in allowed)
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the checkpoint and the inference settings, used to key cached predictions"""
+        return f"{file_fingerprint(self.checkpoint_path)}:{tuple(self.settings)}"
     
+    def sliding_window_tiles(self, shape) -> int:
+        """Number of patches the sliding window predicts for an input of shape (z, y, x) on the nnU-Net grid.
+
+        The input is padded to the patch size first, smaller inputs cost one patch.
+        """
+        patch_size = self.predictor.configuration_manager.patch_size
+        padded = [max(size, patch) for size, patch in zip(shape, patch_size)]
+        steps = compute_steps_for_sliding_window(padded, patch_size, self.settings.tile_step_size)
+        return int(np.prod([len(axis) for axis in steps]))
+
     @abstractmethod
-    def prediction(self):
+    def prediction(self, num_processes_preprocessing:int=2, num_processes_segmentation_export:int=2, keys:list=None):
         pass
+
+    def cases(self, images_ts:str, output_folder:str, keys:list=None):
+        """Inputs and outputs for predict_from_files.
+
+        Without keys the whole ImagesTs folder is predicted. With keys only the
+        files of those patients are, so that shards sharing the nnU-Net folders
+        never pick up each other's patients.
+
+        Returns:
+            tuple: (folder or list of input file lists, folder or list of output names)
+        """
+        if keys is None:
+            return images_ts, output_folder
+        keys = [key for key in keys if os.path.exists(join(images_ts, self.input_name(key)))]
+        return ([[join(images_ts, self.input_name(key))] for key in keys],
+                [join(output_folder, f"{self.case_prefix}{key}") for key in keys])
+
+    def input_name(self, key:str) -> str:
+        """File name of the model input of a patient in ImagesTs"""
+        return f"{self.case_prefix}{key}_0000.nii.gz"
+
+    def input_file(self, key:str) -> str:
+        return join(nnUNet_raw, self.input_path, 'ImagesTs', self.input_name(key))
+
+    def predict_image(self, image:sitk.Image):
+        """Runs the model on a volume in memory, nothing is written to ImagesTs or the Outcomes folders
+
+        Args:
+            image (sitk.Image): volume prepared for the model
+
+        Returns:
+            tuple: (segmentation as sitk.Image on the grid of image, probabilities as np.ndarray (c, z, y, x))
+        """
+        data, properties = image_to_nnunet(image)
+        with self._lock:
+            segmentation, probabilities = self.predictor.predict_single_npy_array(
+                data, properties, segmentation_previous_stage=None,
+                output_file_truncated=None, save_or_return_probabilities=True)
+        segmentation = sitk.GetImageFromArray(segmentation.astype(np.uint8))
+        segmentation.CopyInformation(image)
+        return segmentation, probabilities
     
     @abstractmethod
     def return_paths(self):
         pass
 
 class WGNNUnet(BaseNNUnetModule):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    case_prefix = "ProstateWG_"
 
-    # Create nnUNetPredictor with the determined device
-    predictor = nnUNetPredictor(
-        tile_step_size=0.5,
-        use_gaussian=True,
-        use_mirroring=True,
-        perform_everything_on_gpu=device.type == 'cuda',  # Set to True if using GPU, False if using CPU
-        device=device,
-        verbose=False,
-        verbose_preprocessing=False,
-        allow_tqdm=False
-    )
-    def __init__(self, input_path:str, output_path:str):
-        self.input_path = input_path
-        self.output_path = output_path
-        self.predictor.initialize_from_trained_model_folder(
-        join(nnUNet_results, os.path.join(self.input_path,'nnUNetTrainer__nnUNetPlans__3d_fullres')),
-        use_folds=(0,),
-        checkpoint_name='checkpoint_final.pth',
-    )
-    
-    def prediction(self):
-        self.predictor.predict_from_files(join(nnUNet_raw, os.path.join(self.input_path,'ImagesTs')),
-                            join(nnUNet_raw,self.output_path),
+    def prediction(self, num_processes_preprocessing:int=2, num_processes_segmentation_export:int=2, keys:list=None):
+        inputs, outputs = self.cases(join(nnUNet_raw, os.path.join(self.input_path,'ImagesTs')),
+                                     join(nnUNet_raw,self.output_path), keys)
+        if not inputs:
+            return
+        self.predictor.predict_from_files(inputs, outputs,
                             save_probabilities=True, overwrite=True,
-                            num_processes_preprocessing=2, num_processes_segmentation_export=2,
+                            num_processes_preprocessing=num_processes_preprocessing,
+                            num_processes_segmentation_export=num_processes_segmentation_export,
                             folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
     
     def return_paths(self, pats_for_wg:dict):
@@ -64,33 +174,17 @@ class WGNNUnet(BaseNNUnetModule):
         return pats_for_wg_inference
 
 class ZonesNNUnet(BaseNNUnetModule):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    case_prefix = "ProstateZonesFilteredLessDilated_ProstateZones_"
 
-    # Create nnUNetPredictor with the determined device
-    predictor = nnUNetPredictor(
-        tile_step_size=0.5,
-        use_gaussian=True,
-        use_mirroring=True,
-        perform_everything_on_gpu=device.type == 'cuda',  # Set to True if using GPU, False if using CPU
-        device=device,
-        verbose=False,
-        verbose_preprocessing=False,
-        allow_tqdm=False
-    )
-    def __init__(self, input_path, output_path):
-        self.input_path = input_path
-        self.output_path = output_path
-        self.predictor.initialize_from_trained_model_folder(
-        join(nnUNet_results, os.path.join(self.input_path,'nnUNetTrainer__nnUNetPlans__3d_fullres')),
-        use_folds=(0,),
-        checkpoint_name='checkpoint_final.pth',
-    )
-    
-    def prediction(self):
-        self.predictor.predict_from_files(join(nnUNet_raw, os.path.join(self.input_path,'ImagesTs')),
-                            join(nnUNet_raw,"OutcomesZones"),
+    def prediction(self, num_processes_preprocessing:int=2, num_processes_segmentation_export:int=2, keys:list=None):
+        inputs, outputs = self.cases(join(nnUNet_raw, os.path.join(self.input_path,'ImagesTs')),
+                                     join(nnUNet_raw,"OutcomesZones"), keys)
+        if not inputs:
+            return
+        self.predictor.predict_from_files(inputs, outputs,
                             save_probabilities=True, overwrite=True,
-                            num_processes_preprocessing=2, num_processes_segmentation_export=2,
+                            num_processes_preprocessing=num_processes_preprocessing,
+                            num_processes_segmentation_export=num_processes_segmentation_export,
                             folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
     
     def return_paths(self, pats_for_wg_inference:dict):
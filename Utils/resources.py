@@ -0,0 +1,142 @@
+'''
+CPU resource governor.
+
+Splits the cores available to the process between torch intra-op threads, the
+SimpleITK global thread pool and the nnU-Net preprocessing / export worker
+processes, according to the stage that is running. Every value can be pinned
+from the command line or with an environment variable:
+
+    SEGMENTOR_CPUS            cores to split (defaults to the affinity mask / cgroup quota)
+    SEGMENTOR_TORCH_THREADS   torch intra-op threads
+    SEGMENTOR_SITK_THREADS    SimpleITK global default number of threads
+    SEGMENTOR_NNUNET_WORKERS  nnU-Net preprocessing and segmentation export processes (each)
+'''
+import os
+import logging
+from typing import NamedTuple
+import torch
+import SimpleITK as sitk
+
+
+class ResourcePlan(NamedTuple):
+    torch_threads: int
+    sitk_threads: int
+    preprocessing_workers: int
+    export_workers: int
+    worker_threads: int
+
+def _cgroup_cpus():
+    ''' CPU quota of the container, None when unlimited or unknown '''
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r", encoding="utf-8") as file: # cgroup v2
+            quota, period = file.read().split()[:2]
+        if quota == "max":
+            return None
+        return float(quota) / float(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r", encoding="utf-8") as file: # cgroup v1
+            quota = float(file.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r", encoding="utf-8") as file:
+            period = float(file.read())
+        return quota / period if quota > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpus() -> int:
+    ''' Cores this process may actually use: affinity mask, capped by the container quota '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpus()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+def _env_int(name:str):
+    value = os.environ.get(name)
+    if not value:
+        return None
+    try:
+        return max(1, int(value))
+    except ValueError:
+        logging.warning(f"Ignoring {name}={value}, not an integer")
+        return None
+
+class ResourceGovernor:
+    '''
+    Decides how many threads and processes each stage gets.
+
+    Stages:
+        inference        one in-memory forward pass at a time, torch gets every core
+        batch_inference  predict_from_files: torch in this process, nnU-Net
+                         preprocessing and export workers in separate processes
+        streaming        every stage runs concurrently (two models and the
+                         SimpleITK post-processing), the cores are shared
+        preprocessing    SimpleITK only (N4, resampling, cropping)
+        postprocessing   SimpleITK only (morphology, components, resampling)
+
+    :param cpus: cores to split, SEGMENTOR_CPUS or the available cores if None
+    :param torch_threads: pins the torch threads of every stage
+    :param sitk_threads: pins the SimpleITK threads of every stage
+    :param nnunet_workers: pins the nnU-Net preprocessing and export processes
+    '''
+
+    STAGES = ("inference", "batch_inference", "streaming", "preprocessing", "postprocessing")
+
+    def __init__(self, cpus:int=None, torch_threads:int=None, sitk_threads:int=None, nnunet_workers:int=None):
+        self.cpus = cpus or _env_int("SEGMENTOR_CPUS") or available_cpus()
+        self.torch_threads = torch_threads or _env_int("SEGMENTOR_TORCH_THREADS")
+        self.sitk_threads = sitk_threads or _env_int("SEGMENTOR_SITK_THREADS")
+        self.nnunet_workers = nnunet_workers or _env_int("SEGMENTOR_NNUNET_WORKERS")
+        self.current = None
+
+    def plan(self, stage:str) -> ResourcePlan:
+        ''' Threads and processes for a stage, overrides applied '''
+        if stage not in self.STAGES:
+            raise ValueError(f"Unknown stage {stage}, expected one of {self.STAGES}")
+        cpus = self.cpus
+        # one worker per 8 cores for each nnU-Net pool, the forward passes need the rest
+        workers = self.nnunet_workers or min(8, max(1, cpus // 8))
+
+        if stage == "inference":
+            torch_threads, sitk_threads = cpus, 1
+        elif stage == "batch_inference":
+            torch_threads, sitk_threads = max(1, cpus - 2 * workers), 1
+        elif stage == "streaming":
+            # both models may run at once and each forward pass opens its own
+            # OpenMP team, a quarter of the cores is left to the SimpleITK stages
+            sitk_threads = max(1, cpus // 4)
+            torch_threads = max(1, (cpus - sitk_threads) // 2)
+        else:
+            torch_threads, sitk_threads = 1, cpus
+
+        return ResourcePlan(
+            torch_threads=self.torch_threads or torch_threads,
+            sitk_threads=self.sitk_threads or sitk_threads,
+            preprocessing_workers=workers,
+            export_workers=workers,
+            worker_threads=max(1, (cpus - (self.torch_threads or torch_threads)) // (2 * workers)),
+        )
+
+    def apply(self, stage:str) -> ResourcePlan:
+        '''
+        Configures torch and SimpleITK for a stage, the worker counts are returned for nnU-Net.
+        The nnU-Net workers are spawned, they only see the environment: OMP and ITK
+        read their thread counts from it at start-up.
+        '''
+        plan = self.plan(stage)
+        if plan != self.current:
+            torch.set_num_threads(plan.torch_threads)
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(plan.sitk_threads)
+            os.environ["OMP_NUM_THREADS"] = str(plan.worker_threads)
+            os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(plan.worker_threads)
+            logging.info(f"{stage}: {plan}")
+            self.current = plan
+        return plan
+
+    def __repr__(self):
+        return (f"ResourceGovernor(cpus={self.cpus}, torch_threads={self.torch_threads}, "
+                f"sitk_threads={self.sitk_threads}, nnunet_workers={self.nnunet_workers})")
@@ -0,0 +1,143 @@
+'''
+Content addressed cache for the nnU-Net stage outputs.
+
+The whole gland entry is keyed on the input voxels and geometry plus the whole
+gland checkpoint, the zones entry on the whole gland key plus the zones
+checkpoint. Changing only the zones checkpoint therefore re-runs only the
+zones model.
+
+Entries are touched when used. prune drops the ones unused for max_age_days,
+then the least recently used ones until the entries fit in max_gb.
+'''
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+
+_FINGERPRINTS = {}
+
+def image_digest(image:sitk.Image) -> str:
+    ''' sha256 of the voxel data, pixel type and geometry of a sitk image '''
+    digest = hashlib.sha256()
+    digest.update(image.GetPixelIDTypeAsString().encode("utf-8"))
+    digest.update(repr((image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())).encode("utf-8"))
+    digest.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).tobytes())
+    return digest.hexdigest()
+
+def file_fingerprint(path:str) -> str:
+    ''' sha256 of a file, memoized on path, size and modification time '''
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _FINGERPRINTS:
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        _FINGERPRINTS[memo_key] = digest.hexdigest()
+    return _FINGERPRINTS[memo_key]
+
+class StageCache:
+    '''
+    Stores segmentation and probabilities of a model stage on disk
+
+    :param cache_dir: cache folder, other files kept there are left alone by prune
+    :param max_gb: size of the entries kept by prune, None for no limit
+    :param max_age_days: entries unused for longer are dropped by prune, None for no limit
+    '''
+
+    def __init__(self, cache_dir:str, max_gb:float=10.0, max_age_days:float=30.0):
+        self.cache_dir = cache_dir
+        self.max_gb = max_gb
+        self.max_age_days = max_age_days
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(parent_key:str, model_fingerprint:str) -> str:
+        ''' Chains the key of the stage input with the fingerprint of the model '''
+        return hashlib.sha256(f"{parent_key}:{model_fingerprint}".encode("utf-8")).hexdigest()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def __contains__(self, key:str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, key:str, reference:sitk.Image):
+        '''
+        Returns (segmentation, probabilities) or None on a miss.
+        The segmentation takes the geometry of the reference image, the stage input.
+        '''
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                segmentation = sitk.GetImageFromArray(entry["segmentation"])
+                probabilities = entry["probabilities"]
+        except (OSError, KeyError, ValueError):
+            return None
+        segmentation.CopyInformation(reference)
+        try:
+            os.utime(path) # last use, for prune
+        except OSError:
+            pass
+        return segmentation, probabilities
+
+    def store(self, key:str, segmentation:sitk.Image, probabilities:np.ndarray):
+        ''' Writes an entry atomically so that concurrent readers never see partial files '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez_compressed(
+                    file,
+                    segmentation=sitk.GetArrayFromImage(segmentation),
+                    probabilities=probabilities
+                )
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def entries(self) -> list:
+        ''' (last use, size, path) of the entries, least recently used first '''
+        found = []
+        for folder in os.listdir(self.cache_dir):
+            folder_path = os.path.join(self.cache_dir, folder)
+            if len(folder) != 2 or not os.path.isdir(folder_path):
+                continue
+            for name in os.listdir(folder_path):
+                if not name.endswith(".npz"):
+                    continue
+                path = os.path.join(folder_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError: # pruned by another process
+                    continue
+                found.append((stat.st_mtime, stat.st_size, path))
+        return sorted(found)
+
+    def prune(self) -> int:
+        ''' Drops the entries over the age and size limits, returns the number removed '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        oldest = time.time() - self.max_age_days * 86400 if self.max_age_days is not None else None
+        max_bytes = self.max_gb * 1024 ** 3 if self.max_gb is not None else None
+        removed = 0
+        for last_use, size, path in entries:
+            if (oldest is None or last_use >= oldest) and (max_bytes is None or total <= max_bytes):
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Pruned {removed} entries from {self.cache_dir}, {total / 1024 ** 3:.2f} GB left")
+        return removed
@@ -2,28 +2,127 @@ import os
 from Utils import InputCheck
 from Utils import ImageProcessor
 import torch
-from Utils import helpers, nnUnet_call
+from Utils import helpers, nnUnet_call, instrumentation
+from Utils.resources import ResourceGovernor
+from Utils.sharding import Shard
+from Utils.result_cache import StageCache, image_digest
 import SimpleITK as sitk
 from MedProIO import Coregistrator
 import numpy as np
 import json
 import warnings
 import multiprocessing
+import queue
+import threading
 warnings.filterwarnings('ignore')
 import logging
 nnUNet_raw = os.path.join("nnUnet_paths", "nnUNet_raw")
 
-def segmentor_pipeline_operation(output_volume:str, pats:dict):
-    segmentor = Segmentor()
-    segmentor.wg_model(pats)
-    segmentor.preparation_zones(input_patients=pats)
-    segmentor.zones_model()
-    segmentor.post_process_zones(output_patient_folder=output_volume, pats=pats)
-    segmentor.saving()
-    segmentor.clean_workspace()
+_STOP = object()
+
+def stream_stages(items, stages:list, queue_size:int=2):
+    """Pushes (key, payload) items through the stages, one thread per stage.
+
+    Stages are connected with bounded queues so that different patients can be
+    in different stages at the same time. A patient failing in a stage is logged
+    and dropped, the rest of the cohort keeps flowing.
+
+    Args:
+        items (iterable): (key, payload) pairs fed to the first stage
+        stages (list): callables with signature stage(key, payload) -> payload
+        queue_size (int): maximum number of patients waiting in front of each stage
+
+    Yields:
+        tuple: (key, payload) of the last stage, as soon as each patient finishes
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def feed():
+        try:
+            for item in items:
+                queues[0].put(item)
+        except Exception as e:
+            logging.error(f"Error reading the inputs: {e}")
+        finally:
+            queues[0].put(_STOP) # the stages and the consumer always get to finish
+
+    def work(stage, q_in, q_out):
+        while True:
+            item = q_in.get()
+            if item is _STOP:
+                q_out.put(_STOP)
+                return
+            key, payload = item
+            try:
+                with instrumentation.stage(stage.__name__, patient=key):
+                    result = stage(key, payload)
+                q_out.put((key, result))
+            except Exception as e:
+                logging.error(f"Error processing {key}: {e}")
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage, q_in, q_out in zip(stages, queues[:-1], queues[1:]):
+        threads.append(threading.Thread(target=work, args=(stage, q_in, q_out), daemon=True))
+    for thread in threads:
+        thread.start()
+
+    while True:
+        item = queues[-1].get()
+        if item is _STOP:
+            break
+        yield item
+
+    for thread in threads:
+        thread.join()
+
+def segmentor_pipeline_operation(output_volume:str, pats:dict, streaming:bool=False, queue_size:int=2,
+                                 segmentor=None, cache_dir:str=None, probs_writer=None, governor=None, shard=None,
+                                 tier:str="full", zones_roi:bool=False, output_format:str="separate",
+                                 cache_max_gb:float=10.0, cache_max_age_days:float=30.0):
+    segmentor = segmentor if segmentor is not None else Segmentor(cache_dir=cache_dir, probs_writer=probs_writer,
+                                                                  governor=governor, shard=shard, tier=tier,
+                                                                  zones_roi=zones_roi, output_format=output_format,
+                                                                  cache_max_gb=cache_max_gb,
+                                                                  cache_max_age_days=cache_max_age_days)
+    if streaming:
+        for key, _ in segmentor.stream(output_patient_folder=output_volume, pats=pats, queue_size=queue_size):
+            logging.info(f"Segmentation of {key} finished")
+        segmentor.saving()
+    else:
+        segmentor.wg_model(pats)
+        segmentor.preparation_zones(input_patients=pats)
+        segmentor.zones_model()
+        segmentor.post_process_zones(output_patient_folder=output_volume, pats=pats)
+        segmentor.saving()
+        segmentor.clean_workspace()
+    if segmentor.cache is not None:
+        segmentor.cache.prune()
 
 class Segmentor:
-    def __init__(self):
+    """Whole gland and zones segmentor.
+
+    The nnU-Net models are loaded on first use and kept for the lifetime of the
+    object, so a long-lived Segmentor pays for weight loading once per process.
+
+    Example:
+        segmentor = Segmentor()
+        segmentor.load_models()
+        masks = segmentor.segment(sitk.ReadImage("t2.nii.gz"))
+        masks["Resampled"]["wg_binary"]
+    """
+    def __init__(self, cache_dir:str=None, probs_writer=None, governor:ResourceGovernor=None, shard:Shard=None,
+                 tier:str="full", zones_roi:bool=False, output_format:str="separate", incremental:bool=False,
+                 cache_max_gb:float=10.0, cache_max_age_days:float=30.0):
+        if output_format not in helpers.OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {output_format}, use one of {list(helpers.OUTPUT_FORMATS)}")
+        self.tier = tier
+        self.zones_roi = zones_roi
+        self.output_format = output_format
+        self.cache = StageCache(cache_dir, max_gb=cache_max_gb, max_age_days=cache_max_age_days) if cache_dir else None
+        self.governor = governor if governor is not None else ResourceGovernor()
+        self.shard = shard
+        self.incremental = incremental # successive cohorts add to the JSON indexes (watch mode)
+        self.probs_writer = probs_writer if probs_writer is not None else helpers.ProbabilityWriter()
         self.pats_for_wg_inference = None
         self.pats_for_wg = None
         self.wg_dict_original = None
@@ -31,40 +130,267 @@ class Segmentor:
         self.pats_for_zones = None
         self.zones_original = None
         self.zones_resampled = None
+        self.wg_binaries = None
+        self.zones_rois = None
+        self.wg_probs = None
+        self.wg_keys = {} # cache keys of the whole gland stage in batch mode, chained by the zones stage
+        self._wg_nn = None
+        self._zones_nn = None
+
+    @property
+    def wg_nn(self):
+        if self._wg_nn is None:
+            self._wg_nn = nnUnet_call.WGNNUnet(input_path="Dataset016_WgSegmentationPNetAndPicai", output_path="OutcomesWG",
+                                              tier=self.tier)
+        return self._wg_nn
+
+    @property
+    def zones_nn(self):
+        if self._zones_nn is None:
+            self._zones_nn = nnUnet_call.ZonesNNUnet(input_path="Dataset019_ProstateZonesSegmentationWgFilteredLessDilated", output_path="OutcomesZones",
+                                                   tier=self.tier)
+        return self._zones_nn
+
+    def load_models(self):
+        """Loads both checkpoints up front instead of on the first segmentation"""
+        return self.wg_nn, self.zones_nn
+
+    def predict(self, model, image:sitk.Image, parent_key:str=None):
+        """Runs a model in memory, going through the stage cache when one is configured
+
+        Args:
+            model (BaseNNUnetModule): whole gland or zones model
+            image (sitk.Image): model input
+            parent_key (str): digest of the original input or key of the previous stage
+
+        Returns:
+            tuple: (segmentation, probabilities, key of this stage)
+        """
+        if self.cache is None or parent_key is None:
+            return (*model.predict_image(image), None)
+        key = self.cache.key(parent_key, model.fingerprint)
+        cached = self.cache.load(key, reference=image)
+        if cached is not None:
+            logging.info(f"Cache hit for {type(model).__name__}")
+            return (*cached, key)
+        segmentation, probabilities = model.predict_image(image)
+        self.cache.store(key, segmentation, probabilities)
+        return segmentation, probabilities, key
+
+    def predict_zones(self, filtered_ser:sitk.Image, wg_binary:sitk.Image, wg_key:str=None):
+        """Runs the zones model, on the whole gland box plus a margin with zones_roi
+
+        Returns:
+            tuple: (segmentation, probabilities, key of this stage) on the grid of filtered_ser
+        """
+        roi = helpers.zones_roi(wg_binary) if self.zones_roi else None
+        if roi is None:
+            return self.predict(self.zones_nn, filtered_ser, wg_key)
+        cropped = helpers.crop_to_roi(filtered_ser, roi)
+        logging.debug(f"zones model on {cropped.GetSize()} instead of {filtered_ser.GetSize()}, "
+                      f"{self.zones_nn.sliding_window_tiles(cropped.GetSize()[::-1])} tiles instead of "
+                      f"{self.zones_nn.sliding_window_tiles(filtered_ser.GetSize()[::-1])}")
+        zones, probs, key = self.predict(self.zones_nn, cropped,
+                                         helpers.zones_roi_key(wg_key) if wg_key is not None else None)
+        return (*helpers.paste_roi(zones, probs, roi, filtered_ser), key)
+
+    def segment(self, image:sitk.Image) -> dict:
+        """Segments a single T2 volume in memory.
+
+        Args:
+            image (sitk.Image): original T2 volume
+
+        Returns:
+            dict: {"Original": {...}, "Resampled": {...}} with the wg, tz and pz
+            binary masks and probabilities, on the nnU-Net grid (0.5x0.5x3.0) and
+            resampled to the grid of image respectively
+        """
+        digest = image_digest(image) if self.cache is not None else None
+        self.governor.apply("preprocessing")
+        image_for_wg = ImageProcessor.ImageProcessing(image)
+        self.governor.apply("inference")
+        wg_binary, probs, wg_key = self.predict(self.wg_nn, image_for_wg, digest)
+        self.governor.apply("postprocessing")
+        wg_binary, wg_probs, filtered_ser = helpers.wg_postprocessing(wg_binary, probs, image_for_wg)
+
+        self.governor.apply("inference")
+        zones, probs, _ = self.predict_zones(filtered_ser, wg_binary, wg_key)
+        self.governor.apply("postprocessing")
+        zone_masks = helpers.zones_postprocessing(zones, probs)
+        original = {"wg_binary": helpers.wg_union(wg_binary, zone_masks), "wg_probs": wg_probs}
+        original.update(zone_masks)
+
+        resampled = helpers.resample_all_to_original(original, image)
+        helpers.release_resampling_plans(image)
+        return {"Original": original, "Resampled": resampled}
 
     @staticmethod
-    def preparation_wg(input_patients:dict):
-        pats_for_wg = helpers.initial_processing(input_patients)
+    def preparation_wg(input_patients:dict, digests:dict=None):
+        pats_for_wg = helpers.initial_processing(input_patients, digests=digests)
         return pats_for_wg
     
     def wg_model(self, input_patients:dict):
-        self.pats_for_wg = self.preparation_wg(input_patients = input_patients)
-        wg_nn = nnUnet_call.WGNNUnet(input_path="Dataset016_WgSegmentationPNetAndPicai", output_path="OutcomesWG")
-        wg_nn.prediction()
-        self.pats_for_wg_inference = wg_nn.return_paths(pats_for_wg=self.pats_for_wg)
+        self.governor.apply("preprocessing")
+        digests = {} if self.cache is not None else None
+        self.pats_for_wg = self.preparation_wg(input_patients = input_patients, digests=digests)
+        self.pats_for_wg_inference = self.wg_nn.return_paths(pats_for_wg=self.pats_for_wg)
+        keys = self._shard_keys(self.pats_for_wg)
+        if self.cache is not None:
+            self.wg_keys = {key: self.cache.key(digest, self.wg_nn.fingerprint) for key, digest in digests.items()}
+            keys = self.restore_cached(self.wg_keys, self.pats_for_wg_inference, self.pats_for_wg)
+        plan = self.governor.apply("batch_inference")
+        with instrumentation.stage("wg_inference", patients=len(self.pats_for_wg)):
+            self.wg_nn.prediction(plan.preprocessing_workers, plan.export_workers, keys=keys)
+        if self.cache is not None:
+            self.store_predicted(keys, self.wg_keys, self.pats_for_wg_inference)
+
+    def restore_cached(self, stage_keys:dict, output_paths:dict, references) -> list:
+        """Writes the cached predictions of a batch stage where nnU-Net would have
+
+        Args:
+            stage_keys (dict): {patient: cache key of the stage}
+            output_paths (dict): {patient: {"binary", "probs"}} as returned by return_paths
+            references (dict): {patient: model input}, the geometry of the cached segmentations
+
+        Returns:
+            list: the patients left to predict
+        """
+        missing = []
+        for key, stage_key in stage_keys.items():
+            if stage_key not in self.cache:
+                missing.append(key)
+                continue
+            cached = self.cache.load(stage_key, reference=references[key])
+            InputCheck.release(references, key)
+            if cached is None:
+                missing.append(key)
+                continue
+            logging.info(f"Cache hit for {key}")
+            segmentation, probabilities = cached
+            os.makedirs(os.path.dirname(output_paths[key]["binary"]), exist_ok=True)
+            sitk.WriteImage(segmentation, output_paths[key]["binary"])
+            np.savez_compressed(output_paths[key]["probs"], probabilities=probabilities)
+        return missing
+
+    def store_predicted(self, keys:list, stage_keys:dict, output_paths:dict):
+        """Fills the cache from the nnU-Net outputs of the predicted patients"""
+        for key in keys:
+            paths = output_paths[key]
+            if not os.path.exists(paths["binary"]) or not os.path.exists(paths["probs"]):
+                continue # failed, logged by nnU-Net
+            with np.load(paths["probs"]) as entry:
+                probabilities = entry["probabilities"]
+            self.cache.store(stage_keys[key], sitk.ReadImage(paths["binary"]), probabilities)
 
     def preparation_zones(self, input_patients:dict):
-        file_handling = helpers.ImageProcessorClass(base_output_path='Outputs', nnUNet_raw = nnUNet_raw)
+        self.governor.apply("postprocessing")
+        file_handling = helpers.ImageProcessorClass(base_output_path='Outputs', nnUNet_raw = nnUNet_raw, probs_writer=self.probs_writer,
+                                                    zones_roi=self.zones_roi, output_format=self.output_format)
         file_handling.process_images(self.pats_for_wg_inference, self.pats_for_wg, pats=input_patients)
         self.wg_dict_original, self.wg_dict_resampled = file_handling.get_paths()
+        self.wg_binaries = file_handling.wg_binaries
+        self.zones_rois = file_handling.zones_rois
+        self.wg_probs = file_handling.wg_probs
 
     def zones_model(self):
-        zones_nn = nnUnet_call.ZonesNNUnet(input_path="Dataset019_ProstateZonesSegmentationWgFilteredLessDilated", output_path="OutcomesZones")
-        zones_nn.prediction()
-        self.pats_for_zones = zones_nn.return_paths(pats_for_wg_inference=self.pats_for_wg_inference)
+        self.pats_for_zones = self.zones_nn.return_paths(pats_for_wg_inference=self.pats_for_wg_inference)
+        keys = self._shard_keys(self.pats_for_wg_inference)
+        if self.cache is not None:
+            # keyed as predict_zones does, the zones input was cropped when a roi was kept
+            inputs = {key: self.zones_nn.input_file(key) for key in self.wg_keys
+                      if os.path.exists(self.zones_nn.input_file(key))}
+            zones_keys = {key: self.cache.key(helpers.zones_roi_key(self.wg_keys[key]) if key in self.zones_rois else self.wg_keys[key],
+                                              self.zones_nn.fingerprint) for key in inputs}
+            keys = self.restore_cached(zones_keys, self.pats_for_zones, InputCheck.LazyImages(inputs, max_resident=1))
+        plan = self.governor.apply("batch_inference")
+        with instrumentation.stage("zones_inference", patients=len(self.pats_for_wg_inference)):
+            self.zones_nn.prediction(plan.preprocessing_workers, plan.export_workers, keys=keys)
+        if self.cache is not None:
+            self.store_predicted(keys, zones_keys, self.pats_for_zones)
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     
     def post_process_zones(self, output_patient_folder:str, pats:dict):
-        zone_handling = helpers.ZoneProcessor(output_patient_folder)
-        zone_handling.process_zones(self.pats_for_zones, pats)
+        self.governor.apply("postprocessing")
+        zone_handling = helpers.ZoneProcessor(output_patient_folder, probs_writer=self.probs_writer, output_format=self.output_format)
+        zone_handling.process_zones(self.pats_for_zones, pats, wg_binaries=self.wg_binaries, zones_rois=self.zones_rois,
+                                    wg_probs=self.wg_probs)
         self.zones_original, self.zones_resampled = zone_handling.get_paths()
     
+    def _shard_keys(self, patients:dict):
+        """Patients handed to nnU-Net explicitly when sharded, the other shards use the same folders"""
+        return list(patients) if self.shard is not None else None
+
     def saving(self):
-        helpers.outputs_saving(self.wg_dict_original, self.zones_original, self.wg_dict_resampled, self.zones_resampled)
+        helpers.outputs_saving(self.wg_dict_original, self.zones_original, self.wg_dict_resampled, self.zones_resampled,
+                               probs_encoding=self.probs_writer.metadata(),
+                               suffix=self.shard.suffix if self.shard is not None else "",
+                               output_format=helpers.output_format_metadata(self.output_format),
+                               merge=self.incremental)
 
     def clean_workspace(self):
         renduntant = helpers.DeleteRedundantfiles()
         renduntant.clean_workspace_wg(self.pats_for_wg_inference)
         renduntant.clean_workspace_zones(self.pats_for_zones)
+        if self.shard is not None:
+            return # the folders may hold patients of other shards still running
         renduntant.clean_patients_directory(os.path.join(nnUNet_raw, os.path.join("Dataset016_WgSegmentationPNetAndPicai", "ImagesTs")),
                                             os.path.join(nnUNet_raw, os.path.join("Dataset019_ProstateZonesSegmentationWgFilteredLessDilated", "ImagesTs")))
+
+    def stream(self, output_patient_folder:str, pats:dict, queue_size:int=2):
+        """Runs every stage per patient instead of per cohort.
+
+        Patient A can be in zones inference while patient B is in whole gland
+        inference and patient C is being post-processed. Volumes are handed to
+        nnU-Net in memory, no ImagesTs or Outcomes files are written.
+
+        Yields:
+            tuple: (key, None) for each finished patient
+        """
+        wg_nn, _ = self.load_models()
+        # the stages run concurrently, one plan for the whole stream
+        self.governor.apply("streaming")
+        file_handling = helpers.ImageProcessorClass(base_output_path='Outputs', nnUNet_raw = nnUNet_raw, probs_writer=self.probs_writer,
+                                                    output_format=self.output_format)
+        zone_handling = helpers.ZoneProcessor(output_patient_folder, probs_writer=self.probs_writer, output_format=self.output_format)
+
+        # stage names match the instrumentation of the batch mode. The original volume is
+        # read here, a corrupt input only drops its patient, then travels with the patient
+        # so that pats is only read once
+        def wg_preprocessing(key, _):
+            image = pats[key]
+            digest = image_digest(image) if self.cache is not None else None
+            return image, digest, ImageProcessor.ImageProcessing(image)
+
+        def wg_inference(key, payload):
+            image, digest, image_for_wg = payload
+            return (image, image_for_wg, *self.predict(wg_nn, image_for_wg, digest))
+
+        def wg_postprocessing(key, payload):
+            image, image_for_wg, wg_binary, probs, wg_key = payload
+            return image, wg_key, file_handling.process_prediction(key, wg_binary, probs, image_for_wg, image)
+
+        def zones_inference(key, payload):
+            image, wg_key, filtered_ser = payload
+            return (image, *self.predict_zones(filtered_ser, file_handling.wg_binaries[key], wg_key))
+
+        def zones_postprocessing(key, payload):
+            image, zones, probs, _ = payload
+            zone_handling.process_prediction(key, zones, probs, image, file_handling.wg_binaries[key],
+                                             file_handling.wg_probs.get(key))
+            del file_handling.wg_binaries[key]
+            file_handling.wg_probs.pop(key, None)
+            helpers.release_resampling_plans(image)
+            InputCheck.release(pats, key)
+
+        stages = [wg_preprocessing, wg_inference, wg_postprocessing, zones_inference, zones_postprocessing]
+        yield from stream_stages(((key, None) for key in pats), stages, queue_size=queue_size)
+
+        # patients that failed in the zones stages still get their WG mask
+        for key, wg_binary in list(file_handling.wg_binaries.items()):
+            original = pats[key]
+            zone_handling.write_wg(key, wg_binary, original, file_handling.wg_probs.get(key))
+            helpers.release_resampling_plans(original)
+            InputCheck.release(pats, key)
+
+        self.wg_dict_original, self.wg_dict_resampled = file_handling.get_paths()
+        self.zones_original, self.zones_resampled = zone_handling.get_paths()
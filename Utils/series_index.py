@@ -0,0 +1,204 @@
+'''
+Header-only index of the reference series used by the DICOM-SEG writer.
+
+The SEG writer only needs the SOP class and instance UIDs and the position of
+every slice, plus the patient, study and geometry tags of one slice. The
+headers are read without the pixel data in a thread pool and sorted along the
+slice normal, as GDCM orders a series. The index of a series directory is
+stored in a small SQLite file and reused as long as the directory listing
+(names, sizes and modification times) is unchanged, so repeated exports and
+reruns do not read the series again.
+'''
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pydicom import Dataset, dcmread
+
+SLICE_TAGS = ("SOPClassUID", "SOPInstanceUID", "ImagePositionPatient", "ReferencedFrameNumber")
+FUNCTIONAL_GROUPS = ("SharedFunctionalGroupsSequence", "PerFrameFunctionalGroupsSequence")
+
+
+def _dcm_entries(series_dir:Path) -> list:
+    return sorted(
+        (entry for entry in os.scandir(series_dir) if entry.is_file() and entry.name.endswith(".dcm")),
+        key=lambda entry: entry.name,
+    )
+
+def series_stamp(series_dir:Path) -> str:
+    ''' Changes whenever a .dcm file of the directory is added, removed or rewritten '''
+    digest = hashlib.sha256()
+    for entry in _dcm_entries(series_dir):
+        stat = entry.stat()
+        digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()
+
+def _slice_position(dataset:Dataset, normal:np.ndarray):
+    if normal is None or "ImagePositionPatient" not in dataset:
+        return None
+    return float(np.dot(normal, np.asarray(dataset.ImagePositionPatient, dtype=float)))
+
+def _is_multiframe(dataset:Dataset) -> bool:
+    return "PerFrameFunctionalGroupsSequence" in dataset and int(dataset.get("NumberOfFrames", 1) or 1) > 1
+
+def expand_frames(dataset:Dataset) -> tuple:
+    '''
+    Splits an enhanced multi-frame header into per slice headers, as the SEG writer
+    expects from a classic series. Returns the header of the image, with the shared
+    functional groups flattened into it, and one header per frame holding the
+    SLICE_TAGS (ReferencedFrameNumber counts from 1).
+    '''
+    header = Dataset()
+    for element in dataset:
+        if element.keyword not in FUNCTIONAL_GROUPS + ("PixelData",):
+            header.add(element)
+    shared = dataset.SharedFunctionalGroupsSequence[0]
+    header.ImageOrientationPatient = shared.PlaneOrientationSequence[0].ImageOrientationPatient
+    measures = shared.PixelMeasuresSequence[0]
+    for keyword in ("PixelSpacing", "SliceThickness", "SpacingBetweenSlices"):
+        if keyword in measures:
+            header.add(measures.data_element(keyword))
+
+    frames = []
+    for number, group in enumerate(dataset.PerFrameFunctionalGroupsSequence, start=1):
+        frame = Dataset()
+        frame.SOPClassUID = dataset.SOPClassUID
+        frame.SOPInstanceUID = dataset.SOPInstanceUID
+        frame.ImagePositionPatient = group.PlanePositionSequence[0].ImagePositionPatient
+        frame.ReferencedFrameNumber = number
+        frames.append(frame)
+    return header, frames
+
+def read_series_headers(series_dir:Path, workers:int=None) -> List[Dataset]:
+    '''
+    Reads the headers of the .dcm files of a series directory, without the pixel
+    data, in spatial order (increasing position along the slice normal).
+    Falls back to the InstanceNumber when the slices have no position.
+    An enhanced multi-frame image gives one header per frame, see expand_frames.
+    '''
+    paths = [entry.path for entry in _dcm_entries(series_dir)]
+    if not paths:
+        return []
+    workers = workers or min(8, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        datasets = list(executor.map(lambda path: dcmread(path, stop_before_pixels=True), paths))
+
+    # one series per directory, as GDCMSeriesFileNames returns the first series found
+    series_uid = datasets[0].get("SeriesInstanceUID")
+    if any(dataset.get("SeriesInstanceUID") != series_uid for dataset in datasets):
+        logging.warning(f"{series_dir} holds more than one series, only {series_uid} is referenced")
+        datasets = [dataset for dataset in datasets if dataset.get("SeriesInstanceUID") == series_uid]
+
+    header = None
+    if len(datasets) == 1 and _is_multiframe(datasets[0]):
+        header, datasets = expand_frames(datasets[0])
+    return order_headers(datasets, header, series_dir)
+
+def order_headers(datasets:List[Dataset], header:Dataset=None, name:str="") -> List[Dataset]:
+    '''
+    Sorts slice headers along the slice normal. When the slices only hold the
+    SLICE_TAGS, header holds the tags shared by the series and is merged into
+    the first slice, as in a classic series.
+    '''
+    normal = None
+    orientation_source = header if header is not None else datasets[0]
+    if "ImageOrientationPatient" in orientation_source:
+        orientation = np.asarray(orientation_source.ImageOrientationPatient, dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+    positions = [_slice_position(dataset, normal) for dataset in datasets]
+    if None in positions:
+        logging.warning(f"{name} has slices without position, ordering by InstanceNumber")
+        positions = [int(dataset.get("InstanceNumber", 0) or 0) for dataset in datasets]
+    # sorted is stable, equal positions keep the file name order
+    order = sorted(range(len(datasets)), key=lambda index: positions[index])
+    ordered = [datasets[index] for index in order]
+    if header is not None:
+        # the first slice carries the patient, study and geometry tags
+        header.update(ordered[0])
+        ordered[0] = header
+    return ordered
+
+class ReferenceSeries(NamedTuple):
+    '''
+    A series written by this process: its directory and its headers in the order
+    read_series_headers gives them, so that the SEG writer does not read it back.
+    '''
+    path: str
+    headers: List[Dataset]
+
+class SeriesIndex:
+    '''
+    SQLite store of the ordered reference series headers, keyed by series
+    directory and validated against its stamp.
+
+    Only the complete header of the first slice and the SLICE_TAGS of the
+    others are kept, the datasets returned for the other slices hold only these.
+    '''
+
+    def __init__(self, db_path:str, workers:int=None):
+        self.db_path = db_path
+        self.workers = workers
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS series (series_dir TEXT PRIMARY KEY, stamp TEXT, headers TEXT)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        # shards of a cohort may share the file, sqlite serializes the writers
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection: # commits, or rolls back on error
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _encode(datasets:List[Dataset]) -> str:
+        slices = [
+            Dataset({dataset.data_element(tag).tag: dataset.data_element(tag)
+                     for tag in SLICE_TAGS if tag in dataset})
+            for dataset in datasets
+        ]
+        return json.dumps({
+            "first": datasets[0].to_json_dict(),
+            "slices": [dataset.to_json_dict() for dataset in slices],
+        })
+
+    @staticmethod
+    def _decode(headers:str) -> List[Dataset]:
+        decoded = json.loads(headers)
+        return [Dataset.from_json(decoded["first"])] + [
+            Dataset.from_json(tags) for tags in decoded["slices"][1:]
+        ]
+
+    def get(self, series_dir:Path) -> List[Dataset]:
+        ''' Ordered headers of a series directory, read and stored on a miss '''
+        series_dir = os.path.abspath(series_dir)
+        stamp = series_stamp(series_dir)
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT stamp, headers FROM series WHERE series_dir = ?", (series_dir,)
+            ).fetchone()
+        if row is not None and row[0] == stamp:
+            return self._decode(row[1])
+
+        datasets = read_series_headers(series_dir, self.workers)
+        if datasets:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO series (series_dir, stamp, headers) VALUES (?, ?, ?)",
+                    (series_dir, stamp, self._encode(datasets)),
+                )
+        return datasets
+
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM series").fetchone()[0]
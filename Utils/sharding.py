@@ -0,0 +1,111 @@
+'''
+Static sharding of a cohort across processes or nodes sharing the Pats and
+Outputs volumes.
+
+Shard i/N (0 <= i < N) takes every N-th input of the sorted list of dicom
+series and nifti files, so every shard computes the same partition as long as
+they all see the same Pats folder. Each shard writes its own JSON indexes,
+merge_shards combines them into the cohort-level ones once all shards finished.
+
+    python __main__.py --shard 0/4   # on node 0
+    python __main__.py --shard 3/4   # on node 3
+    python __main__.py --merge-shards
+'''
+import os
+import re
+import argparse
+import glob
+import json
+import logging
+from typing import List, NamedTuple
+import yaml
+
+INDEXES = ("nnOutputSegmentationPaths", "ResampledToOriginalSegmentationPaths")
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    @property
+    def suffix(self) -> str:
+        ''' Appended to the names of the per shard files, e.g. nnOutputSegmentationPaths.shard-0-of-4.json '''
+        return f".shard-{self.index}-of-{self.count}"
+
+    def select(self, items) -> list:
+        ''' The items of this shard, deterministic regardless of the listing order '''
+        return sorted(items)[self.index::self.count]
+
+def parse_shard(value:str) -> Shard:
+    ''' Parses "i/N", for argparse, which shows the message of an ArgumentTypeError '''
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value or "")
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Shard must be given as i/N, got {value!r}")
+    shard = Shard(int(match.group(1)), int(match.group(2)))
+    if shard.count < 1:
+        raise argparse.ArgumentTypeError(f"Shard count must be at least 1, got {value!r}")
+    if not 0 <= shard.index < shard.count:
+        raise argparse.ArgumentTypeError(f"Shard index must be within 0 and {shard.count - 1}, got {value!r}")
+    return shard
+
+def _shard_files(pattern:str) -> dict:
+    ''' {shard count: {shard index: path}} of the files matching a glob pattern with a shard suffix '''
+    found = {}
+    for path in glob.glob(pattern):
+        match = re.search(r"\.shard-(\d+)-of-(\d+)\.", os.path.basename(path))
+        if match:
+            found.setdefault(int(match.group(2)), {})[int(match.group(1))] = path
+    return found
+
+def _merge(files:List[str], load) -> dict:
+    merged = {}
+    for path in files:
+        part = load(path) or {}
+        duplicates = merged.keys() & part.keys()
+        if duplicates:
+            raise ValueError(f"{path} repeats patients of another shard: {sorted(duplicates)}")
+        merged.update(part)
+    return merged
+
+def _select_run(found:dict, name:str) -> List[str]:
+    if len(found) > 1:
+        raise ValueError(f"{name} has shards of different runs ({sorted(found)} shards), remove the stale ones")
+    count, files = next(iter(found.items()))
+    missing = sorted(set(range(count)) - files.keys())
+    if missing:
+        logging.warning(f"{name}: shards {missing} of {count} are missing, the merged index is incomplete")
+    return [files[index] for index in sorted(files)]
+
+def merge_shards(output_dir:str="Outputs", input_dir:str="Pats") -> dict:
+    '''
+    Combines the per shard JSON indexes and patient dictionaries into the
+    cohort-level files read by the rest of the tooling.
+
+    Returns:
+        dict: {index name: number of patients} of the merged files
+    '''
+    merged_counts = {}
+    for name in INDEXES:
+        found = _shard_files(os.path.join(output_dir, f"{name}.shard-*-of-*.json"))
+        if not found:
+            continue
+        files = _select_run(found, name)
+
+        def load_json(path):
+            with open(path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        merged = _merge(files, load_json)
+        with open(os.path.join(output_dir, f"{name}.json"), "w") as file:
+            json.dump(merged, file, indent=4)
+        merged_counts[name] = len(merged)
+
+    found = _shard_files(os.path.join(input_dir, "patient_dict.shard-*-of-*.yaml"))
+    if found:
+        def load_yaml(path):
+            with open(path, "r", encoding="utf-8") as yfile:
+                return yaml.safe_load(yfile)
+        merged = _merge(_select_run(found, "patient_dict"), load_yaml)
+        with open(os.path.join(input_dir, "patient_dict.yaml"), "w", encoding="utf-8") as yfile:
+            yaml.safe_dump(merged, yfile, indent=4, sort_keys=False)
+        merged_counts["patient_dict"] = len(merged)
+    return merged_counts
@@ -0,0 +1,336 @@
+'''
+Watch-folder ingestion for the daemon mode.
+
+With inotify only the sources its events point at are rescanned, and only new
+directories get a watch; the whole volume is rescanned at start up, when the
+event queue overflows, and every poll_interval seconds where inotify is not
+available (e.g. on macOS or some network mounts). A source, a dicom series
+directory or a .nii.gz file, is handed over once it is new or changed and has
+not changed for quiescence seconds, so that half copied series are never
+processed. The consumer marks the sources it processed successfully, the
+others are retried once they change again. The state of the processed sources
+is kept in a JSON file, a restarted daemon only picks up what changed while it
+was down.
+'''
+import os
+import json
+import time
+import struct
+import ctypes
+import select
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List
+from Utils.series_index import series_stamp
+from Utils.get_images import GENERATED_DIR
+
+# inotify(7) events that may change a source
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000 # the watch was removed, e.g. its directory was deleted
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII") # wd, mask, cookie, len, followed by len bytes of name
+
+
+def _drain(fd:int):
+    ''' Discards what is waiting on a non-blocking descriptor, only the wake up matters '''
+    try:
+        while os.read(fd, 65536):
+            pass
+    except BlockingIOError:
+        pass
+
+def scan_sources(input_dir:Path, root:Path=None) -> Dict[str, str]:
+    '''
+    {source: stamp} of the dicom series directories and .nii.gz files of the input
+    volume, or of its root subtree, the niftis generated from dicom excluded. Paths
+    as get_images lists them.
+    '''
+    generated = os.path.join(input_dir, GENERATED_DIR)
+    sources = {}
+    for dirpath, dirnames, files in os.walk(input_dir if root is None else root):
+        dirnames[:] = [name for name in dirnames if os.path.join(dirpath, name) != generated]
+        for file in files:
+            if file.endswith(".nii.gz"):
+                path = os.path.join(dirpath, file)
+                stamp = _file_stamp(path)
+                if stamp is not None:
+                    sources[path] = stamp
+        if any(file.endswith(".dcm") for file in files):
+            try:
+                sources[dirpath] = series_stamp(dirpath)
+            except FileNotFoundError: # removed while scanning
+                continue
+    return sources
+
+def _file_stamp(path:str) -> str:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def _series_stamp(directory:str) -> str:
+    ''' Stamp of a directory as a series source, None if it holds no .dcm file (anymore) '''
+    try:
+        if not any(entry.name.endswith(".dcm") and entry.is_file() for entry in os.scandir(directory)):
+            return None
+        return series_stamp(directory)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+class _Inotify:
+    ''' Minimal inotify(7) binding, reports the paths of the events under the watched directories '''
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches = {} # watch descriptor: directory
+
+    def watch_tree(self, root:Path, exclude:str=None):
+        ''' Watches root and the directories under it, but exclude '''
+        watched = set(self._watches.values())
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [name for name in dirnames if os.path.join(dirpath, name) != exclude]
+            if dirpath in watched:
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dirpath), IN_EVENTS)
+            if wd < 0:
+                logging.warning(f"Cannot watch {dirpath}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self._watches[wd] = dirpath
+
+    def unwatch_tree(self, root:str):
+        ''' Drops the watches of a directory moved away and of the directories under it '''
+        for wd, directory in list(self._watches.items()):
+            if directory == root or directory.startswith(root + os.sep):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._watches[wd]
+
+    def events(self) -> List[tuple]:
+        ''' (path, mask) of the events waiting, path None for a queue overflow '''
+        buffer = b""
+        try:
+            while True:
+                chunk = os.read(self.fd, 65536)
+                if not chunk:
+                    break
+                buffer += chunk
+        except BlockingIOError:
+            pass
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(buffer):
+            wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self._watches.get(wd)
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if directory is None:
+                continue
+            events.append((os.path.join(directory, os.fsdecode(name)) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    '''
+    Yields the sources of an input volume that are new or changed and quiescent.
+
+    :param input_dir: the watched input volume
+    :param quiescence: seconds a source must stay unchanged before it is processed
+    :param poll_interval: rescan period without inotify, upper bound of the wait with it
+    :param state_path: JSON file of the processed sources and their stamps, in memory only if None
+    :param use_inotify: False forces polling
+    '''
+
+    def __init__(self, input_dir:Path, quiescence:float=30.0, poll_interval:float=5.0,
+                 state_path:str=None, use_inotify:bool=True):
+        self.input_dir = input_dir
+        self.quiescence = quiescence
+        self.poll_interval = poll_interval
+        self.state_path = state_path
+        self.processed = self._load_state()
+        self._pending = {} # source: (stamp, time the stamp was first seen)
+        self._complete = set() # sources known to be complete, no quiescence needed
+        self._handed = {} # source: stamp of the batch the consumer is processing
+        self._failed = {} # source: stamp it failed with, retried once the stamp changes
+        self._sources = None # {source: stamp} of the volume, None until the first full scan
+        self._changed = set() # .nii.gz files and series directories inotify reported
+        self._trees = set() # directories created, moved or removed, rescanned as a whole
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        self._generated = os.path.join(input_dir, GENERATED_DIR)
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+                self._inotify.watch_tree(input_dir, exclude=self._generated)
+            except (OSError, AttributeError) as e: # AttributeError: no inotify in the C library
+                logging.warning(f"inotify not available ({e}), polling {input_dir} every {poll_interval} s")
+                self._inotify = None
+
+    def _load_state(self) -> Dict[str, str]:
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _save_state(self):
+        if self.state_path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(self.processed, file, indent=4)
+        os.replace(tmp_path, self.state_path)
+
+    def notify_complete(self, source:str):
+        ''' Marks a source as complete (e.g. a series received over DICOM), it is processed at the next scan '''
+        with self._lock:
+            self._complete.add(source)
+        os.write(self._wake_write, b"\0")
+
+    def _read_events(self):
+        ''' Sorts the inotify events into the sources and the trees to rescan, new directories get a watch '''
+        for path, mask in self._inotify.events():
+            if path is None: # events were lost
+                self._sources = None
+                continue
+            if path == self._generated or path.startswith(self._generated + os.sep):
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._inotify.watch_tree(path, exclude=self._generated)
+                elif mask & IN_MOVED_FROM:
+                    self._inotify.unwatch_tree(path)
+                self._trees.add(path)
+            elif path.endswith(".nii.gz"):
+                self._changed.add(path)
+            elif path.endswith(".dcm"):
+                self._changed.add(os.path.dirname(path))
+
+    def _scan(self, complete:set) -> Dict[str, str]:
+        ''' {source: stamp} of the volume, only the reported sources are rescanned with inotify '''
+        if self._inotify is not None:
+            self._read_events()
+        if self._inotify is None or self._sources is None:
+            self._sources = scan_sources(self.input_dir)
+            self._changed.clear()
+            self._trees.clear()
+            return self._sources
+        for tree in self._trees:
+            for source in [source for source in self._sources if source == tree or source.startswith(tree + os.sep)]:
+                del self._sources[source]
+            if os.path.isdir(tree):
+                self._sources.update(scan_sources(self.input_dir, root=tree))
+        for source in self._changed | complete:
+            stamp = _file_stamp(source) if source.endswith(".nii.gz") else _series_stamp(source)
+            if stamp is None:
+                self._sources.pop(source, None)
+            else:
+                self._sources[source] = stamp
+        self._changed.clear()
+        self._trees.clear()
+        return self._sources
+
+    def ready(self, now:float) -> Dict[str, str]:
+        '''
+        {source: stamp} of the new or changed sources that did not change for
+        quiescence seconds, or that were notified as complete
+        '''
+        with self._lock:
+            complete = set(self._complete)
+        current = self._scan(complete)
+        ready = {}
+        for source, stamp in current.items():
+            if self.processed.get(source) == stamp or self._failed.get(source) == stamp:
+                self._pending.pop(source, None)
+                continue
+            seen = self._pending.get(source)
+            if source in complete:
+                ready[source] = stamp
+            elif seen is None or seen[0] != stamp:
+                self._pending[source] = (stamp, now)
+            elif now - seen[1] >= self.quiescence:
+                ready[source] = stamp
+        for source in set(self._pending) - current.keys(): # removed before becoming quiescent
+            del self._pending[source]
+        for source in set(self._failed) - current.keys():
+            del self._failed[source]
+        removed = self.processed.keys() - current.keys()
+        if removed:
+            for source in removed:
+                del self.processed[source]
+            self._save_state()
+        return ready
+
+    def mark_processed(self, sources:Iterable[str]):
+        ''' Records sources of the current batch as processed, with the stamp they were handed over with '''
+        sources = [source for source in sources if source in self._handed]
+        for source in sources:
+            self.processed[source] = self._handed.pop(source)
+            self._pending.pop(source, None)
+        with self._lock:
+            self._complete.difference_update(sources)
+        self._save_state()
+
+    def _wait(self, now:float):
+        timeout = self.poll_interval
+        if self._pending:
+            # wake up when the earliest pending source becomes quiescent
+            deadline = min(seen for _, seen in self._pending.values()) + self.quiescence
+            timeout = min(timeout, max(0.0, deadline - now))
+        descriptors = [self._wake_read]
+        if self._inotify is not None:
+            descriptors.append(self._inotify.fd)
+        readable, _, _ = select.select(descriptors, [], [], timeout)
+        if self._wake_read in readable:
+            _drain(self._wake_read)
+        # the inotify events are read by the next scan
+
+    def batches(self, stop=None):
+        '''
+        Yields lists of ready sources, forever or until stop (a threading.Event) is set.
+        The consumer calls mark_processed with the sources it processed successfully;
+        the others count as failed once it asks for the next batch and are retried
+        when they change again.
+        '''
+        while stop is None or not stop.is_set():
+            now = time.monotonic()
+            ready = self.ready(now)
+            if ready:
+                self._handed = dict(ready)
+                yield sorted(ready)
+                self._failed.update(self._handed)
+                for source in self._handed:
+                    self._pending.pop(source, None)
+                with self._lock:
+                    self._complete.difference_update(self._handed)
+                self._handed = {}
+            else:
+                self._wait(now)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
@@ -3,11 +3,18 @@ Main component for prostate zone (WG,PZ,TZ) segmentation, data transformation(dc
 and uploading results to an orthanc server + ohif viewer server.
 '''
 import os
+import time
 import shutil
+import argparse
+import uuid
 import warnings
 import multiprocessing
 import logging
-from Utils import helpers, segmentor_pipeline, InputCheck
+from Utils import helpers, segmentor_pipeline, InputCheck, instrumentation
+from Utils.resources import ResourceGovernor
+from Utils.sharding import merge_shards, parse_shard
+from Utils.watcher import FolderWatcher
+from Utils.dicom_receiver import DicomReceiver
 from Utils.get_images import get_images
 from Utils.nifti2dicom_convert import converter
 from Utils.ImportDicomFiles import upload
@@ -15,47 +22,244 @@ warnings.filterwarnings('ignore')
 
 INPUT_VOLUME = "Pats"
 OUTPUT_VOLUME = "Outputs"
+WATCH_SUFFIX = ".watch" # patient_dict.watch.yaml, the patients of the current watch batch
 
-def run_process(patient_list:str): #input_folder, output_folder
+def run_process(patient_list:str, args:argparse.Namespace=None): #input_folder, output_folder
     ''' Creates zone segmentation for the given data via trained NNUnet '''
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = args if args is not None else parse_args([])
+    configure_metrics(args)
 
-    pats = InputCheck.load_nii_gz_files(patient_list) # loads files
+    pats = InputCheck.load_nii_gz_files(patient_list, max_resident=args.max_resident) # read on demand
 
     try:
         # perform segmentation operations
-        segmentor_pipeline.segmentor_pipeline_operation(
-            output_volume=OUTPUT_VOLUME, pats=pats
-        )
+        with instrumentation.stage("segmentation", patients=len(pats), quality=args.quality):
+            segmentor_pipeline.segmentor_pipeline_operation(
+                output_volume=OUTPUT_VOLUME, pats=pats,
+                streaming=args.streaming, queue_size=args.queue_size,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                cache_max_gb=args.cache_max_gb,
+                cache_max_age_days=args.cache_max_age_days,
+                probs_writer=helpers.ProbabilityWriter(args.probs_precision, args.probs_compression),
+                governor=ResourceGovernor(args.cpus, args.torch_threads, args.sitk_threads, args.nnunet_workers),
+                shard=args.shard,
+                tier=args.quality,
+                zones_roi=args.zones_roi,
+                output_format=args.output_format
+            )
 
     except Exception as e:
          # Open file in append mode
         with open(os.path.join(OUTPUT_VOLUME,'error_log.txt'), 'a') as f: 
             f.write(f"An error occurred: {str(e)}\n")
 
-    try:
-        # post process masks, filling holes for WG and TZ when necessary
-        helpers.process_masks(out_volume=OUTPUT_VOLUME) 
+def run_watch(args:argparse.Namespace):
+    '''
+    Daemon mode: processes the new or changed series and niftis of the input volume as
+    they arrive, with the models loaded once. Nothing is wiped, the JSON indexes are updated.
+    With --listen, series received over DICOM are processed as soon as their association
+    is released.
+    '''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    configure_metrics(args)
+    segmentor = segmentor_pipeline.Segmentor(
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_max_gb=args.cache_max_gb,
+        cache_max_age_days=args.cache_max_age_days,
+        probs_writer=helpers.ProbabilityWriter(args.probs_precision, args.probs_compression),
+        governor=ResourceGovernor(args.cpus, args.torch_threads, args.sitk_threads, args.nnunet_workers),
+        tier=args.quality,
+        zones_roi=args.zones_roi,
+        output_format=args.output_format,
+        incremental=True
+    )
+    segmentor.load_models()
+    watcher = FolderWatcher(INPUT_VOLUME, quiescence=args.quiescence, poll_interval=args.poll_interval,
+                            state_path=os.path.join(args.cache_dir, "watch_state.json"))
+    logging.info(f"Watching {INPUT_VOLUME}, series are processed after {args.quiescence} s without changes")
+    receiver = None
+    if args.listen:
+        receiver = DicomReceiver(INPUT_VOLUME, port=args.listen, ae_title=args.ae_title,
+                                 on_series=lambda series_dir, _: watcher.notify_complete(series_dir)).start()
 
-    except Exception as e:
-        print ("ERROR IN THE POST PROCESS OF WG MASK, CHECK SEGMENTATION",e)
+    for sources in watcher.batches():
+        logging.info(f"{len(sources)} new or changed: {sources}")
+        pat_list = []
+        try:
+            with instrumentation.stage("dicom_conversion", patients=len(sources)):
+                pat_list = get_images(INPUT_VOLUME, workers=args.conversion_workers, sources=sources, suffix=WATCH_SUFFIX)
+            pats = InputCheck.load_nii_gz_files(pat_list, max_resident=args.max_resident)
+            with instrumentation.stage("segmentation", patients=len(pats), quality=args.quality):
+                segmentor_pipeline.segmentor_pipeline_operation(
+                    output_volume=OUTPUT_VOLUME, pats=pats,
+                    streaming=args.streaming, queue_size=args.queue_size,
+                    segmentor=segmentor
+                )
+            seg_files = {} # source: SEG files written, the patients dropped by the segmentation have none
+            with instrumentation.stage("dicom_export"):
+                study_dirs = converter(
+                    os.path.join(INPUT_VOLUME, f"patient_dict{WATCH_SUFFIX}.yaml"), output_format=args.output_format,
+                    series_index_path=None if args.no_cache else os.path.join(args.cache_dir, "series_index.sqlite"),
+                    t2_export=args.t2_export, export_workers=args.export_workers, seg_files=seg_files,
+                )
+            results = upload(study_dirs, workers=args.upload_workers)
+            uploaded = {os.path.normpath(result.path) for result in results if result.success}
+            for source in sources:
+                stored = seg_files.get(source)
+                if not stored or any(os.path.normpath(path) not in uploaded for path in stored):
+                    logging.error(f"{source}: SEG not stored, "
+                                  f"{'upload failed' if stored else 'segmentation or export failed'}")
+                    continue
+                watcher.mark_processed([source])
+                # from the last instance received to the SEG stored in orthanc
+                received = receiver.received_at(source) if receiver is not None else None
+                if received is not None:
+                    instrumentation.interval("receive_to_seg", received, time.time(), patient=source)
+                    logging.info(f"{source}: SEG stored {time.time() - received:.1f} s after the last instance")
+        except Exception as e:
+            # the sources not marked as processed are retried once they change again
+            logging.error(f"Processing {sources} failed: {e}")
+            with open(os.path.join(OUTPUT_VOLUME,'error_log.txt'), 'a') as f:
+                f.write(f"An error occurred: {str(e)}\n")
+        finally:
+            for nii in pat_list:
+                if "_gen_dicom2nifti" in nii.split(os.sep) and os.path.exists(nii):
+                    os.remove(nii)
+
+        if not args.no_metrics:
+            # running totals of the daemon, metrics.jsonl is not read back after every batch
+            instrumentation.write_process_prometheus(os.path.join(args.metrics_dir, "metrics.prom"))
+
+def configure_metrics(args:argparse.Namespace):
+    ''' Stage timing and memory records of this process, shared by all processes of the run '''
+    if args.no_metrics:
+        return
+    instrumentation.configure(os.path.join(args.metrics_dir, "metrics.jsonl"), run_id=args.run_id)
+
+def parse_args(argv=None):
+    ''' Command line options of the segmentor '''
+    parser = argparse.ArgumentParser(description="Prostate whole gland and zones segmentor")
+    parser.add_argument("--streaming", action="store_true",
+                        help="run every stage per patient with bounded queues instead of per cohort")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="patients allowed to wait in front of each stage in streaming mode")
+    parser.add_argument("--max-resident", type=int, default=4,
+                        help="decoded input volumes kept in memory, the others are read again when needed")
+    parser.add_argument("--cache-dir", default=os.path.join(OUTPUT_VOLUME, ".cache"),
+                        help="cache of the whole gland and zones predictions, "
+                             "and of the reference series headers of the DICOM-SEG export")
+    parser.add_argument("--cache-max-gb", type=float, default=10.0,
+                        help="size of the cached predictions, the least recently used are dropped beyond it")
+    parser.add_argument("--cache-max-age-days", type=float, default=30.0,
+                        help="cached predictions unused for longer are dropped")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always re-run both models and re-read the reference series")
+    parser.add_argument("--quality", default="full", choices=["full", "balanced", "fast"],
+                        help="inference tier: full (8x mirroring, 50%% tile overlap), balanced (left-right "
+                             "mirroring only) or fast (no mirroring, no tile overlap)")
+    parser.add_argument("--zones-roi", action="store_true",
+                        help="run the zones model on the whole gland bounding box plus a small margin instead of the full grid")
+    parser.add_argument("--output-format", default="separate", choices=["separate", "multilabel"],
+                        help="separate binary masks and probability maps per zone, or one label map "
+                             "(1 WG, 2 TZ, 3 PZ) and one 4D (wg, tz, pz) probability volume per space")
+    parser.add_argument("--conversion-workers", type=int, default=None,
+                        help="processes converting dicom series to nifti, defaults to the cores the process may use (affinity, cgroup quota)")
+    parser.add_argument("--probs-precision", default="float32", choices=["float32", "uint16", "uint8"],
+                        help="storage of the probability maps, fixed point types are scaled to their full range")
+    parser.add_argument("--probs-compression", type=int, default=None, choices=range(10),
+                        help="gzip level of the probability maps, 0 writes uncompressed .nii")
+    parser.add_argument("--t2-export", default="classic", choices=["classic", "enhanced"],
+                        help="T2 series written for nifti inputs: classic (one file per slice) or enhanced "
+                             "(one Enhanced MR multi-frame file, experimental: DERIVED frames without the MR "
+                             "acquisition macros, see benchmarks/seg_frames.py for the IOD check)")
+    parser.add_argument("--export-workers", type=int, default=None,
+                        help="threads writing the classic T2 slices, defaults to the number of cores (at most 8)")
+    parser.add_argument("--upload-workers", type=int, default=8,
+                        help="parallel requests uploading to orthanc")
+    parser.add_argument("--cpus", type=int, default=None,
+                        help="cores split between torch, SimpleITK and nnU-Net workers (env SEGMENTOR_CPUS), "
+                             "defaults to the cores available to the container")
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="pins the torch threads of every stage (env SEGMENTOR_TORCH_THREADS)")
+    parser.add_argument("--sitk-threads", type=int, default=None,
+                        help="pins the SimpleITK threads of every stage (env SEGMENTOR_SITK_THREADS)")
+    parser.add_argument("--nnunet-workers", type=int, default=None,
+                        help="nnU-Net preprocessing and export processes each (env SEGMENTOR_NNUNET_WORKERS)")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="i/N, process only the i-th of N deterministic parts of the cohort (0 <= i < N)")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="merge the per shard JSON indexes into the cohort-level ones and exit")
+    parser.add_argument("--watch", action="store_true",
+                        help="daemon mode: keep the models loaded and process new or changed series as they arrive")
+    parser.add_argument("--quiescence", type=float, default=30.0,
+                        help="seconds a series or nifti must stay unchanged before it is processed in watch mode")
+    parser.add_argument("--poll-interval", type=float, default=5.0,
+                        help="rescan period of the input volume in watch mode when inotify is not available")
+    parser.add_argument("--listen", type=int, default=None, metavar="PORT",
+                        help="watch mode with a DICOM C-STORE SCP on PORT, received MR series are processed "
+                             "once their association is released (needs pynetdicom)")
+    parser.add_argument("--ae-title", default="SEGMENTOR",
+                        help="application entity title of the C-STORE SCP")
+    parser.add_argument("--metrics-dir", default=OUTPUT_VOLUME,
+                        help="where metrics.jsonl and the prometheus snapshot metrics.prom are written")
+    parser.add_argument("--no-metrics", action="store_true",
+                        help="do not record stage timings")
+    args = parser.parse_args(argv)
+    args.run_id = uuid.uuid4().hex
+    return args
 
 if __name__ == '__main__':
 
-    for x in os.listdir("dicom_outputs"):
-        if x != '.gitkeep':
-            shutil.rmtree( os.path.join("dicom_outputs",x))
+    args = parse_args()
 
-    if os.path.exists("Pats/_gen_dicom2nifti"):
-        shutil.rmtree("Pats/_gen_dicom2nifti")
+    if args.merge_shards:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        for name, count in merge_shards(OUTPUT_VOLUME, INPUT_VOLUME).items():
+            logging.info(f"{name}: {count} patients merged")
+        raise SystemExit(0)
 
-    pat_list = get_images( INPUT_VOLUME ) # .dcm 2 nifti or NifTi files instanly
+    if args.watch or args.listen:
+        run_watch(args)
+        raise SystemExit(0)
+
+    # shards share dicom_outputs and the generated niftis, only a full run starts from scratch
+    if args.shard is None:
+        for x in os.listdir("dicom_outputs"):
+            if x != '.gitkeep':
+                shutil.rmtree( os.path.join("dicom_outputs",x))
+
+        if os.path.exists("Pats/_gen_dicom2nifti"):
+            shutil.rmtree("Pats/_gen_dicom2nifti")
+
+    configure_metrics(args)
+    suffix = args.shard.suffix if args.shard is not None else ""
+
+    with instrumentation.stage("dicom_conversion"):
+        pat_list = get_images( INPUT_VOLUME, workers=args.conversion_workers, shard=args.shard ) # .dcm 2 nifti or NifTi files instanly
     process = multiprocessing.Process(
-        target=run_process,kwargs={"patient_list":pat_list}
+        target=run_process,kwargs={"patient_list":pat_list, "args":args}
     )
     process.start()
     process.join()
 
-    converter()
-    upload("dicom_outputs")
-    shutil.rmtree("Pats/_gen_dicom2nifti")
+    with instrumentation.stage("dicom_export"):
+        study_dirs = converter(
+            os.path.join(INPUT_VOLUME, f"patient_dict{suffix}.yaml"), output_format=args.output_format,
+            series_index_path=None if args.no_cache else os.path.join(args.cache_dir, "series_index.sqlite"),
+            t2_export=args.t2_export, export_workers=args.export_workers,
+        )
+    upload("dicom_outputs" if args.shard is None else study_dirs, workers=args.upload_workers)
+    if args.shard is None:
+        shutil.rmtree("Pats/_gen_dicom2nifti")
+    else:
+        for nii in pat_list:
+            if "_gen_dicom2nifti" in nii.split(os.sep):
+                os.remove(nii)
+
+    if not args.no_metrics:
+        instrumentation.write_prometheus(
+            os.path.join(args.metrics_dir, "metrics.jsonl"),
+            os.path.join(args.metrics_dir, f"metrics{suffix}.prom"),
+            run_id=args.run_id
+        )
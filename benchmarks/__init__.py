@@ -0,0 +1,6 @@
+'''
+Stage level benchmarks on synthetic prostate phantoms.
+
+Run from the repository root:
+    python -m benchmarks.stages --output bench_output.json
+'''
@@ -0,0 +1,88 @@
+'''
+Timing and memory measurement helpers shared by the benchmarks.
+'''
+import os
+import gc
+import time
+import platform
+import threading
+from typing import Callable, Dict, List
+import numpy as np
+from Utils.instrumentation import current_rss
+
+
+class PeakRSS:
+    ''' Samples the RSS in a background thread while the context is active '''
+
+    def __init__(self, interval:float=0.002):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = current_rss()
+        self.peak = self.baseline
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+def summarize(latencies:List[float]) -> Dict[str, float]:
+    ''' Latency statistics in milliseconds '''
+    values = np.array(latencies) * 1000
+    return {
+        "min": float(values.min()),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+def measure(fn:Callable[[], object], repeats:int=5, warmup:int=1, items:int=1) -> dict:
+    '''
+    Calls fn repeatedly and reports latency percentiles, throughput and peak RSS.
+
+    :param fn: the operation to time, without arguments
+    :param repeats: timed calls
+    :param warmup: untimed calls before the measurement
+    :param items: units of work done by one call (patients, files, ...)
+    '''
+    for _ in range(warmup):
+        fn()
+    gc.collect()
+
+    latencies = []
+    with PeakRSS() as rss:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+
+    return {
+        "repeats": repeats,
+        "latency_ms": summarize(latencies),
+        "throughput_per_s": items * repeats / sum(latencies),
+        "peak_rss_mb": rss.peak / 2**20,
+        "rss_increase_mb": (rss.peak - rss.baseline) / 2**20,
+    }
+
+def environment() -> dict:
+    ''' Machine description stored next to the results '''
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
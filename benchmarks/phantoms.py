@@ -0,0 +1,82 @@
+'''
+Synthetic T2-like prostate phantoms.
+
+The gland is an ellipsoid centred slightly below the middle of the field of
+view, the transition zone an inner ellipsoid shifted anteriorly and the
+peripheral zone the posterior remainder of the gland. Intensities mimic a
+T2-weighted scan: bright PZ, darker TZ, intermediate surrounding tissue and
+Rician-like noise.
+'''
+from typing import Dict, NamedTuple, Tuple
+import numpy as np
+import SimpleITK as sitk
+
+
+class Geometry(NamedTuple):
+    ''' Size (x, y, z) in voxels and spacing (x, y, z) in mm '''
+    name: str
+    size: Tuple[int, int, int]
+    spacing: Tuple[float, float, float]
+
+# Typical axial T2 acquisitions of prostate mpMRI protocols
+GEOMETRIES = {
+    "320x320x20": Geometry("320x320x20", (320, 320, 20), (0.5625, 0.5625, 3.6)),
+    "384x384x24": Geometry("384x384x24", (384, 384, 24), (0.5, 0.5, 3.0)),
+    "512x512x30": Geometry("512x512x30", (512, 512, 30), (0.35, 0.35, 3.0)),
+    "256x256x24": Geometry("256x256x24", (256, 256, 24), (0.5, 0.5, 3.0)), # nnU-Net grid
+}
+
+def _ellipsoid(shape_zyx, spacing_zyx, centre_mm, radii_mm) -> np.ndarray:
+    grids = np.ogrid[tuple(slice(0, n) for n in shape_zyx)]
+    distance = 0
+    for grid, spacing, centre, radius in zip(grids, spacing_zyx, centre_mm, radii_mm):
+        distance = distance + ((grid * spacing - centre) / radius) ** 2
+    return distance <= 1.0
+
+def phantom(geometry:Geometry, seed:int=0) -> Dict[str, sitk.Image]:
+    '''
+    Returns the T2 volume and the wg, tz and pz binary masks of one phantom.
+    All images share the geometry (identity direction, zero origin).
+    '''
+    rng = np.random.default_rng(seed)
+    shape_zyx = geometry.size[::-1]
+    spacing_zyx = geometry.spacing[::-1]
+    extent = np.array(shape_zyx) * np.array(spacing_zyx)
+
+    # Gland of about 45 x 35 x 40 mm, with some jitter between phantoms
+    jitter = rng.uniform(0.9, 1.1, size=3)
+    centre = extent * np.array([0.5, 0.55, 0.5])
+    radii = np.array([20.0, 17.5, 22.5]) * jitter
+    wg = _ellipsoid(shape_zyx, spacing_zyx, centre, radii)
+    tz = _ellipsoid(shape_zyx, spacing_zyx, centre - np.array([0, radii[1] * 0.25, 0]), radii * 0.6)
+    tz &= wg
+    pz = wg & ~tz
+
+    t2 = rng.normal(300, 40, size=shape_zyx)
+    t2[pz] = rng.normal(700, 60, size=pz.sum())
+    t2[tz] = rng.normal(400, 50, size=tz.sum())
+    t2 = np.abs(t2 + rng.normal(0, 20, size=shape_zyx)).astype(np.int16)
+
+    images = {
+        "t2": sitk.GetImageFromArray(t2),
+        "wg": sitk.GetImageFromArray(wg.astype(np.uint8)),
+        "tz": sitk.GetImageFromArray(tz.astype(np.uint8)),
+        "pz": sitk.GetImageFromArray(pz.astype(np.uint8)),
+    }
+    for image in images.values():
+        image.SetSpacing(geometry.spacing)
+    return images
+
+def noisy_mask(mask:sitk.Image, seed:int=0, islands:int=20) -> sitk.Image:
+    '''
+    Adds small spurious islands to a mask, as a raw network output would have,
+    so that the connected component filtering has something to remove.
+    '''
+    rng = np.random.default_rng(seed)
+    array = sitk.GetArrayFromImage(mask)
+    for _ in range(islands):
+        z, y, x = (rng.integers(0, n - 3) for n in array.shape)
+        array[z:z + 2, y:y + 3, x:x + 3] = 1
+    noisy = sitk.GetImageFromArray(array)
+    noisy.CopyInformation(mask)
+    return noisy
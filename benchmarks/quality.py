@@ -0,0 +1,109 @@
+'''
+Accuracy check of the inference tiers against the full tier.
+
+Segments a reference set of T2 volumes with every tier and reports, per tier,
+the latency per patient and, for the wg, tz and pz masks resampled to the
+original grid, the Dice coefficient and the volume difference against the
+full tier. Needs the trained checkpoints; synthetic phantoms are no use here.
+
+    python -m benchmarks.quality --reference Pats --output quality.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from Utils import InputCheck
+from Utils.nnUnet_call import QUALITY_TIERS
+from Utils.segmentor_pipeline import Segmentor
+from benchmarks.harness import environment, summarize
+
+ZONES = ("wg", "tz", "pz")
+
+
+def dice(reference:np.ndarray, test:np.ndarray) -> float:
+    ''' Dice coefficient of two binary masks, 1.0 when both are empty '''
+    total = reference.sum() + test.sum()
+    if total == 0:
+        return 1.0
+    return float(2 * np.logical_and(reference, test).sum() / total)
+
+def volume_ml(mask:sitk.Image) -> float:
+    return float(sitk.GetArrayViewFromImage(mask).astype(bool).sum() * np.prod(mask.GetSpacing()) / 1000)
+
+def segment_all(tier:str, pats:dict) -> tuple:
+    ''' Masks on the original grid and latencies of one tier, models loaded before timing '''
+    segmentor = Segmentor(tier=tier)
+    segmentor.load_models()
+    masks, latencies = {}, []
+    for key, image in pats.items():
+        start = time.perf_counter()
+        resampled = segmentor.segment(image)["Resampled"]
+        latencies.append(time.perf_counter() - start)
+        masks[key] = {zone: resampled[f"{zone}_binary"] for zone in ZONES}
+    return masks, latencies
+
+def compare(reference:dict, test:dict) -> dict:
+    ''' Per patient Dice and volume difference of every zone '''
+    patients = {}
+    for key, masks in reference.items():
+        patients[key] = {}
+        for zone in ZONES:
+            ref_volume, test_volume = volume_ml(masks[zone]), volume_ml(test[key][zone])
+            patients[key][zone] = {
+                "dice": dice(sitk.GetArrayViewFromImage(masks[zone]).astype(bool),
+                             sitk.GetArrayViewFromImage(test[key][zone]).astype(bool)),
+                "volume_ml": test_volume,
+                "volume_diff_ml": test_volume - ref_volume,
+                "volume_diff_pct": 100 * (test_volume - ref_volume) / ref_volume if ref_volume else 0.0,
+            }
+    summary = {}
+    for zone in ZONES:
+        dices = [patient[zone]["dice"] for patient in patients.values()]
+        diffs = [abs(patient[zone]["volume_diff_pct"]) for patient in patients.values()]
+        summary[zone] = {
+            "dice_mean": float(np.mean(dices)),
+            "dice_min": float(np.min(dices)),
+            "abs_volume_diff_pct_mean": float(np.mean(diffs)),
+            "abs_volume_diff_pct_max": float(np.max(diffs)),
+        }
+    return {"summary": summary, "patients": patients}
+
+def run_check(reference_dir:str, tiers) -> dict:
+    files = sorted(
+        os.path.join(dirpath, file)
+        for dirpath, _, names in os.walk(reference_dir)
+        for file in names if file.endswith(".nii.gz")
+    )
+    if not files:
+        raise AttributeError(f"No .nii.gz file was found in {reference_dir}")
+    pats = InputCheck.load_nii_gz_files(files)
+
+    masks, results = {}, {}
+    for tier in ["full"] + [tier for tier in tiers if tier != "full"]:
+        masks[tier], latencies = segment_all(tier, pats)
+        results[tier] = {"settings": QUALITY_TIERS[tier]._asdict(), "latency_ms": summarize(latencies)}
+        if tier != "full":
+            results[tier].update(compare(masks["full"], masks[tier]))
+            results[tier]["speedup"] = results["full"]["latency_ms"]["mean"] / results[tier]["latency_ms"]["mean"]
+            worst = min(results[tier]["summary"][zone]["dice_min"] for zone in ZONES)
+            print(f"{tier:>9} x{results[tier]['speedup']:5.2f}  worst Dice vs full {worst:.4f}", file=sys.stderr)
+    return {"environment": environment(), "patients": len(pats), "tiers": results}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Dice and volume differences of the inference tiers against full")
+    parser.add_argument("--reference", required=True, help="folder with the reference T2 .nii.gz volumes")
+    parser.add_argument("--tiers", nargs="+", default=list(QUALITY_TIERS), choices=list(QUALITY_TIERS))
+    parser.add_argument("--output", default=None, help="JSON file for the results, stdout if omitted")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_check(args.reference, args.tiers)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
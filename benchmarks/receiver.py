@@ -0,0 +1,97 @@
+'''
+End to end latency of the C-STORE input path.
+
+Sends the dicom series of a folder (the sample Pats/dicom_dataset studies by
+default) to a running listener, one association per series, then waits for
+the receive_to_seg records the daemon writes once the SEG of each series is
+stored, and reports the latency from the last instance received.
+
+    python __main__.py --listen 11112 --streaming &
+    python -m benchmarks.receiver --port 11112 --series Pats/dicom_dataset --output receiver.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+from pydicom import dcmread
+from benchmarks.harness import environment, summarize
+
+
+def series_dirs(folder:str) -> list:
+    return sorted(dirpath for dirpath, _, files in os.walk(folder) if any(file.endswith(".dcm") for file in files))
+
+def send_series(series_dir:str, host:str, port:int, ae_title:str) -> dict:
+    ''' C-STORE of every instance of a series on one association '''
+    from pynetdicom import AE
+    from pynetdicom.sop_class import MRImageStorage
+
+    ae = AE(ae_title="SEGMENTOR_SCU")
+    ae.add_requested_context(MRImageStorage)
+    datasets = [dcmread(os.path.join(series_dir, file)) for file in sorted(os.listdir(series_dir)) if file.endswith(".dcm")]
+    start = time.time()
+    assoc = ae.associate(host, port, ae_title=ae_title)
+    if not assoc.is_established:
+        raise ConnectionError(f"Association with {ae_title}@{host}:{port} rejected or aborted")
+    failed = 0
+    for dataset in datasets:
+        status = assoc.send_c_store(dataset)
+        failed += not status or status.Status != 0x0000
+    assoc.release()
+    return {"series": series_dir, "instances": len(datasets), "failed": failed,
+            "series_uid": str(datasets[0].SeriesInstanceUID), "sent_s": time.time() - start}
+
+def wait_latencies(metrics_path:str, sent:list, since:float, timeout:float) -> dict:
+    ''' receive_to_seg records of the sent series, by series UID (the last directory of the received path) '''
+    expected = {item["series_uid"] for item in sent}
+    found = {}
+    deadline = time.time() + timeout
+    while time.time() < deadline and expected - found.keys():
+        if os.path.exists(metrics_path):
+            with open(metrics_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    record = json.loads(line)
+                    if record["stage"] != "receive_to_seg" or record["start"] < since:
+                        continue
+                    series_uid = os.path.basename(record["patient"])
+                    if series_uid in expected:
+                        found[series_uid] = record["wall_s"]
+        time.sleep(1.0)
+    return found
+
+def run_benchmark(folder:str, host:str, port:int, ae_title:str, metrics_path:str, timeout:float) -> dict:
+    since = time.time()
+    sent = [send_series(series_dir, host, port, ae_title) for series_dir in series_dirs(folder)]
+    for item in sent:
+        print(f"{item['series']}: {item['instances']} instances sent in {item['sent_s']:.2f} s", file=sys.stderr)
+    latencies = wait_latencies(metrics_path, sent, since, timeout)
+    missing = sorted({item["series_uid"] for item in sent} - latencies.keys())
+    if missing:
+        print(f"No SEG stored within {timeout} s for {missing}", file=sys.stderr)
+    return {
+        "environment": environment(),
+        "series": sent,
+        "receive_to_seg_s": latencies,
+        "latency_ms": summarize(list(latencies.values())) if latencies else None,
+        "missing": missing,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Latency from the last instance received to the SEG stored")
+    parser.add_argument("--series", default=os.path.join("Pats", "dicom_dataset"), help="folder with the series to send")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11112)
+    parser.add_argument("--ae-title", default="SEGMENTOR", help="AE title of the listener")
+    parser.add_argument("--metrics", default=os.path.join("Outputs", "metrics.jsonl"), help="metrics.jsonl of the daemon")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds to wait for the SEGs")
+    parser.add_argument("--output", default=None, help="JSON file for the results, stdout if omitted")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmark(args.series, args.host, args.port, args.ae_title, args.metrics, args.timeout)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
@@ -0,0 +1,153 @@
+'''
+Compares the resource governor with the previous defaults (torch and SimpleITK
+at their default thread counts, two nnU-Net preprocessing and two export
+processes) on a synthetic workload shaped like the segmentor:
+
+    batch      predict_from_files: a process pool preprocesses the cohort, the
+               main process runs sliding window forward passes, a second pool
+               resamples and exports the predictions
+    streaming  preprocessing, two models and post-processing run concurrently
+               on different patients
+
+The network is a small 3D conv stack standing in for the nnU-Net, so that the
+benchmark runs without the checkpoints. Every configuration runs in a fresh
+process, torch and SimpleITK thread pools are process wide.
+
+    python -m benchmarks.resources --patients 8 --output resources.json
+'''
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+from benchmarks.harness import environment
+from benchmarks.phantoms import GEOMETRIES, noisy_mask, phantom
+
+
+PATCH = (24, 128, 128) # z, y, x
+NN_GRID = GEOMETRIES["256x256x24"]
+
+def _network(torch):
+    return torch.nn.Sequential(
+        torch.nn.Conv3d(1, 32, 3, padding=1), torch.nn.LeakyReLU(),
+        torch.nn.Conv3d(32, 32, 3, padding=1), torch.nn.LeakyReLU(),
+        torch.nn.Conv3d(32, 3, 1),
+    ).eval()
+
+def _sliding_window(torch, network, array:np.ndarray) -> np.ndarray:
+    ''' Forward passes over half overlapping patches, as nnU-Net with tile_step_size=0.5 '''
+    data = torch.from_numpy(array[None, None].astype(np.float32))
+    logits = torch.zeros((3, *array.shape))
+    steps = [range(0, max(1, n - p + 1), max(1, p // 2)) for n, p in zip(array.shape, PATCH)]
+    with torch.inference_mode():
+        for z in steps[0]:
+            for y in steps[1]:
+                for x in steps[2]:
+                    window = (slice(z, z + PATCH[0]), slice(y, y + PATCH[1]), slice(x, x + PATCH[2]))
+                    logits[(slice(None), *window)] += network(data[(slice(None), slice(None), *window)])[0]
+    return logits.softmax(0).numpy()
+
+def _preprocess(seed:int) -> np.ndarray:
+    from Utils import ImageProcessor
+    t2 = phantom(GEOMETRIES["384x384x24"], seed)["t2"]
+    return sitk.GetArrayFromImage(ImageProcessor.ImageProcessing(t2))
+
+def _export(probs:np.ndarray, seed:int):
+    from Utils import ImageProcessor, helpers
+    images = phantom(GEOMETRIES["384x384x24"], seed)
+    nn_grid = phantom(NN_GRID, seed)
+    mask = ImageProcessor.remove_small_components(noisy_mask(nn_grid["wg"], seed))
+    helpers.resample_to_original(mask, images["t2"])
+    for channel in probs:
+        image = sitk.GetImageFromArray(channel)
+        image.CopyInformation(nn_grid["wg"])
+        helpers.resample_to_original(image, images["t2"])
+
+def _batch(torch, network, patients:int, preprocessing_workers:int, export_workers:int):
+    context = multiprocessing.get_context("spawn") # as nnU-Net
+    with ProcessPoolExecutor(preprocessing_workers, mp_context=context) as preprocessing, \
+         ProcessPoolExecutor(export_workers, mp_context=context) as export:
+        inputs = [preprocessing.submit(_preprocess, seed) for seed in range(patients)]
+        exports = [export.submit(_export, _sliding_window(torch, network, future.result()), seed)
+                   for seed, future in enumerate(inputs)]
+        for future in exports:
+            future.result()
+
+def _streaming(torch, network, patients:int):
+    from Utils.segmentor_pipeline import stream_stages
+    def preprocessing(key, _):
+        return _preprocess(key)
+    def wg_inference(key, array):
+        return _sliding_window(torch, network, array)
+    def postprocessing(key, probs):
+        _export(probs, key)
+        return _preprocess(key)
+    def zones_inference(key, array):
+        return _sliding_window(torch, network, array)
+    def zones_postprocessing(key, probs):
+        _export(probs, key)
+    stages = [preprocessing, wg_inference, postprocessing, zones_inference, zones_postprocessing]
+    for _ in stream_stages(((seed, None) for seed in range(patients)), stages):
+        pass
+
+def _run(config:dict) -> dict:
+    ''' Runs one configuration, in its own process '''
+    import torch
+    from Utils.resources import ResourceGovernor
+    torch.manual_seed(0)
+    network = _network(torch)
+    workers = (2, 2)
+    if config["governed"]:
+        governor = ResourceGovernor(cpus=config["cpus"])
+        plan = governor.apply("batch_inference" if config["mode"] == "batch" else "streaming")
+        workers = (plan.preprocessing_workers, plan.export_workers)
+        config["plan"] = plan._asdict()
+    else:
+        config["plan"] = {"torch_threads": torch.get_num_threads(),
+                          "sitk_threads": sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+                          "preprocessing_workers": workers[0], "export_workers": workers[1]}
+
+    start = time.perf_counter()
+    if config["mode"] == "batch":
+        _batch(torch, network, config["patients"], *workers)
+    else:
+        _streaming(torch, network, config["patients"])
+    wall = time.perf_counter() - start
+    config.update({"wall_s": wall, "patients_per_min": 60 * config["patients"] / wall})
+    return config
+
+def run_benchmarks(modes, patients:int, cpus:int=None) -> dict:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for mode in modes:
+        for governed in (False, True):
+            config = {"mode": mode, "governed": governed, "patients": patients, "cpus": cpus}
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(_run, config).result()
+            print(f"{mode:>10} {'governor' if governed else 'defaults':>9} {result['wall_s']:8.2f} s"
+                  f"  {result['patients_per_min']:6.2f} patients/min", file=sys.stderr)
+            results.append(result)
+    for mode in modes:
+        defaults, governed = [r for r in results if r["mode"] == mode]
+        governed["speedup"] = defaults["wall_s"] / governed["wall_s"]
+    return {"environment": environment(), "results": results}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Resource governor against the previous thread and worker defaults")
+    parser.add_argument("--modes", nargs="+", default=["batch", "streaming"], choices=["batch", "streaming"])
+    parser.add_argument("--patients", type=int, default=8)
+    parser.add_argument("--cpus", type=int, default=None, help="cores given to the governor, all available if omitted")
+    parser.add_argument("--output", default=None, help="JSON file for the results, stdout if omitted")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmarks(args.modes, args.patients, args.cpus)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
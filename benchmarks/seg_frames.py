@@ -0,0 +1,234 @@
+'''
+Per-frame functional groups of the DICOM-SEG writer: the templated builder
+against the previous one, which built every sub-sequence of every frame.
+
+Runs on synthetic reference series of 24 to 200 slices, for the combined SEG
+(three segments, empty slices dropped) and the single segment exports (every
+slice kept). Both builders are encoded as explicit VR little endian and the
+bytes must be equal before anything is timed.
+
+The enhanced T2 export (--t2-export enhanced) is checked against the Enhanced
+MR Image IOD first: the type 1 and 2 attributes of its modules and the
+mandatory functional group macros are read back from the written file, and
+dciodvfy (dicom3tools) is run on it when it is on the PATH.
+
+    python -m benchmarks.seg_frames --slices 24 50 100 200 --output seg_frames.json
+'''
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import SimpleITK as sitk
+from pydicom import Dataset, dcmread
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+from Utils.nifti2dicomseg import clean_zero_slices, clear_overlapping, per_frame_group
+from Utils.nifti2dicom import _series_tags, _write_enhanced
+from benchmarks.harness import environment, measure
+
+ZONES = ("wg", "pz", "tz")
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+# Type of the attributes of the Enhanced MR Image IOD modules, for DERIVED frames
+# (the MR Pulse Sequence module and the MR acquisition macros are conditional on ORIGINAL or MIXED)
+ENHANCED_MR_MODULES = {
+    "Patient": {"PatientName": 2, "PatientID": 2, "PatientBirthDate": 2, "PatientSex": 2},
+    "General Study": {"StudyInstanceUID": 1, "StudyDate": 2, "StudyTime": 2, "ReferringPhysicianName": 2,
+                      "StudyID": 2, "AccessionNumber": 2},
+    "General Series": {"Modality": 1, "SeriesInstanceUID": 1, "SeriesNumber": 2},
+    "Frame of Reference": {"FrameOfReferenceUID": 1, "PositionReferenceIndicator": 2},
+    "Enhanced General Equipment": {"Manufacturer": 1, "ManufacturerModelName": 1, "DeviceSerialNumber": 1,
+                                   "SoftwareVersions": 1},
+    "Image Pixel": {"SamplesPerPixel": 1, "PhotometricInterpretation": 1, "Rows": 1, "Columns": 1,
+                    "BitsAllocated": 1, "BitsStored": 1, "HighBit": 1, "PixelRepresentation": 1, "PixelData": 1},
+    "Multi-frame Functional Groups": {"SharedFunctionalGroupsSequence": 2, "PerFrameFunctionalGroupsSequence": 1,
+                                      "InstanceNumber": 1, "ContentDate": 1, "ContentTime": 1, "NumberOfFrames": 1},
+    "Multi-frame Dimension": {"DimensionOrganizationSequence": 1, "DimensionIndexSequence": 1},
+    "Acquisition Context": {"AcquisitionContextSequence": 2},
+    "Enhanced MR Image": {"ImageType": 1, "ContentQualification": 1, "PixelPresentation": 1,
+                          "VolumetricProperties": 1, "VolumeBasedCalculationTechnique": 1,
+                          "ComplexImageComponent": 1, "AcquisitionContrast": 1, "BurnedInAnnotation": 1,
+                          "LossyImageCompression": 1, "PresentationLUTShape": 1},
+    "SOP Common": {"SOPClassUID": 1, "SOPInstanceUID": 1},
+}
+# Mandatory functional group macros, in the shared groups or in every per-frame group
+ENHANCED_MR_MACROS = {
+    "PixelMeasuresSequence": {"PixelSpacing": 1, "SliceThickness": 1},
+    "FrameContentSequence": {"StackID": 1, "InStackPositionNumber": 1, "DimensionIndexValues": 1},
+    "PlanePositionSequence": {"ImagePositionPatient": 1},
+    "PlaneOrientationSequence": {"ImageOrientationPatient": 1},
+    "FrameAnatomySequence": {"AnatomicRegionSequence": 1, "FrameLaterality": 1},
+    "PixelValueTransformationSequence": {"RescaleIntercept": 1, "RescaleSlope": 1, "RescaleType": 1},
+    "MRImageFrameTypeSequence": {"FrameType": 1, "PixelPresentation": 1, "VolumetricProperties": 1,
+                                 "VolumeBasedCalculationTechnique": 1, "ComplexImageComponent": 1,
+                                 "AcquisitionContrast": 1},
+}
+
+
+def previous_per_frame_group(reference_ds_list, seg_dict) -> Sequence:
+    ''' The builder before the templates, kept as the reference output '''
+    purpose_ds = Dataset()
+    purpose_ds.CodeValue = '121322'
+    purpose_ds.CodingSchemeDesignator = 'DCM'
+    purpose_ds.CodeMeaning = 'Source image for image processing operation'
+
+    derivation_code = Dataset()
+    derivation_code.CodeValue = '113076'
+    derivation_code.CodingSchemeDesignator = 'DCM'
+    derivation_code.CodeMeaning = 'Segmentation'
+
+    def frame_dataset(frame_dict, slice_index, dataset):
+        per_frame = Dataset()
+        derivation_image = Dataset()
+        source_image = Dataset()
+        source_image.ReferencedSOPClassUID = dataset.SOPClassUID
+        source_image.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
+        source_image.PurposeOfReferenceCodeSequence = Sequence([purpose_ds])
+        derivation_image.SourceImageSequence = Sequence([source_image])
+        derivation_image.DerivationCodeSequence = Sequence([derivation_code])
+        dim_index = Dataset()
+        dim_index.DimensionIndexValues = [frame_dict["label"], slice_index]
+        per_frame.FrameContentSequence = Sequence([dim_index])
+        img_position = Dataset()
+        img_position.ImagePositionPatient = dataset.ImagePositionPatient
+        per_frame.PlanePositionSequence = Sequence([img_position])
+        ref_segment_num = Dataset()
+        ref_segment_num.ReferencedSegmentNumber = frame_dict["label"]
+        per_frame.SegmentIdentificationSequence = Sequence([ref_segment_num])
+        per_frame.DerivationImageSequence = Sequence([derivation_image])
+        return per_frame
+
+    per_frame_sequence = Sequence()
+    for value in seg_dict.values():
+        if "seg_index" in value:
+            for idx in value["seg_index"]:
+                per_frame_sequence.append(frame_dataset(value, idx, reference_ds_list[idx]))
+        else:
+            for idx, dataset in enumerate(reference_ds_list):
+                per_frame_sequence.append(frame_dataset(value, idx, dataset))
+    return per_frame_sequence
+
+def reference_series(slices:int) -> list:
+    ''' Headers of an axial series of 3 mm slices, as the SEG writer reads them '''
+    datasets = []
+    for index in range(slices):
+        dataset = Dataset()
+        dataset.SOPClassUID = MR_IMAGE_STORAGE
+        dataset.SOPInstanceUID = generate_uid()
+        dataset.ImagePositionPatient = [-95.0, -80.5, -36.0 + 3.0 * index]
+        datasets.append(dataset)
+    return datasets
+
+def segmentations(slices:int, single_seg:str="") -> dict:
+    ''' Masks with the gland over the middle 60% of the slices, prepared as write_seg does '''
+    shape = (slices, 32, 32)
+    gland = np.zeros(shape, dtype=np.uint8)
+    gland[int(0.2 * slices):int(0.8 * slices), 8:24, 8:24] = 1
+    tz = np.zeros(shape, dtype=np.uint8)
+    tz[int(0.3 * slices):int(0.7 * slices), 12:20, 12:20] = 1
+    seg_dict = {"wg": {"array": gland}, "pz": {"array": gland & (1 - tz)}, "tz": {"array": tz}}
+    if single_seg:
+        seg_dict = {single_seg: seg_dict[single_seg]}
+    else:
+        seg_dict = clean_zero_slices(clear_overlapping(seg_dict))
+    for label, value in enumerate(seg_dict.values(), start=1):
+        value["label"] = label
+    return seg_dict
+
+def missing_attributes(dataset:Dataset, attributes:dict, where:str) -> list:
+    ''' Type 1 attributes absent or empty and type 2 attributes absent '''
+    missing = []
+    for keyword, kind in attributes.items():
+        if keyword not in dataset:
+            missing.append(f"{where}: {keyword} (type {kind}) absent")
+        elif kind == 1 and dataset[keyword].is_empty:
+            missing.append(f"{where}: {keyword} (type 1) empty")
+    return missing
+
+def enhanced_t2_problems(dataset:Dataset) -> list:
+    ''' Required attributes of the Enhanced MR Image IOD missing from an enhanced T2 export '''
+    problems = []
+    for module, attributes in ENHANCED_MR_MODULES.items():
+        problems += missing_attributes(dataset, attributes, module)
+    shared = dataset.SharedFunctionalGroupsSequence[0] if dataset.get("SharedFunctionalGroupsSequence") else Dataset()
+    per_frame = dataset.get("PerFrameFunctionalGroupsSequence") or []
+    if len(per_frame) != int(dataset.get("NumberOfFrames") or 0):
+        problems.append(f"{len(per_frame)} per-frame functional groups for {dataset.get('NumberOfFrames')} frames")
+    for macro, attributes in ENHANCED_MR_MACROS.items():
+        if macro in shared:
+            problems += missing_attributes(shared[macro][0], attributes, f"shared {macro}")
+        elif per_frame and all(macro in group for group in per_frame):
+            for index, group in enumerate(per_frame, start=1):
+                problems += missing_attributes(group[macro][0], attributes, f"frame {index} {macro}")
+        else:
+            problems.append(f"{macro} neither shared nor in every frame")
+    return problems
+
+def validate_enhanced_t2(slices:int) -> dict:
+    ''' Writes a synthetic T2 as the enhanced export does and checks it against the IOD '''
+    image = sitk.GetImageFromArray(np.random.default_rng(slices).integers(0, 1200, (slices, 64, 64), dtype=np.int16))
+    image.SetSpacing((0.5, 0.5, 3.0))
+    with tempfile.TemporaryDirectory() as output_name:
+        _write_enhanced(image, _series_tags(image), output_name)
+        path = os.path.join(output_name, "image.dcm")
+        problems = enhanced_t2_problems(dcmread(path))
+        dciodvfy = None
+        if shutil.which("dciodvfy"):
+            run = subprocess.run(["dciodvfy", path], capture_output=True, text=True)
+            dciodvfy = [line for line in run.stderr.splitlines() if line.startswith("Error")]
+            problems += dciodvfy
+    return {"slices": slices, "problems": problems, "dciodvfy": dciodvfy is not None}
+
+def encode(sequence:Sequence) -> bytes:
+    dataset = Dataset()
+    dataset.PerFrameFunctionalGroupsSequence = sequence
+    buffer = DicomBytesIO()
+    buffer.is_little_endian = True
+    buffer.is_implicit_VR = False
+    write_dataset(buffer, dataset)
+    return buffer.getvalue()
+
+def run_benchmarks(slice_counts, repeats:int, warmup:int) -> dict:
+    results, validation = [], []
+    for slices in slice_counts:
+        check = validate_enhanced_t2(slices)
+        if check["problems"]:
+            raise AssertionError(f"Enhanced T2 of {slices} slices is not a valid Enhanced MR Image:\n"
+                                 + "\n".join(check["problems"]))
+        validation.append(check)
+        reference = reference_series(slices)
+        for single_seg in ("",) + ZONES:
+            seg_dict = segmentations(slices, single_seg)
+            if encode(per_frame_group(reference, seg_dict)) != encode(previous_per_frame_group(reference, seg_dict)):
+                raise AssertionError(f"Per-frame groups differ for {slices} slices, segment {single_seg or 'all'}")
+            frames = len(per_frame_group(reference, seg_dict))
+            row = {"slices": slices, "segment": single_seg or "all", "frames": frames, "byte_equal": True}
+            for name, builder in (("previous", previous_per_frame_group), ("templated", per_frame_group)):
+                row[name] = measure(lambda: builder(reference, seg_dict), repeats=repeats, warmup=warmup, items=frames)
+            row["speedup"] = row["previous"]["latency_ms"]["mean"] / row["templated"]["latency_ms"]["mean"]
+            print(f"{slices:>4} slices {row['segment']:>3} {frames:>4} frames  x{row['speedup']:5.2f}", file=sys.stderr)
+            results.append(row)
+    return {"environment": environment(), "enhanced_t2": validation, "results": results}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Templated per-frame functional groups against the previous builder")
+    parser.add_argument("--slices", nargs="+", type=int, default=[24, 50, 100, 200])
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", default=None, help="JSON file for the results, stdout if omitted")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = run_benchmarks(args.slices, args.repeats, args.warmup)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
@@ -0,0 +1,178 @@
+'''
+Times the hot paths of the segmentor in isolation on synthetic phantoms.
+
+Every stage runs on every selected geometry; the results are written as one
+JSON document with latency percentiles, throughput and peak RSS per stage.
+
+    python -m benchmarks.stages --geometries 384x384x24 512x512x30 --repeats 10 --output bench.json
+'''
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from contextlib import contextmanager
+import SimpleITK as sitk
+from Utils import ImageProcessor, helpers
+from Utils.nifti2dicom import nifti2dicom
+from Utils.nifti2dicomseg import array2bits, clean_zero_slices, clear_overlapping, nifti2dicomseg_all
+from Utils.ImportDicomFiles import upload
+from benchmarks.harness import environment, measure
+from benchmarks.phantoms import GEOMETRIES, noisy_mask, phantom
+from benchmarks.stub_orthanc import StubOrthanc
+
+
+@contextmanager
+def workspace():
+    ''' Runs inside a temporary directory, the exporters write relative to the cwd '''
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix="segmentor_bench_")
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path, ignore_errors=True)
+
+def _write_case(images:dict, folder:str) -> dict:
+    ''' Writes the phantom as the pipeline would leave it for the exporters '''
+    seg_dir = os.path.join(folder, "Resampled")
+    os.makedirs(seg_dir, exist_ok=True)
+    t2_path = os.path.join(folder, "t2.nii.gz")
+    sitk.WriteImage(images["t2"], t2_path)
+    for zone in ("wg", "tz", "pz"):
+        sitk.WriteImage(images[zone], os.path.join(seg_dir, f"{zone}_binary.nii.gz"))
+    return {"t2": t2_path, "seg_dir": seg_dir}
+
+def _seg_dict(images:dict) -> dict:
+    seg_dict = {zone: {"array": sitk.GetArrayFromImage(images[zone])} for zone in ("wg", "pz", "tz")}
+    seg_dict = clear_overlapping(seg_dict)
+    return clean_zero_slices(seg_dict)
+
+def stage_image_processing(images, case, options):
+    return lambda: ImageProcessor.ImageProcessing(images["t2"]), 1
+
+def stage_process_mask(images, case, options):
+    mask = noisy_mask(images["wg"])
+    return lambda: ImageProcessor.process_mask(mask), 1
+
+def stage_mask_dilation(images, case, options):
+    return lambda: ImageProcessor.mask_dilation(images["wg"]), 1
+
+def stage_remove_small_components(images, case, options):
+    mask = noisy_mask(images["wg"])
+    return lambda: ImageProcessor.remove_small_components(mask), 1
+
+def _nn_grid_outputs() -> dict:
+    ''' The six masks and probability maps of a patient, on the nnU-Net 256x256x24 grid '''
+    nn_grid = phantom(GEOMETRIES["256x256x24"])
+    outputs = {}
+    for zone in ("wg", "tz", "pz"):
+        outputs[f"{zone}_binary"] = nn_grid[zone]
+        outputs[f"{zone}_probs"] = sitk.SmoothingRecursiveGaussian(sitk.Cast(nn_grid[zone], sitk.sitkFloat32), 1.0)
+    return outputs
+
+def _sitk_resample(outputs:dict, original:sitk.Image) -> dict:
+    return {name: sitk.Resample(image, original, sitk.Transform(), sitk.sitkNearestNeighbor)
+            for name, image in outputs.items()}
+
+def stage_resample_sitk(images, case, options):
+    # one sitk.Resample per output, as before the shared resampling plan
+    outputs = _nn_grid_outputs()
+    return lambda: _sitk_resample(outputs, images["t2"]), 1
+
+def stage_resample_to_original(images, case, options):
+    outputs = _nn_grid_outputs()
+    expected = _sitk_resample(outputs, images["t2"])
+    for name, image in helpers.resample_all_to_original(outputs, images["t2"]).items():
+        if not (sitk.GetArrayViewFromImage(image).tobytes() == sitk.GetArrayViewFromImage(expected[name]).tobytes()
+                and image.GetPixelID() == expected[name].GetPixelID()
+                and (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+                == (expected[name].GetSize(), expected[name].GetSpacing(), expected[name].GetOrigin(),
+                    expected[name].GetDirection())):
+            raise AssertionError(f"Resampling plan differs from sitk.Resample for {name}")
+    return lambda: helpers.resample_all_to_original(outputs, images["t2"]), 1
+
+def stage_nifti2dicom(images, case, options):
+    return lambda: nifti2dicom(case["t2"]), images["t2"].GetDepth()
+
+def stage_nifti2dicom_enhanced(images, case, options):
+    return lambda: nifti2dicom(case["t2"], mode="enhanced"), images["t2"].GetDepth()
+
+def stage_nifti2dicomseg(images, case, options):
+    t2_dir = nifti2dicom(case["t2"]).path
+    return lambda: nifti2dicomseg_all(case["seg_dir"], t2_dir, ("", "wg", "pz", "tz")), 1
+
+def stage_nifti2dicomseg_in_memory(images, case, options):
+    # headers of the reference series from nifti2dicom, nothing read back
+    t2_series = nifti2dicom(case["t2"])
+    return lambda: nifti2dicomseg_all(case["seg_dir"], t2_series, ("", "wg", "pz", "tz")), 1
+
+def stage_array2bits(images, case, options):
+    seg_dict = _seg_dict(images)
+    return lambda: array2bits(seg_dict), 1
+
+def stage_upload(images, case, options):
+    t2_dir = nifti2dicom(case["t2"]).path
+    files = len([x for x in os.listdir(t2_dir) if x.endswith(".dcm")])
+    server = options["server"]
+    def run():
+        upload(t2_dir, workers=options["upload_workers"], ip="127.0.0.1", port=server.port,
+               username="bench", password="bench")
+    return run, files
+
+STAGES = {
+    "ImageProcessing": stage_image_processing,
+    "process_mask": stage_process_mask,
+    "mask_dilation": stage_mask_dilation,
+    "remove_small_components": stage_remove_small_components,
+    "resample_sitk": stage_resample_sitk,
+    "resample_to_original": stage_resample_to_original,
+    "nifti2dicom": stage_nifti2dicom,
+    "nifti2dicom_enhanced": stage_nifti2dicom_enhanced,
+    "nifti2dicomseg": stage_nifti2dicomseg,
+    "nifti2dicomseg_in_memory": stage_nifti2dicomseg_in_memory,
+    "array2bits": stage_array2bits,
+    "upload": stage_upload,
+}
+
+def run_benchmarks(stages, geometries, repeats:int, warmup:int, upload_workers:int, upload_latency:float) -> dict:
+    results = []
+    with StubOrthanc(latency=upload_latency) as server, workspace() as path:
+        options = {"server": server, "upload_workers": upload_workers}
+        for geometry_name in geometries:
+            geometry = GEOMETRIES[geometry_name]
+            images = phantom(geometry)
+            case = _write_case(images, os.path.join(path, geometry_name))
+            for stage in stages:
+                fn, items = STAGES[stage](images, case, options)
+                result = measure(fn, repeats=repeats, warmup=warmup, items=items)
+                result.update({"stage": stage, "geometry": geometry_name, "items_per_call": items})
+                print(f"{stage:>24} {geometry_name:>12} p50 {result['latency_ms']['p50']:9.2f} ms"
+                      f"  peak {result['peak_rss_mb']:8.1f} MB", file=sys.stderr)
+                results.append(result)
+    return {"environment": environment(), "results": results}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stage benchmarks on synthetic prostate phantoms")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--geometries", nargs="+", default=["320x320x20", "384x384x24"], choices=list(GEOMETRIES))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--upload-workers", type=int, default=8)
+    parser.add_argument("--upload-latency", type=float, default=0.002,
+                        help="seconds the stub orthanc waits per request")
+    parser.add_argument("--output", default=None, help="JSON file for the results, stdout if omitted")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    report = run_benchmarks(args.stages, args.geometries, args.repeats, args.warmup,
+                            args.upload_workers, args.upload_latency)
+    if output:
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
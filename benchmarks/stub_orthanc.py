@@ -0,0 +1,72 @@
+'''
+Local HTTP stand-in for the Orthanc REST API, enough for the uploader.
+Accepts POST /instances, answers 200 and counts the received instances.
+Error statuses can be scripted to exercise the retries.
+'''
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, as Orthanc
+
+    def do_POST(self):
+        length = int(self.headers.get("content-length", 0))
+        self.rfile.read(length)
+        delay = self.server.latency
+        if delay:
+            threading.Event().wait(delay)
+        with self.server.lock:
+            self.server.requests += 1
+            status = self.server.responses.pop(0) if self.server.responses else 200
+            self.server.received += status == 200
+        body = b'{"Status": "Success"}' if status == 200 else b'{"Status": "Failure"}'
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubOrthanc:
+    '''
+    Context manager running the stub server on a free local port.
+
+    :param latency: seconds each request waits before answering, to emulate
+                    the network and storage time of a real server.
+    :param responses: statuses of the first requests, in order, 200 afterwards
+    '''
+
+    def __init__(self, latency:float=0.0, responses=()):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.responses = list(responses)
+        self.server.requests = 0
+        self.server.received = 0
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    @property
+    def received(self) -> int:
+        ''' Instances accepted with a 200 '''
+        return self.server.received
+
+    @property
+    def requests(self) -> int:
+        ''' Every request, the failed ones included '''
+        return self.server.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
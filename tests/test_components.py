@@ -0,0 +1,82 @@
+'''
+remove_small_components against the per-label implementation it replaced.
+
+    python -m pytest tests
+'''
+import unittest
+import numpy as np
+import SimpleITK as sitk
+from Utils import ImageProcessor
+
+
+def baseline_remove_small_components(mask, keep_largest_only=True, size_threshold=None):
+    ''' ConnectedComponent, label statistics and one BinaryThreshold + Or per kept label '''
+    labeled_mask = sitk.ConnectedComponent(mask)
+    label_stats = sitk.LabelShapeStatisticsImageFilter()
+    label_stats.Execute(labeled_mask)
+    if keep_largest_only:
+        labels_to_keep = [label_stats.GetLabels()[0]]
+    else:
+        labels_to_keep = [label for label in label_stats.GetLabels()
+                          if label_stats.GetNumberOfPixels(label) >= size_threshold]
+    output_image = sitk.Image(mask.GetSize(), sitk.sitkUInt8)
+    output_image.CopyInformation(mask)
+    for label in labels_to_keep:
+        component = sitk.BinaryThreshold(labeled_mask, lowerThreshold=label, upperThreshold=label,
+                                         insideValue=1, outsideValue=0)
+        output_image = sitk.Or(output_image, component)
+    return output_image
+
+def mask_image(array:np.ndarray) -> sitk.Image:
+    image = sitk.GetImageFromArray(array.astype(np.uint8))
+    image.SetSpacing((0.5, 0.5, 3.0))
+    image.SetOrigin((-32.0, -30.0, -36.0))
+    return image
+
+
+class RemoveSmallComponentsTest(unittest.TestCase):
+
+    def setUp(self):
+        # components of 8, 54, 1 and 27 voxels, in this raster order (z first)
+        array = np.zeros((8, 16, 16), dtype=np.uint8)
+        array[0:2, 0:2, 0:2] = 1
+        array[2:8, 6:9, 6:9] = 1
+        array[3, 14, 14] = 1
+        array[4:7, 11:14, 0:3] = 1
+        self.mask = mask_image(array)
+
+    def assert_same_output(self, output:sitk.Image, expected:sitk.Image):
+        self.assertEqual(output.GetPixelID(), expected.GetPixelID())
+        self.assertEqual((output.GetSize(), output.GetSpacing(), output.GetOrigin(), output.GetDirection()),
+                         (expected.GetSize(), expected.GetSpacing(), expected.GetOrigin(), expected.GetDirection()))
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(output), sitk.GetArrayViewFromImage(expected))
+
+    def test_size_threshold_matches_baseline(self):
+        for size_threshold in (0, 1, 2, 8, 9, 27, 28, 54, 55):
+            with self.subTest(size_threshold=size_threshold):
+                self.assert_same_output(
+                    ImageProcessor.remove_small_components(self.mask, False, size_threshold),
+                    baseline_remove_small_components(self.mask, False, size_threshold))
+
+    def test_keep_largest_matches_baseline(self):
+        output = ImageProcessor.remove_small_components(self.mask)
+        self.assert_same_output(output, baseline_remove_small_components(self.mask))
+        # as it always did, the component met first in raster order is kept, not the biggest one
+        self.assertEqual(int(sitk.GetArrayViewFromImage(output).sum()), 8)
+
+    def test_keep_largest_tie_keeps_the_first_component(self):
+        array = np.zeros((4, 12, 12), dtype=np.uint8)
+        array[1:3, 8:11, 8:11] = 1
+        array[1:3, 1:4, 1:4] = 1 # same size, first in raster order
+        mask = mask_image(array)
+        output = ImageProcessor.remove_small_components(mask)
+        self.assert_same_output(output, baseline_remove_small_components(mask))
+        # RelabelComponent sorts by size and breaks ties by raster order as well
+        largest = sitk.Cast(sitk.RelabelComponent(sitk.ConnectedComponent(mask)) == 1, sitk.sitkUInt8)
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(output), sitk.GetArrayViewFromImage(largest))
+        np.testing.assert_array_equal(sitk.GetArrayViewFromImage(output)[1:3, 1:4, 1:4], 1)
+        self.assertEqual(int(sitk.GetArrayViewFromImage(output).sum()), 18)
+
+
+if __name__ == "__main__":
+    unittest.main()
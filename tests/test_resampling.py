@@ -0,0 +1,118 @@
+'''
+Resampling plans against sitk.Resample, and their size bounded cache.
+
+    python -m pytest tests
+'''
+import unittest
+from unittest import mock
+import numpy as np
+import SimpleITK as sitk
+from Utils import helpers
+
+
+def grid(size:tuple, spacing:tuple, origin:tuple, rotation:tuple, pixel_type:int=sitk.sitkUInt8) -> sitk.Image:
+    ''' An empty image on a grid with an oblique direction '''
+    image = sitk.Image(size, pixel_type)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    euler = sitk.Euler3DTransform()
+    euler.SetRotation(*rotation)
+    image.SetDirection(euler.GetMatrix())
+    return image
+
+def nnunet_grid(pixel_type:int=sitk.sitkUInt8) -> sitk.Image:
+    return grid((36, 40, 12), (0.5, 0.6, 3.0), (-10.0, 5.0, -20.0), (0.1, -0.05, 0.2), pixel_type)
+
+def original_grid(shift:float=0.0) -> sitk.Image:
+    return grid((30, 33, 20), (0.7, 0.65, 1.9), (-11.0 + shift, 4.0, -21.0), (-0.03, 0.08, -0.1))
+
+def with_values(image:sitk.Image, array:np.ndarray) -> sitk.Image:
+    filled = sitk.GetImageFromArray(array)
+    filled.CopyInformation(image)
+    return filled
+
+
+class ResamplingPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        source = nnunet_grid()
+        shape = source.GetSize()[::-1]
+        self.mask = with_values(source, (rng.random(shape) > 0.5).astype(np.uint8))
+        self.probs = with_values(source, rng.random(shape).astype(np.float32))
+        self.reference = original_grid()
+
+    def assert_same_grid(self, image:sitk.Image, expected:sitk.Image):
+        self.assertEqual(image.GetPixelID(), expected.GetPixelID())
+        self.assertEqual(helpers._geometry(image), helpers._geometry(expected))
+
+    def test_nearest_neighbour_is_bit_identical(self):
+        plan = helpers.ResamplingPlan(self.mask, self.reference)
+        for image in (self.mask, self.probs):
+            expected = sitk.Resample(image, self.reference, sitk.Transform(), sitk.sitkNearestNeighbor)
+            resampled = plan.apply(image)
+            self.assert_same_grid(resampled, expected)
+            self.assertEqual(sitk.GetArrayViewFromImage(resampled).tobytes(),
+                             sitk.GetArrayViewFromImage(expected).tobytes())
+
+    def test_linear_matches_sitk(self):
+        plan = helpers.ResamplingPlan(self.probs, self.reference, sitk.sitkLinear)
+        expected = sitk.Resample(self.probs, self.reference, sitk.Transform(), sitk.sitkLinear)
+        resampled = plan.apply(self.probs)
+        self.assert_same_grid(resampled, expected)
+        expected_array = sitk.GetArrayViewFromImage(expected)
+        resampled_array = sitk.GetArrayViewFromImage(resampled)
+        np.testing.assert_allclose(resampled_array, expected_array, atol=1e-5)
+        # the voxels outside the source grid are zero for both
+        np.testing.assert_array_equal(resampled_array == 0, expected_array == 0)
+
+    def test_other_grid_is_rejected(self):
+        plan = helpers.ResamplingPlan(self.mask, self.reference)
+        with self.assertRaises(ValueError):
+            plan.apply(self.reference)
+
+
+class PlanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        helpers._PLANS.clear()
+        self.source = nnunet_grid()
+        self.plan_bytes = helpers.ResamplingPlan(self.source, original_grid()).nbytes
+
+    def tearDown(self):
+        helpers._PLANS.clear()
+
+    def test_plans_are_shared(self):
+        reference = original_grid()
+        plan = helpers.resampling_plan(self.source, reference)
+        self.assertIs(helpers.resampling_plan(nnunet_grid(sitk.sitkFloat32), reference), plan)
+        self.assertIsNot(helpers.resampling_plan(self.source, reference, sitk.sitkLinear), plan)
+
+    def test_least_recently_used_plan_is_evicted(self):
+        references = [original_grid(shift) for shift in (0.0, 1.0, 2.0)]
+        with mock.patch.object(helpers, "PLAN_CACHE_BYTES", 2 * self.plan_bytes):
+            first = helpers.resampling_plan(self.source, references[0])
+            helpers.resampling_plan(self.source, references[1])
+            self.assertIs(helpers.resampling_plan(self.source, references[0]), first) # now the most recent
+            helpers.resampling_plan(self.source, references[2])
+        cached = [key[1] for key in helpers._PLANS]
+        self.assertEqual(cached, [helpers._geometry(references[0]), helpers._geometry(references[2])])
+        self.assertLessEqual(sum(plan.nbytes for plan in helpers._PLANS.values()), 2 * self.plan_bytes)
+
+    def test_a_plan_larger_than_the_cache_is_kept_alone(self):
+        with mock.patch.object(helpers, "PLAN_CACHE_BYTES", self.plan_bytes // 2):
+            helpers.resampling_plan(self.source, original_grid(0.0))
+            plan = helpers.resampling_plan(self.source, original_grid(1.0))
+        self.assertEqual(list(helpers._PLANS.values()), [plan])
+
+    def test_release_drops_only_the_plans_to_that_reference(self):
+        released, kept = original_grid(0.0), original_grid(1.0)
+        helpers.resampling_plan(self.source, released)
+        helpers.resampling_plan(self.source, released, sitk.sitkLinear)
+        helpers.resampling_plan(self.source, kept)
+        helpers.release_resampling_plans(released)
+        self.assertEqual([key[1] for key in helpers._PLANS], [helpers._geometry(kept)])
+
+
+if __name__ == "__main__":
+    unittest.main()
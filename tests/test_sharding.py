@@ -0,0 +1,92 @@
+'''
+Shard specs, the partition of the cohort and the merge of the per shard indexes.
+
+    python -m pytest tests
+'''
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import unittest
+from Utils.sharding import Shard, parse_shard, merge_shards
+
+
+class ParseShardTest(unittest.TestCase):
+
+    def test_valid_specs(self):
+        self.assertEqual(parse_shard("0/1"), Shard(0, 1))
+        self.assertEqual(parse_shard(" 3 / 4 "), Shard(3, 4))
+
+    def test_invalid_specs(self):
+        for spec in ("0/0", "3/2", "2/2", "a/b", "1", "-1/2", "1/2/3", ""):
+            with self.subTest(spec=spec), self.assertRaises(argparse.ArgumentTypeError):
+                parse_shard(spec)
+
+
+class ShardSelectTest(unittest.TestCase):
+
+    def test_every_item_lands_in_exactly_one_shard(self):
+        items = [f"Pats/patient{number:03}" for number in range(53)]
+        for count in (1, 2, 3, 4, 7, 53, 60):
+            with self.subTest(count=count):
+                parts = [Shard(index, count).select(items) for index in range(count)]
+                selected = [item for part in parts for item in part]
+                self.assertEqual(sorted(selected), sorted(items))
+                self.assertEqual(len(selected), len(set(selected)))
+                # balanced within one item
+                self.assertLessEqual(max(map(len, parts)) - min(map(len, parts)), 1)
+
+    def test_partition_does_not_depend_on_the_listing_order(self):
+        items = [f"Pats/patient{number:03}" for number in range(20)]
+        self.assertEqual(Shard(1, 3).select(items), Shard(1, 3).select(reversed(items)))
+
+
+class MergeShardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outputs = tempfile.mkdtemp()
+        self.inputs = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outputs)
+        shutil.rmtree(self.inputs)
+
+    def write_index(self, shard:Shard, patients:dict):
+        path = os.path.join(self.outputs, f"nnOutputSegmentationPaths{shard.suffix}.json")
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(patients, file)
+
+    def merged_index(self) -> dict:
+        with open(os.path.join(self.outputs, "nnOutputSegmentationPaths.json"), "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def test_shards_are_merged(self):
+        self.write_index(Shard(0, 2), {"a": {"wg": "a"}})
+        self.write_index(Shard(1, 2), {"b": {"wg": "b"}})
+        self.assertEqual(merge_shards(self.outputs, self.inputs), {"nnOutputSegmentationPaths": 2})
+        self.assertEqual(self.merged_index(), {"a": {"wg": "a"}, "b": {"wg": "b"}})
+
+    def test_duplicate_patients_are_rejected(self):
+        self.write_index(Shard(0, 2), {"a": {}, "b": {}})
+        self.write_index(Shard(1, 2), {"b": {}})
+        with self.assertRaisesRegex(ValueError, "repeats patients"):
+            merge_shards(self.outputs, self.inputs)
+
+    def test_missing_shard_is_warned_about(self):
+        self.write_index(Shard(0, 3), {"a": {}})
+        self.write_index(Shard(2, 3), {"c": {}})
+        with self.assertLogs(level="WARNING") as logs:
+            merge_shards(self.outputs, self.inputs)
+        self.assertTrue(any("shards [1] of 3 are missing" in message for message in logs.output))
+        self.assertEqual(sorted(self.merged_index()), ["a", "c"])
+
+    def test_shards_of_different_runs_are_rejected(self):
+        self.write_index(Shard(0, 2), {"a": {}})
+        self.write_index(Shard(0, 3), {"b": {}})
+        with self.assertRaisesRegex(ValueError, "different runs"):
+            merge_shards(self.outputs, self.inputs)
+
+
+if __name__ == "__main__":
+    unittest.main()
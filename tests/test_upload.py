@@ -0,0 +1,87 @@
+'''
+Retries and per file results of the Orthanc uploader, against the local stub server.
+
+    python -m pytest tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from Utils.ImportDicomFiles import OrthancUploader, upload
+from benchmarks.stub_orthanc import StubOrthanc
+
+
+class OrthancUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "instance.dcm")
+        with open(self.path, "wb") as file:
+            file.write(b"\0" * 128 + b"DICM") # the uploader does not parse the files
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def uploader(self, server:StubOrthanc, retries:int=3, backoff:float=0.5) -> OrthancUploader:
+        return OrthancUploader("127.0.0.1", server.port, "orthanc", "orthanc", workers=1,
+                               retries=retries, backoff=backoff, timeout=5)
+
+    def test_retried_503_succeeds(self):
+        with StubOrthanc(responses=[503]) as server, mock.patch("Utils.ImportDicomFiles.time.sleep") as sleep:
+            result = self.uploader(server).upload_file(self.path)
+        self.assertTrue(result.success)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(result.attempts, 2)
+        self.assertIsNone(result.error)
+        self.assertEqual(server.requests, 2)
+        self.assertEqual(server.received, 1)
+        sleep.assert_called_once_with(0.5)
+
+    def test_persistent_500_fails(self):
+        with StubOrthanc(responses=[500] * 10) as server, mock.patch("Utils.ImportDicomFiles.time.sleep") as sleep:
+            result = self.uploader(server, retries=3, backoff=0.25).upload_file(self.path)
+        self.assertFalse(result.success)
+        self.assertEqual(result.status, 500)
+        self.assertEqual(result.error, "HTTP 500")
+        # one attempt and three retries, the waits double from the backoff
+        self.assertEqual(result.attempts, 4)
+        self.assertEqual(server.requests, 4)
+        self.assertEqual(server.received, 0)
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.25, 0.5, 1.0])
+
+    def test_429_is_retried(self):
+        with StubOrthanc(responses=[429, 429]) as server, mock.patch("Utils.ImportDicomFiles.time.sleep"):
+            result = self.uploader(server).upload_file(self.path)
+        self.assertTrue(result.success)
+        self.assertEqual(result.attempts, 3)
+
+    def test_client_error_is_not_retried(self):
+        with StubOrthanc(responses=[400]) as server, mock.patch("Utils.ImportDicomFiles.time.sleep") as sleep:
+            result = self.uploader(server).upload_file(self.path)
+        self.assertFalse(result.success)
+        self.assertEqual((result.status, result.attempts, result.error), (400, 1, "HTTP 400"))
+        self.assertEqual(server.requests, 1)
+        sleep.assert_not_called()
+
+    def test_upload_reports_every_file(self):
+        failing = os.path.join(self.folder, "series", "failing.dcm")
+        os.makedirs(os.path.dirname(failing))
+        shutil.copy(self.path, failing)
+        with open(os.path.join(self.folder, "notes.txt"), "w") as file:
+            file.write("not uploaded")
+        # workers=1: the requests come in the walk order, the first file is the one failing
+        expected_first = [os.path.join(dirs, file) for dirs, _, files in os.walk(self.folder)
+                          for file in files if file.endswith(".dcm")][0]
+        with StubOrthanc(responses=[500, 500]) as server, mock.patch("Utils.ImportDicomFiles.time.sleep"):
+            results = upload(self.folder, workers=1, ip="127.0.0.1", port=server.port,
+                             username="orthanc", password="orthanc", retries=1, backoff=0.0)
+        self.assertEqual(len(results), 2)
+        by_path = {result.path: result for result in results}
+        self.assertFalse(by_path[expected_first].success)
+        self.assertEqual(by_path[expected_first].attempts, 2)
+        self.assertEqual(sum(result.success for result in results), 1)
+        self.assertEqual(server.received, 1)
+
+if __name__ == "__main__":
+    unittest.main()
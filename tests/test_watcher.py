@@ -0,0 +1,106 @@
+'''
+Batches of the watch-folder ingestion: quiescence, acknowledged sources, retries
+and removed sources, with inotify and with polling.
+
+    python -m pytest tests
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from Utils.watcher import FolderWatcher
+from Utils.get_images import GENERATED_DIR
+
+
+class FolderWatcherTest(unittest.TestCase):
+    use_inotify = True
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.state = os.path.join(tempfile.mkdtemp(), "watch_state.json")
+        self.watcher = FolderWatcher(self.root, quiescence=0.1, poll_interval=0.05, state_path=self.state,
+                                     use_inotify=self.use_inotify)
+        self.stop = threading.Event()
+
+    def tearDown(self):
+        self.stop.set()
+        self.watcher.close()
+        shutil.rmtree(self.root)
+        shutil.rmtree(os.path.dirname(self.state))
+
+    def write(self, *parts:str) -> str:
+        path = os.path.join(self.root, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(path)
+        return path
+
+    def next_batch(self, batches, timeout:float=1.0) -> list:
+        ''' The next batch, None if nothing became ready within timeout '''
+        timer = threading.Timer(timeout, self.stop.set)
+        timer.start()
+        try:
+            return next(batches, None)
+        finally:
+            timer.cancel()
+
+    def test_sources_are_batched_generated_niftis_excluded(self):
+        nifti = self.write("t2.nii.gz")
+        self.write("patient", "series", "1.dcm")
+        self.write(GENERATED_DIR, "patient_series.nii.gz")
+        batch = self.next_batch(self.watcher.batches(self.stop))
+        self.assertEqual(batch, sorted([nifti, os.path.join(self.root, "patient", "series")]))
+
+    def test_failed_source_is_retried_once_changed(self):
+        self.write("patient", "series", "1.dcm")
+        series = os.path.join(self.root, "patient", "series")
+        batches = self.watcher.batches(self.stop)
+        self.assertEqual(self.next_batch(batches), [series])
+        # not marked as processed: failed, left alone until it changes
+        self.assertIsNone(self.next_batch(batches, timeout=0.5))
+        self.assertNotIn(series, self.watcher.processed)
+
+        self.stop.clear()
+        batches = self.watcher.batches(self.stop)
+        self.write("patient", "series", "2.dcm")
+        self.assertEqual(self.next_batch(batches), [series])
+        self.watcher.mark_processed([series])
+        self.assertIn(series, self.watcher.processed)
+        self.assertIsNone(self.next_batch(batches, timeout=0.5))
+
+    def test_new_directory_is_picked_up(self):
+        batches = self.watcher.batches(self.stop)
+        self.write("first.nii.gz")
+        self.watcher.mark_processed(self.next_batch(batches))
+        self.write("late", "patient", "series", "1.dcm")
+        self.assertEqual(self.next_batch(batches), [os.path.join(self.root, "late", "patient", "series")])
+
+    def test_removed_sources_are_pruned_from_the_state(self):
+        nifti = self.write("t2.nii.gz")
+        batches = self.watcher.batches(self.stop)
+        self.assertEqual(self.next_batch(batches), [nifti])
+        self.watcher.mark_processed([nifti])
+        os.remove(nifti)
+        self.assertIsNone(self.next_batch(batches, timeout=0.5))
+        self.assertNotIn(nifti, self.watcher.processed)
+        restarted = FolderWatcher(self.root, state_path=self.state, use_inotify=False)
+        self.assertEqual(restarted.processed, {})
+        restarted.close()
+
+    def test_state_survives_a_restart(self):
+        nifti = self.write("t2.nii.gz")
+        batches = self.watcher.batches(self.stop)
+        self.watcher.mark_processed(self.next_batch(batches))
+        restarted = FolderWatcher(self.root, quiescence=0.0, state_path=self.state, use_inotify=False)
+        self.assertIn(nifti, restarted.processed)
+        self.assertEqual(restarted.ready(0.0), {})
+        restarted.close()
+
+
+class PollingFolderWatcherTest(FolderWatcherTest):
+    use_inotify = False
+
+
+if __name__ == "__main__":
+    unittest.main()